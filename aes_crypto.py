@@ -1,6 +1,9 @@
 """Модуль для AES шифрования и дешифрования."""
 from base64 import b64encode, b64decode
 from hashlib import sha256
+from itertools import count
+from os import urandom
+from threading import Lock
 from Crypto.Cipher import AES
 from Crypto import Random
 from Crypto.Util.Padding import pad, unpad
@@ -33,3 +36,101 @@ class acrypt:
         cipher = AES.new(self.__key, AES.MODE_CBC, ivb)
         dec = unpad(cipher.decrypt(enc[AES.block_size:]), AES.block_size)
         return dec[:-ord(dec[len(dec) - 1:])].decode("utf8")
+
+    def encrypt_bytes(self, rawdata: bytes) -> bytes:
+        """Шифрует rawdata без base64 и двойного дополнения."""
+        ivb = Random.new().read(AES.block_size)
+        cipher = AES.new(self.__key, AES.MODE_CBC, ivb)
+        return ivb + cipher.encrypt(pad(rawdata, AES.block_size))
+
+    def decrypt_bytes(self, encrypted: bytes) -> bytes:
+        """Расшифровывает результат encrypt_bytes()."""
+        ivb = encrypted[:AES.block_size]
+        cipher = AES.new(self.__key, AES.MODE_CBC, ivb)
+        return unpad(
+            cipher.decrypt(encrypted[AES.block_size:]),
+            AES.block_size
+        )
+
+
+class agcm:
+    """Класс для AES-GCM шифрования с проверкой целостности.
+
+    Пакет состоит из nonce, шифротекста без дополнения и тега. Из общего
+    ключа сессии вычисляются отдельные ключи для пакетов клиента и
+    сервера, поэтому nonce двух сторон не могут совпасть при одном ключе.
+    Nonce - случайный префикс и счётчик пакетов, поэтому не повторяется в
+    пределах одного объекта.
+    """
+
+    CLIENT = "client"
+    SERVER = "server"
+    # Метки ключей для пакетов клиента серверу и сервера клиенту
+    LABELS = {CLIENT: b"agcm-c2s", SERVER: b"agcm-s2c"}
+    NONCE_PREFIX_SIZE = 4
+    NONCE_SIZE = 12
+    TAG_SIZE = 16
+
+    def __init__(self, key, side):
+        """Инициализация класса.
+
+        Аргументы:
+            key:    Общий ключ сессии.
+            side:   Сторона, которая использует объект (agcm.CLIENT или
+                        agcm.SERVER): её пакеты шифруются ключом её
+                        направления, пакеты другой стороны расшифровываются
+                        ключом обратного направления.
+        """
+        if side not in self.LABELS:
+            raise ValueError(f"Неизвестная сторона: {side}")
+
+        other = self.SERVER if side == self.CLIENT else self.CLIENT
+        # Отдельные ключи, чтобы один и тот же ключ не использовался в
+        # режимах CBC и GCM и в двух направлениях
+        self.__key = sha256(self.LABELS[side] + key.encode()).digest()
+        self.__peer_key = sha256(self.LABELS[other] + key.encode()).digest()
+        self.__prefix = urandom(self.NONCE_PREFIX_SIZE)
+        self.__counter = count()
+        self.__lock = Lock()
+
+    def __nonce(self) -> bytes:
+        """Возвращает следующий nonce."""
+        with self.__lock:
+            number = next(self.__counter)
+
+        return self.__prefix + number.to_bytes(
+            self.NONCE_SIZE - self.NONCE_PREFIX_SIZE,
+            "big"
+        )
+
+    def encrypt_bytes(self, rawdata: bytes) -> bytes:
+        """Шифрует rawdata."""
+        nonce = self.__nonce()
+        cipher = AES.new(
+            self.__key,
+            AES.MODE_GCM,
+            nonce=nonce,
+            mac_len=self.TAG_SIZE
+        )
+        encrypted, tag = cipher.encrypt_and_digest(rawdata)
+        return nonce + encrypted + tag
+
+    def decrypt_bytes(self, encrypted: bytes) -> bytes:
+        """Расшифровывает encrypted и проверяет тег.
+
+        Исключения:
+            ValueError: Пакет повреждён или подделан.
+        """
+        if len(encrypted) < self.NONCE_SIZE + self.TAG_SIZE:
+            raise ValueError("Пакет слишком короткий")
+
+        cipher = AES.new(
+            self.__peer_key,
+            AES.MODE_GCM,
+            nonce=encrypted[:self.NONCE_SIZE],
+            mac_len=self.TAG_SIZE
+        )
+        return cipher.decrypt_and_verify(
+            encrypted[self.NONCE_SIZE:-self.TAG_SIZE],
+            encrypted[-self.TAG_SIZE:]
+        )
@@ -0,0 +1,82 @@
+"""Сравнение режимов шифрования aes_crypto.
+
+Измеряется время шифрования и расшифровки одного пакета и размер
+шифротекста для старого режима acrypt (строки, двойное дополнение,
+base64), байтового режима acrypt (CBC без base64) и agcm (AES-GCM).
+
+Запуск:
+    python benchmarks/bench_aes_modes.py --repeat 5000
+"""
+from argparse import ArgumentParser
+from os import path
+from sys import path as sys_path
+from time import perf_counter
+
+ROOT = path.dirname(path.dirname(path.realpath(__file__)))
+sys_path.insert(0, ROOT)
+
+from aes_crypto import acrypt  # noqa: E402
+from aes_crypto import agcm  # noqa: E402
+
+SIZES = (64, 1024, 16384)
+
+
+def modes(key: str) -> dict:
+    """Возвращает функции шифрования и расшифровки для каждого режима."""
+    cbc = acrypt(key)
+    client = agcm(key, agcm.CLIENT)
+    server = agcm(key, agcm.SERVER)
+    return {
+        "acrypt": (
+            lambda data: cbc.encrypt(data.decode()),
+            cbc.decrypt
+        ),
+        "acrypt bytes": (cbc.encrypt_bytes, cbc.decrypt_bytes),
+        "agcm": (client.encrypt_bytes, server.decrypt_bytes)
+    }
+
+
+def measure(encrypt, decrypt, data: bytes, repeat: int) -> dict:
+    """Измеряет время шифрования и расшифровки data."""
+    encrypted = encrypt(data)
+    started = perf_counter()
+
+    for _ in range(repeat):
+        encrypt(data)
+
+    encrypt_time = perf_counter() - started
+    started = perf_counter()
+
+    for _ in range(repeat):
+        decrypt(encrypted)
+
+    decrypt_time = perf_counter() - started
+
+    return {
+        "bytes": len(encrypted),
+        "encrypt_us": encrypt_time / repeat * 1e6,
+        "decrypt_us": decrypt_time / repeat * 1e6
+    }
+
+
+def main() -> None:
+    """Основная функция."""
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5000)
+    args = parser.parse_args()
+
+    for size in SIZES:
+        data = b"x" * size
+
+        for name, (encrypt, decrypt) in modes("0" * 64).items():
+            result = measure(encrypt, decrypt, data, args.repeat)
+            print(
+                f"{size:6} байт {name:12}: "
+                f"шифротекст {result['bytes']:6} байт, "
+                f"шифрование {result['encrypt_us']:7.1f} мкс, "
+                f"расшифровка {result['decrypt_us']:7.1f} мкс"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Сравнение записи сообщений с объединением транзакций и без него.
+
+Несколько потоков отправляют сообщения через server.GroupCommitWriter и
+ждут подтверждения сохранения каждого из них, как это делает сервер перед
+ответом клиенту. База данных находится на диске, поэтому стоимость COMMIT
+включена в измерения.
+
+Запуск:
+    python benchmarks/bench_group_commit.py --messages 2000 --threads 16
+"""
+from argparse import ArgumentParser
+from os import path
+from sys import path as sys_path
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import perf_counter
+
+ROOT = path.dirname(path.dirname(path.realpath(__file__)))
+sys_path.insert(0, ROOT)
+
+from server import Database  # noqa: E402
+from server import GroupCommitWriter  # noqa: E402
+
+
+def prepare(database: str, users: int) -> list:
+    """Создаёт базу данных с users аккаунтами.
+
+    Возвращаемое значение: ID созданных аккаунтов.
+    """
+    dtb = Database(database)
+    dtb.reset_database()
+    ids = []
+
+    for i in range(users):
+        user_id = dtb.reserve_account(f"Bench{i}", "bench-password")[1]
+        # Хеш пароля не нужен для отправки сообщений
+        dtb.finish_account(user_id, "-")
+        ids.append(user_id)
+
+    dtb.close()
+    return ids
+
+
+def run(database: str, ids: list, args, interval: float) -> dict:
+    """Отправляет сообщения с заданным интервалом объединения."""
+    dtb = Database(database)
+    writer = GroupCommitWriter(dtb, interval, args.batch)
+    per_thread = args.messages // args.threads
+
+    def worker(index: int) -> None:
+        login = f"Bench{index % len(ids)}"
+        receiver = ids[(index + 1) % len(ids)]
+
+        for i in range(per_thread):
+            writer.submit(
+                dtb.send_message,
+                login,
+                receiver,
+                f"Сообщение {i}"
+            ).result()
+
+    threads = [
+        Thread(target=worker, args=(i,)) for i in range(args.threads)
+    ]
+    started = perf_counter()
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    elapsed = perf_counter() - started
+    writer.close()
+    dtb.close()
+
+    return {
+        "interval_ms": interval * 1000,
+        "messages_per_sec": per_thread * args.threads / elapsed
+    }
+
+
+def main() -> None:
+    """Основная функция."""
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--users", type=int, default=32)
+    parser.add_argument("--interval-ms", type=float, default=2)
+    parser.add_argument("--batch", type=int, default=256)
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as directory:
+        database = path.join(directory, "bench.db")
+        ids = prepare(database, args.users)
+
+        for interval in (0, args.interval_ms / 1000):
+            result = run(database, ids, args, interval)
+            print(
+                f"интервал {result['interval_ms']:5.1f} мс: "
+                f"{result['messages_per_sec']:8.1f} сообщений/с"
+            )
+
+
+if __name__ == "__main__":
+    main()
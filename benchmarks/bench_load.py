@@ -0,0 +1,815 @@
+"""Нагрузочный тест сервера множеством клиентов по UDP.
+
+Запускает сервер на временной базе данных и несколько процессов нагрузки,
+каждый из которых держит часть из --clients клиентов. Клиенты используют
+тот же протокол, что и main.py:
+
+1. Рукопожатие HANDSHAKE (все клиенты сразу, не больше
+   --handshake-concurrency одновременно).
+2. Регистрация, вход части клиентов (--login-fraction) и sync. Хеширование
+   пароля намеренно медленное, поэтому этот этап занимает большую часть
+   времени теста при большом количестве клиентов.
+3. В течение --duration секунд каждый клиент раз в --interval секунд
+   отправляет send_message или get_account_data (доля --read-fraction) и
+   ждёт ответа. Всё время теста клиенты отправляют client_alive.
+
+Результат: рукопожатий, регистраций и сообщений в секунду, задержки
+p50/p99/p999 по командам, память сервера (RSS) и снимок метрик сервера.
+Результат можно сохранить в JSON (--output) и сравнить с предыдущим
+запуском (--compare): при ухудшении больше --tolerance программа
+завершается с кодом 1.
+
+Запуск:
+    python benchmarks/bench_load.py --clients 2000 --duration 30 \\
+        --output load.json
+    python benchmarks/bench_load.py --clients 2000 --duration 30 \\
+        --compare load.json
+"""
+from argparse import ArgumentParser
+from collections import deque
+from datetime import datetime
+from datetime import timezone
+from heapq import heappop
+from heapq import heappush
+from json import dump
+from json import dumps
+from json import load
+from json import loads
+from multiprocessing import Process
+from multiprocessing import Queue
+from multiprocessing import Value
+from os import path
+from random import Random
+from selectors import EVENT_READ
+from selectors import DefaultSelector
+from shlex import split
+from socket import AF_INET
+from socket import SOCK_DGRAM
+from socket import socket
+from subprocess import DEVNULL
+from subprocess import PIPE
+from subprocess import Popen
+from sys import executable
+from sys import exit as sys_exit
+from sys import path as sys_path
+from tempfile import TemporaryDirectory
+from threading import Event
+from threading import Thread
+from time import perf_counter
+from time import time
+
+ROOT = path.dirname(path.dirname(path.realpath(__file__)))
+sys_path.insert(0, ROOT)
+
+from aes_crypto import acrypt  # noqa: E402
+from aes_crypto import agcm  # noqa: E402
+from bench_server_modes import percentile  # noqa: E402
+from bench_server_modes import wait_server  # noqa: E402
+from framing import Fragmenter  # noqa: E402
+from framing import Reassembler  # noqa: E402
+from metrics import AF_UNIX  # noqa: E402
+from metrics import fetch  # noqa: E402
+from server import KEY_EXTRA  # noqa: E402
+from server import Database  # noqa: E402
+import wire  # noqa: E402
+
+PASSWORD = "bench-password"
+CAPABILITIES = (wire.BINARY, wire.GCM, wire.ZLIB, wire.ZDICT)
+ALIVE_INTERVAL = 1
+HANDSHAKE_TIMEOUT = 1
+# Сравниваемые значения: путь в результате и больше ли значит лучше
+COMPARED = (
+    (("handshakes_per_sec",), True),
+    (("messages_per_sec",), True),
+    (("requests_per_sec",), True),
+    (("latency_ms", "all", "p50"), False),
+    (("latency_ms", "all", "p99"), False),
+    (("latency_ms", "all", "p999"), False),
+    (("server", "rss_peak_mb"), False)
+)
+
+
+class LoadClient:
+    """Клиент, отправляющий один запрос за раз и измеряющий задержки.
+
+    Сообщения, которые не являются ответом на запрос (например, new_message
+    от других клиентов), пропускаются.
+    """
+
+    def __init__(self, addr, login: str, capabilities) -> None:
+        """Инициализация клиента.
+
+        Аргументы:
+            addr:           Адрес сервера.
+            login:          Логин аккаунта.
+            capabilities:   Возможности, запрашиваемые при рукопожатии.
+        """
+        self.addr = addr
+        self.login = login
+        self.capabilities = capabilities
+        self.sock = None
+        self.key = None
+        self.aes = None
+        self.binary_aes = None
+        self.accepted = ()
+        self.fragmenter = Fragmenter()
+        self.reassembler = Reassembler()
+        self.steps = deque()
+        self.step = None
+        self.message = None
+        self.expected = None
+        self.sent_at = None
+        self.latencies = {}
+        self.errors = 0
+
+    def connect(self, selector: DefaultSelector) -> None:
+        """Открывает новый сокет и отправляет рукопожатие."""
+        if self.sock is not None:
+            selector.unregister(self.sock)
+            self.sock.close()
+
+        self.sock = socket(AF_INET, SOCK_DGRAM)
+        self.sock.connect(self.addr)
+        self.sock.setblocking(False)
+        selector.register(self.sock, EVENT_READ, self)
+        self.key = None
+        self.reassembler = Reassembler()
+        self.sock.send(wire.handshake(self.capabilities))
+
+    def send(self, message: list) -> None:
+        """Шифрует и отправляет сообщение."""
+        if wire.BINARY in self.accepted:
+            data = wire.encode(message)
+            dictionary = wire.PRESET_DICTIONARY \
+                if wire.ZDICT in self.accepted else None
+
+            if wire.ZLIB in self.accepted and \
+                    len(data) > wire.COMPRESSION_THRESHOLD:
+                compressed = wire.compress(data, dictionary)
+
+                if len(compressed) < len(data):
+                    encoded = wire.COMPRESSED_MAGIC + \
+                        self.binary_aes.encrypt_bytes(compressed)
+                else:
+                    encoded = wire.BINARY_MAGIC + \
+                        self.binary_aes.encrypt_bytes(data)
+            else:
+                encoded = wire.BINARY_MAGIC + \
+                    self.binary_aes.encrypt_bytes(data)
+        else:
+            encoded = self.aes.encrypt(dumps(
+                message,
+                separators=(",", ":"),
+                ensure_ascii=False
+            ))
+
+        for packet in self.fragmenter.split(encoded):
+            self.sock.send(packet)
+
+    def decode(self, payload: bytes):
+        """Расшифровывает сообщение сервера."""
+        dictionary = wire.PRESET_DICTIONARY \
+            if wire.ZDICT in self.accepted else None
+
+        if wire.is_compressed(payload):
+            return wire.decode(wire.decompress(
+                self.binary_aes.decrypt_bytes(
+                    payload[len(wire.COMPRESSED_MAGIC):]
+                ),
+                dictionary,
+                self.reassembler.max_bytes
+            ))
+
+        if wire.is_binary(payload):
+            return wire.decode(self.binary_aes.decrypt_bytes(
+                payload[len(wire.BINARY_MAGIC):]
+            ))
+
+        return loads(self.aes.decrypt(payload))
+
+    def request(self, name: str, message, reply: str, now: float,
+                selector: DefaultSelector) -> None:
+        """Отправляет запрос и ждёт ответа reply.
+
+        Аргументы:
+            name:       Название запроса для задержек.
+            message:    Команда или None для рукопожатия.
+            reply:      Ожидаемая команда ответа.
+            now:        Текущее время (perf_counter()).
+            selector:   Селектор сокетов процесса.
+        """
+        self.step = name
+        self.message = message
+        self.expected = reply
+        self.sent_at = now
+
+        if message is None:
+            self.connect(selector)
+        else:
+            self.send(message)
+
+    def next_step(self, now: float, selector: DefaultSelector) -> bool:
+        """Отправляет следующий запрос сценария.
+
+        Возвращаемое значение: Остались ли запросы в сценарии.
+        """
+        if not self.steps:
+            self.step = None
+            return False
+
+        self.request(*self.steps.popleft(), now, selector)
+        return True
+
+    def on_readable(self, now: float) -> bool:
+        """Получает пакет.
+
+        Возвращаемое значение: Получен ли ответ на текущий запрос.
+        """
+        try:
+            packet = self.sock.recv(70000)
+        except OSError:
+            return False
+
+        if self.key is None:
+            self.key, self.accepted = wire.parse_handshake_reply(packet)
+            self.aes = acrypt(KEY_EXTRA + self.key)
+            self.binary_aes = agcm(KEY_EXTRA + self.key, agcm.CLIENT) \
+                if wire.GCM in self.accepted else self.aes
+            return self.finish(now, "handshake")
+
+        payload = self.reassembler.feed(packet)
+
+        if payload is None:
+            return False
+
+        data = self.decode(payload)
+
+        if data[0] in ("register_status", "login_status") and data[1] != 0:
+            self.errors += 1
+
+        return self.finish(now, data[0])
+
+    def finish(self, now: float, reply: str) -> bool:
+        """Записывает задержку, если reply - ответ на текущий запрос."""
+        if self.step is None or reply != self.expected:
+            return False
+
+        self.latencies.setdefault(self.step, []).append(now - self.sent_at)
+        self.step = None
+        return True
+
+
+def heartbeat(clients: deque, now: float) -> None:
+    """Отправляет client_alive клиентам, которые давно его не отправляли.
+
+    Клиенты в clients упорядочены по времени последнего client_alive.
+    """
+    while clients and now - clients[0][0] > ALIVE_INTERVAL:
+        client = clients.popleft()[1]
+
+        if client.key is not None:
+            client.send(["client_alive"])
+
+        clients.append((now, client))
+
+
+def receive(selector, timeout: float) -> list:
+    """Получает пакеты клиентов.
+
+    Возвращаемое значение: Клиенты, получившие ответ на свой запрос.
+    """
+    events = selector.select(timeout)
+    now = perf_counter()
+    return [key.data for key, _ in events if key.data.on_readable(now)]
+
+
+def run_script(selector, clients: list, alive: deque, script,
+               concurrency: int, timeout: float) -> dict:
+    """Проводит клиентов через сценарий, не больше concurrency сразу.
+
+    Запрос без ответа дольше timeout отправляется повторно.
+
+    Аргументы:
+        selector:       Селектор сокетов процесса.
+        clients:        Клиенты.
+        alive:          Очередь client_alive (см. heartbeat()).
+        script:         Функция, возвращающая шаги сценария клиента
+                            (название, команда, ожидаемый ответ).
+        concurrency:    Сколько клиентов выполняют сценарий одновременно.
+        timeout:        Время ожидания ответа в секундах.
+
+    Возвращаемое значение: Время начала и конца этапа (time()) и
+        количество повторов.
+    """
+    waiting = deque(clients)
+    active = set()
+    retries = 0
+    started = time()
+
+    while waiting or active:
+        now = perf_counter()
+
+        while waiting and len(active) < concurrency:
+            client = waiting.popleft()
+            client.steps = deque(script(client))
+
+            if client.next_step(now, selector):
+                active.add(client)
+
+        for client in receive(selector, 0.05):
+            if client in active and \
+                    not client.next_step(perf_counter(), selector):
+                active.discard(client)
+
+        now = perf_counter()
+
+        for client in active:
+            if now - client.sent_at > timeout:
+                retries += 1
+                client.request(
+                    client.step,
+                    client.message,
+                    client.expected,
+                    now,
+                    selector
+                )
+
+        heartbeat(alive, now)
+
+    return {"started": started, "finished": time(), "retries": retries}
+
+
+def run_steady(selector, clients: list, alive: deque, args,
+               rng: Random) -> dict:
+    """Отправляет запросы в течение args.duration секунд.
+
+    Каждый клиент отправляет следующий запрос через args.interval секунд
+    после ответа на предыдущий. Запрос без ответа дольше args.timeout
+    считается потерянным.
+
+    Возвращаемое значение: Время начала и конца этапа (time()) и
+        количество потерянных запросов.
+    """
+    text = ("Сообщение " * (args.message_size // 10 + 1))[:args.message_size]
+    now = perf_counter()
+    deadline = now + args.duration
+    schedule = [
+        (now + rng.random() * args.interval, client.index, client)
+        for client in clients
+    ]
+    schedule.sort()
+    pending = deque()
+    lost = 0
+    started = time()
+
+    while now < deadline:
+        while schedule and schedule[0][0] <= now:
+            client = heappop(schedule)[2]
+
+            if rng.random() < args.read_fraction:
+                client.request(
+                    "get_account_data",
+                    ["get_account_data"],
+                    "sync_data",
+                    now,
+                    selector
+                )
+            else:
+                client.request(
+                    "send_message",
+                    ["send_message", text, rng.randint(1, args.clients)],
+                    "message_ack",
+                    now,
+                    selector
+                )
+
+            pending.append((now, client))
+
+        wait = 0.05 if not schedule else \
+            min(0.05, max(0, schedule[0][0] - perf_counter()))
+
+        for client in receive(selector, wait):
+            heappush(
+                schedule,
+                (perf_counter() + args.interval, client.index, client)
+            )
+
+        now = perf_counter()
+
+        while pending and now - pending[0][0] > args.timeout:
+            sent_at, client = pending.popleft()
+
+            if client.step is not None and client.sent_at == sent_at:
+                lost += 1
+                client.step = None
+                heappush(schedule, (now, client.index, client))
+
+        heartbeat(alive, now)
+
+    return {"started": started, "finished": time(), "lost": lost}
+
+
+def wait_others(selector, alive: deque, done, processes: int,
+                phase: int) -> None:
+    """Ждёт, пока все процессы нагрузки завершат этап phase.
+
+    Клиенты в это время продолжают отправлять client_alive, чтобы сервер
+    их не отключил.
+    """
+    with done.get_lock():
+        done.value += 1
+
+    while done.value < processes * phase:
+        receive(selector, 0.05)
+        heartbeat(alive, perf_counter())
+
+
+def run_load(addr, index: int, logins: list, args, done,
+             results: Queue) -> None:
+    """Процесс нагрузки: проводит клиентов с логинами logins через этапы.
+
+    Результат передаётся в results.
+    """
+    rng = Random(index)
+    selector = DefaultSelector()
+    capabilities = () if args.json else CAPABILITIES
+    clients = [LoadClient(addr, login, capabilities) for login in logins]
+    alive = deque()
+    logged = set(rng.sample(
+        logins,
+        int(len(logins) * args.login_fraction)
+    ))
+
+    for number, client in enumerate(clients):
+        client.index = number
+        alive.append((0.0, client))
+
+    def auth_script(client):
+        steps = [("register", ["register", client.login, PASSWORD],
+                  "register_status")]
+
+        if client.login in logged:
+            steps += [
+                ("reconnect", None, "handshake"),
+                ("login", ["login", client.login, PASSWORD], "login_status")
+            ]
+
+        return steps + [("sync", ["sync", 0, False], "sync_data")]
+
+    phases = {}
+    phases["handshake"] = run_script(
+        selector,
+        clients,
+        alive,
+        lambda client: [("handshake", None, "handshake")],
+        args.handshake_concurrency,
+        HANDSHAKE_TIMEOUT
+    )
+    wait_others(selector, alive, done, args.load_processes, 1)
+    phases["auth"] = run_script(
+        selector,
+        clients,
+        alive,
+        auth_script,
+        args.auth_concurrency,
+        args.auth_timeout
+    )
+    wait_others(selector, alive, done, args.load_processes, 2)
+    phases["steady"] = run_steady(selector, clients, alive, args, rng)
+    latencies = {}
+
+    for client in clients:
+        for step, values in client.latencies.items():
+            latencies.setdefault(step, []).extend(values)
+
+        client.sock.close()
+
+    results.put({
+        "phases": phases,
+        "latencies": latencies,
+        "errors": sum(client.errors for client in clients)
+    })
+
+
+def process_rss(pid: int) -> int:
+    """Возвращает RSS процесса pid и его потомков в байтах (только Linux)."""
+    total = 0
+
+    try:
+        with open(f"/proc/{pid}/status", encoding="ascii") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    total += int(line.split()[1]) * 1024
+
+        with open(
+            f"/proc/{pid}/task/{pid}/children",
+            encoding="ascii"
+        ) as file:
+            children = [int(child) for child in file.read().split()]
+    except OSError:
+        return total
+
+    return total + sum(process_rss(child) for child in children)
+
+
+class RssSampler(Thread):
+    """Поток, запоминающий наибольший RSS сервера."""
+
+    def __init__(self, pid: int, interval: float = 0.5) -> None:
+        """Инициализация потока."""
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self.last = 0
+        self.stopped = Event()
+
+    def run(self) -> None:
+        """Измеряет RSS раз в interval секунд."""
+        while not self.stopped.is_set():
+            self.last = process_rss(self.pid)
+            self.peak = max(self.peak, self.last)
+            self.stopped.wait(self.interval)
+
+
+def summarize(values: list) -> dict:
+    """Возвращает количество и перцентили задержек в миллисекундах."""
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "p50": percentile(values, 0.5) * 1000,
+        "p99": percentile(values, 0.99) * 1000,
+        "p999": percentile(values, 0.999) * 1000
+    }
+
+
+def phase_time(results: list, phase: str) -> float:
+    """Возвращает длительность этапа во всех процессах нагрузки."""
+    return max(
+        result["phases"][phase]["finished"] for result in results
+    ) - min(result["phases"][phase]["started"] for result in results)
+
+
+def aggregate(results: list, sampler: RssSampler) -> dict:
+    """Объединяет результаты процессов нагрузки."""
+    latencies = {}
+
+    for result in results:
+        for step, values in result["latencies"].items():
+            latencies.setdefault(step, []).extend(values)
+
+    steady = latencies.get("send_message", []) + \
+        latencies.get("get_account_data", [])
+    latency_ms = {
+        step: summarize(values) for step, values in latencies.items()
+    }
+    latency_ms["all"] = summarize(steady)
+    steady_time = phase_time(results, "steady")
+    return {
+        "handshakes_per_sec": len(latencies.get("handshake", [])) /
+        phase_time(results, "handshake"),
+        "registrations_per_sec": len(latencies.get("register", [])) /
+        phase_time(results, "auth"),
+        "messages_per_sec": len(latencies.get("send_message", [])) /
+        steady_time,
+        "requests_per_sec": len(steady) / steady_time,
+        "latency_ms": latency_ms,
+        "lost": sum(result["phases"]["steady"]["lost"] for result in results),
+        "retries": sum(
+            result["phases"][phase]["retries"]
+            for result in results
+            for phase in ("handshake", "auth")
+        ),
+        "errors": sum(result["errors"] for result in results),
+        "server": {
+            "rss_mb": sampler.last / 2 ** 20,
+            "rss_peak_mb": sampler.peak / 2 ** 20
+        }
+    }
+
+
+def git_revision() -> str:
+    """Возвращает текущий коммит или None."""
+    try:
+        process = Popen(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            stdout=PIPE,
+            stderr=DEVNULL
+        )
+    except OSError:
+        return None
+
+    output = process.communicate()[0].decode("ascii").strip()
+    return output or None
+
+
+def run(args) -> dict:
+    """Запускает сервер и нагрузку.
+
+    Возвращаемое значение: Результат теста.
+    """
+    addr = ("127.0.0.1", args.port)
+
+    with TemporaryDirectory() as directory:
+        database = path.join(directory, "bench.db")
+        metrics_socket = path.join(directory, "metrics.sock")
+        dtb = Database(database)
+        dtb.reset_database()
+        dtb.close()
+        command = [
+            executable,
+            path.join(ROOT, "server.py"),
+            "--mode", args.mode,
+            "--host", addr[0],
+            "--port", str(args.port),
+            "--database", database
+        ]
+
+        if AF_UNIX is not None:
+            command += ["--metrics-socket", metrics_socket]
+
+        process = Popen(
+            command + split(args.server_args),
+            stdout=DEVNULL,
+            stderr=DEVNULL
+        )
+        sampler = RssSampler(process.pid)
+
+        try:
+            wait_server(addr)
+            sampler.start()
+            done = Value("i", 0)
+            results = Queue()
+            logins = [f"Load{i}" for i in range(args.clients)]
+            loads_ = [
+                Process(target=run_load, args=(
+                    addr,
+                    index,
+                    logins[index::args.load_processes],
+                    args,
+                    done,
+                    results
+                ))
+                for index in range(args.load_processes)
+            ]
+
+            for load_process in loads_:
+                load_process.start()
+
+            collected = [results.get() for _ in loads_]
+
+            for load_process in loads_:
+                load_process.join()
+
+            server_metrics = None
+
+            if AF_UNIX is not None and path.exists(metrics_socket):
+                server_metrics = fetch(metrics_socket)
+        finally:
+            sampler.stopped.set()
+            process.terminate()
+            process.wait()
+
+    config = dict(vars(args))
+
+    for key in ("output", "compare", "tolerance"):
+        config.pop(key)
+
+    return {
+        "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "config": config,
+        **aggregate(collected, sampler),
+        "server_metrics": server_metrics
+    }
+
+
+def lookup(result: dict, keys: tuple):
+    """Возвращает значение по пути keys или None."""
+    for key in keys:
+        if not isinstance(result, dict) or key not in result:
+            return None
+
+        result = result[key]
+
+    return result
+
+
+def compare(baseline: dict, result: dict, tolerance: float) -> bool:
+    """Выводит изменения относительно baseline.
+
+    Возвращаемое значение: Есть ли ухудшения больше tolerance.
+    """
+    regressed = False
+
+    for keys, higher_is_better in COMPARED:
+        old = lookup(baseline, keys)
+        new = lookup(result, keys)
+
+        if not old or new is None:
+            continue
+
+        change = (new - old) / old
+        worse = -change if higher_is_better else change
+        mark = ""
+
+        if worse > tolerance:
+            regressed = True
+            mark = " УХУДШЕНИЕ"
+
+        print(
+            f"{'.'.join(keys):>22}: {old:10.2f} -> {new:10.2f} "
+            f"({change:+7.1%}){mark}"
+        )
+
+    return regressed
+
+
+def report(result: dict) -> None:
+    """Выводит результат теста."""
+    print(
+        f"рукопожатий: {result['handshakes_per_sec']:9.1f}/с, "
+        f"регистраций: {result['registrations_per_sec']:7.1f}/с"
+    )
+    print(
+        f"сообщений:   {result['messages_per_sec']:9.1f}/с, "
+        f"запросов:    {result['requests_per_sec']:7.1f}/с, "
+        f"потеряно {result['lost']}, повторов {result['retries']}, "
+        f"ошибок {result['errors']}"
+    )
+
+    for step, latency in sorted(result["latency_ms"].items()):
+        print(
+            f"{step:>16}: {latency['count']:7} запросов, "
+            f"p50 {latency['p50']:8.2f} мс, p99 {latency['p99']:8.2f} мс, "
+            f"p999 {latency['p999']:8.2f} мс"
+        )
+
+    print(
+        f"RSS сервера: {result['server']['rss_mb']:.1f} МБ "
+        f"(наибольший {result['server']['rss_peak_mb']:.1f} МБ)"
+    )
+
+
+def main() -> None:
+    """Основная функция."""
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--load-processes", type=int, default=1)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=0.1,
+        help="Пауза клиента между ответом и следующим запросом в секундах"
+    )
+    parser.add_argument("--read-fraction", type=float, default=0.2)
+    parser.add_argument("--login-fraction", type=float, default=0.1)
+    parser.add_argument("--message-size", type=int, default=64)
+    parser.add_argument("--timeout", type=float, default=2)
+    parser.add_argument("--handshake-concurrency", type=int, default=256)
+    parser.add_argument("--auth-concurrency", type=int, default=16)
+    parser.add_argument("--auth-timeout", type=float, default=120)
+    parser.add_argument(
+        "--json",
+        action="store_true",
+        help="Не запрашивать двоичный формат и сжатие (старые клиенты)"
+    )
+    parser.add_argument(
+        "--mode",
+        choices=["blocking", "asyncio"],
+        default="asyncio"
+    )
+    parser.add_argument(
+        "--server-args",
+        default="",
+        help="Дополнительные аргументы server.py, например \"--shards 4\""
+    )
+    parser.add_argument("--port", type=int, default=17509)
+    parser.add_argument("--output", default=None, help="Файл результата")
+    parser.add_argument(
+        "--compare",
+        default=None,
+        help="Файл предыдущего результата для сравнения"
+    )
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+
+    result = run(args)
+    report(result)
+
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf8") as file:
+            dump(result, file, ensure_ascii=False, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare, encoding="utf8") as file:
+            baseline = load(file)
+
+        if compare(baseline, result, args.tolerance):
+            sys_exit(1)
+
+
+if __name__ == "__main__":
+    main()
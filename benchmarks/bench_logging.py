@@ -0,0 +1,97 @@
+"""Сравнение print() с журналом через очередь при медленном выводе.
+
+Имитируется медленный терминал: каждая запись в поток занимает --delay
+миллисекунд. Измеряется время, которое поток обработки пакетов тратит на
+запись одной команды: print() ждёт вывода, а журнал только кладёт запись в
+очередь (или отбрасывает её, если очередь заполнена).
+
+Запуск:
+    python benchmarks/bench_logging.py --records 2000 --delay 1
+"""
+from argparse import ArgumentParser
+from logging import Formatter
+from logging import StreamHandler
+from os import path
+from queue import Queue
+from sys import path as sys_path
+from time import perf_counter
+from time import sleep
+
+ROOT = path.dirname(path.dirname(path.realpath(__file__)))
+sys_path.insert(0, ROOT)
+
+import log  # noqa: E402
+from metrics import metrics  # noqa: E402
+
+COMMAND = ["send_message", "Привет! " * 40, 2]
+
+
+class SlowStream:
+    """Поток вывода, каждая запись в который занимает delay секунд."""
+
+    def __init__(self, delay: float) -> None:
+        """Инициализация."""
+        self.delay = delay
+
+    def write(self, _text: str) -> None:
+        """Записывает текст."""
+        sleep(self.delay)
+
+    def flush(self) -> None:
+        """Ничего не делает."""
+
+
+def measure_print(stream: SlowStream, records: int) -> float:
+    """Возвращает среднее время print() в микросекундах."""
+    started = perf_counter()
+
+    for _ in range(records):
+        print("Получено от клиента:", COMMAND, file=stream)
+
+    return (perf_counter() - started) / records * 1e6
+
+
+def measure_log(stream: SlowStream, records: int, rate: float) -> float:
+    """Возвращает среднее время log.trace() в микросекундах."""
+    target = StreamHandler(stream)
+    target.setFormatter(Formatter(log.LOG_FORMAT))
+    queue = Queue(log.LOG_QUEUE_SIZE)
+    log.logger.addHandler(log.DroppingQueueHandler(queue))
+    log.logger.setLevel("DEBUG")
+    listener = log.LogListener(queue, target)
+    listener.start()
+    sampler = log.PacketSampler(rate)
+    started = perf_counter()
+
+    for _ in range(records):
+        log.trace(sampler, "Получено от клиента", COMMAND)
+
+    elapsed = perf_counter() - started
+    log.shutdown(listener)
+    return elapsed / records * 1e6
+
+
+def main() -> None:
+    """Основная функция."""
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--records", type=int, default=2000)
+    parser.add_argument("--delay", type=float, default=1)
+    args = parser.parse_args()
+    stream = SlowStream(args.delay / 1000)
+
+    print(
+        f"print():              "
+        f"{measure_print(stream, args.records):9.1f} мкс/запись"
+    )
+
+    for rate in (1, log.PACKET_SAMPLE_RATE):
+        dropped = metrics.counter("log.dropped")
+        elapsed = measure_log(stream, args.records, rate)
+        print(
+            f"журнал, выборка {rate:4}: {elapsed:9.1f} мкс/запись, "
+            f"отброшено {metrics.counter('log.dropped') - dropped}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+"""Сравнение блокирующего и асинхронного режимов сервера.
+
+Запускает сервер в отдельном процессе для каждого режима. Часть клиентов
+постоянно входит в аккаунт с неверным паролем (медленный bcrypt), остальные
+отправляют быстрые запросы и измеряют время ответа.
+
+Запуск:
+    python benchmarks/bench_server_modes.py --duration 10
+"""
+from argparse import ArgumentParser
+from json import dumps
+from json import loads
+from os import path
+from selectors import EVENT_READ
+from selectors import DefaultSelector
+from socket import AF_INET
+from socket import SOCK_DGRAM
+from socket import socket
+from subprocess import DEVNULL
+from subprocess import Popen
+from sys import executable
+from sys import path as sys_path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from time import sleep
+
+ROOT = path.dirname(path.dirname(path.realpath(__file__)))
+sys_path.insert(0, ROOT)
+
+from aes_crypto import acrypt  # noqa: E402
+from server import KEY_EXTRA  # noqa: E402
+from server import Database  # noqa: E402
+
+HANDSHAKE = b"\x05\x03\xff\x01"
+ALIVE_INTERVAL = 1
+RESEND_TIMEOUT = 2
+
+
+class BenchClient:
+    """Клиент, отправляющий один запрос за раз."""
+
+    def __init__(
+        self,
+        addr,
+        request: list,
+        resend_timeout: float = RESEND_TIMEOUT
+    ) -> None:
+        """Инициализация клиента.
+
+        Аргументы:
+            addr:           Адрес сервера.
+            request:        Запрос, который клиент отправляет по кругу.
+            resend_timeout: Через сколько секунд повторять запрос без ответа.
+        """
+        self.sock = socket(AF_INET, SOCK_DGRAM)
+        self.sock.connect(addr)
+        self.sock.settimeout(5)
+        self.request = request
+        self.resend_timeout = resend_timeout
+        self.sent_at = None
+        self.alive_at = 0
+        self.latencies = []
+        self.sock.send(HANDSHAKE)
+        key = self.sock.recv(70000).decode("ascii")
+        self.aes = acrypt(KEY_EXTRA + key)
+        self.sock.setblocking(False)
+
+    def send(self, message: list) -> None:
+        """Шифрует и отправляет сообщение."""
+        self.sock.send(self.aes.encrypt(dumps(
+            message,
+            separators=(",", ":"),
+            ensure_ascii=False
+        )))
+
+    def tick(self, now: float) -> None:
+        """Отправляет запрос, если предыдущий получен или потерян."""
+        if now - self.alive_at > ALIVE_INTERVAL:
+            self.send(["client_alive"])
+            self.alive_at = now
+
+        if self.sent_at is None or now - self.sent_at > self.resend_timeout:
+            self.sent_at = now
+            self.send(self.request)
+
+    def on_readable(self) -> None:
+        """Получает ответ и записывает задержку."""
+        loads(self.aes.decrypt(self.sock.recv(70000)))
+        now = perf_counter()
+        self.latencies.append(now - self.sent_at)
+        self.sent_at = None
+        self.tick(now)
+
+
+def percentile(values: list, part: float) -> float:
+    """Возвращает перцентиль part (от 0 до 1) отсортированного списка."""
+    if len(values) == 0:
+        return float("nan")
+
+    return values[min(len(values) - 1, int(len(values) * part))]
+
+
+def wait_server(addr, timeout: float = 10) -> None:
+    """Ждёт, пока сервер начнёт отвечать на рукопожатие."""
+    started = perf_counter()
+
+    with socket(AF_INET, SOCK_DGRAM) as sock:
+        sock.settimeout(0.2)
+        sock.connect(addr)
+
+        while perf_counter() - started < timeout:
+            try:
+                sock.send(HANDSHAKE)
+                sock.recv(70000)
+                return
+            except OSError:
+                sleep(0.1)
+
+    raise TimeoutError("Сервер не запустился")
+
+
+def run_mode(mode: str, args, database: str, port: int) -> dict:
+    """Запускает сервер в режиме mode и измеряет его."""
+    addr = ("127.0.0.1", port)
+    process = Popen([
+        executable,
+        path.join(ROOT, "server.py"),
+        "--mode", mode,
+        "--host", addr[0],
+        "--port", str(port),
+        "--database", database
+    ], stdout=DEVNULL, stderr=DEVNULL)
+
+    try:
+        wait_server(addr)
+
+        fast = [
+            BenchClient(addr, ["get_account_data"])
+            for _ in range(args.clients)
+        ]
+        # Сервер не отвечает на неверный пароль, поэтому медленные клиенты
+        # просто повторяют вход с заданным интервалом
+        slow = [
+            BenchClient(
+                addr,
+                ["login", "Bench", "wrong-password"],
+                args.slow_interval
+            )
+            for _ in range(args.slow_clients)
+        ]
+        selector = DefaultSelector()
+
+        for client in fast + slow:
+            selector.register(client.sock, EVENT_READ, client)
+
+        started = perf_counter()
+
+        while perf_counter() - started < args.duration:
+            now = perf_counter()
+
+            for client in fast + slow:
+                client.tick(now)
+
+            for key, _ in selector.select(0.05):
+                key.data.on_readable()
+
+        elapsed = perf_counter() - started
+
+        for client in fast + slow:
+            client.sock.close()
+    finally:
+        process.terminate()
+        process.wait()
+
+    latencies = sorted(sum((client.latencies for client in fast), []))
+
+    return {
+        "mode": mode,
+        "packets_per_sec": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "slow_requests": args.slow_clients * int(
+            elapsed / args.slow_interval
+        )
+    }
+
+
+def main() -> None:
+    """Основная функция."""
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--slow-clients", type=int, default=2)
+    parser.add_argument("--slow-interval", type=float, default=1)
+    parser.add_argument("--port", type=int, default=17505)
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as directory:
+        database = path.join(directory, "bench.db")
+        dtb = Database(database)
+        dtb.reset_database()
+        dtb.create_account("Bench", "bench-password")
+        dtb.close()
+
+        for offset, mode in enumerate(["blocking", "asyncio"]):
+            result = run_mode(mode, args, database, args.port + offset)
+            print(
+                f"{result['mode']:>8}: "
+                f"{result['packets_per_sec']:8.1f} пакетов/с, "
+                f"p50 {result['p50_ms']:7.2f} мс, "
+                f"p99 {result['p99_ms']:7.2f} мс, "
+                f"медленных запросов ~{result['slow_requests']}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Сравнение записи сообщений в один файл и в несколько файлов.
+
+Несколько процессов (как серверы в режиме --workers) одновременно
+отправляют сообщения в разных переписках. SQLite блокирует запись во весь
+файл, поэтому с одним файлом процессы ждут друг друга, а при разделении
+сообщений по файлам пишут параллельно.
+
+Запуск:
+    python benchmarks/bench_shards.py --processes 4 --shards 0 4
+"""
+from argparse import ArgumentParser
+from multiprocessing import Pool
+from os import path
+from sys import path as sys_path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+ROOT = path.dirname(path.dirname(path.realpath(__file__)))
+sys_path.insert(0, ROOT)
+
+from server import Database  # noqa: E402
+from server import STORAGE_PROFILES  # noqa: E402
+
+
+def prepare(database: str, shards: int, users: int) -> None:
+    """Создаёт базу данных с users аккаунтами."""
+    dtb = Database(database, shards=shards)
+    dtb.reset_database()
+
+    for i in range(users):
+        user_id = dtb.reserve_account(f"Bench{i}", "bench-password")[1]
+        dtb.finish_account(user_id, "-")
+
+    dtb.close()
+
+
+def write(database: str, shards: int, profile: str, index: int,
+          users: int, messages: int) -> float:
+    """Отправляет messages сообщений от пользователя номер index.
+
+    Возвращаемое значение: Затраченное время в секундах.
+    """
+    dtb = Database(database, profile=STORAGE_PROFILES[profile], shards=shards)
+    login = f"Bench{index % users}"
+    started = perf_counter()
+
+    for i in range(messages):
+        # Каждый процесс пишет в несколько своих переписок
+        dtb.send_message(login, (index + i) % users + 1, f"Сообщение {i}")
+
+    elapsed = perf_counter() - started
+    dtb.close()
+    return elapsed
+
+
+def main() -> None:
+    """Основная функция."""
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--users", type=int, default=64)
+    parser.add_argument("--shards", type=int, nargs="+", default=[0, 4])
+    parser.add_argument(
+        "--storage-profile",
+        choices=list(STORAGE_PROFILES),
+        default="durable"
+    )
+    args = parser.parse_args()
+
+    for shards in args.shards:
+        with TemporaryDirectory() as directory:
+            database = path.join(directory, "bench.db")
+            prepare(database, shards, args.users)
+
+            with Pool(args.processes) as pool:
+                started = perf_counter()
+                pool.starmap(write, [
+                    (
+                        database,
+                        shards,
+                        args.storage_profile,
+                        index,
+                        args.users,
+                        args.messages
+                    )
+                    for index in range(args.processes)
+                ])
+                elapsed = perf_counter() - started
+
+        print(
+            f"файлов сообщений {shards:2}: "
+            f"{args.processes * args.messages / elapsed:8.1f} сообщений/с"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""Сравнение формата JSON + base64 с двоичным форматом wire.
+
+Для типичных ответов сервера (новое сообщение, подтверждение, страница
+переписки и данные аккаунта) измеряются размер зашифрованного пакета в
+байтах на сообщение, количество датаграмм и время кодирования и
+декодирования вместе с шифрованием и сжатием.
+
+Запуск:
+    python benchmarks/bench_wire_format.py --messages 50 --repeat 2000
+"""
+from argparse import ArgumentParser
+from json import dumps
+from json import loads
+from os import path
+from random import Random
+from sys import path as sys_path
+from time import perf_counter
+
+ROOT = path.dirname(path.dirname(path.realpath(__file__)))
+sys_path.insert(0, ROOT)
+
+from aes_crypto import acrypt  # noqa: E402
+from framing import FRAGMENT_SIZE  # noqa: E402
+import wire  # noqa: E402
+
+
+WORDS = (
+    "привет как дела что нового завтра встреча в офисе отправь файл "
+    "спасибо хорошо договорились позвони мне вечером проект готов"
+).split()
+
+
+def rows(count: int) -> list:
+    """Создаёт count строк сообщений, как их возвращает база данных."""
+    random = Random(count)
+    return [
+        [
+            1000 + i,
+            7 + i % 2,
+            " ".join(random.choices(WORDS, k=random.randint(2, 9))),
+            8 - i % 2,
+            i % 2
+        ]
+        for i in range(count)
+    ]
+
+
+def samples(count: int) -> dict:
+    """Возвращает ответы сервера и количество сообщений в каждом."""
+    page = rows(count)
+    return {
+        "new_message": (
+            ["new_message", page[0], {"7": "Отправитель"}],
+            1
+        ),
+        "message_ack": (["message_ack", page[0]], 1),
+        "conversation": (["conversation", 8, page, count == 50], count),
+        "account_data": (
+            [
+                "account_data",
+                page[:count // 2],
+                page[count // 2:],
+                {"7": "Отправитель", "8": "Получатель"},
+                count
+            ],
+            count
+        )
+    }
+
+
+def json_codec(aes: acrypt) -> tuple:
+    """Возвращает функции кодирования и декодирования JSON + base64."""
+    def encode(message) -> bytes:
+        return aes.encrypt(dumps(
+            message,
+            separators=(",", ":"),
+            ensure_ascii=False
+        ))
+
+    def decode(packet: bytes):
+        return loads(aes.decrypt(packet))
+
+    return encode, decode
+
+
+def binary_codec(aes: acrypt) -> tuple:
+    """Возвращает функции кодирования и декодирования двоичного формата."""
+    def encode(message) -> bytes:
+        return wire.BINARY_MAGIC + aes.encrypt_bytes(wire.encode(message))
+
+    def decode(packet: bytes):
+        return wire.decode(aes.decrypt_bytes(packet[1:]))
+
+    return encode, decode
+
+
+def compressed_codec(aes: acrypt, dictionary: bytes = None) -> tuple:
+    """Возвращает функции кодирования и декодирования со сжатием."""
+    def encode(message) -> bytes:
+        data = wire.encode(message)
+
+        if len(data) > wire.COMPRESSION_THRESHOLD:
+            compressed = wire.compress(data, dictionary)
+
+            if len(compressed) < len(data):
+                return wire.COMPRESSED_MAGIC + aes.encrypt_bytes(compressed)
+
+        return wire.BINARY_MAGIC + aes.encrypt_bytes(data)
+
+    def decode(packet: bytes):
+        if wire.is_compressed(packet):
+            return wire.decode(wire.decompress(
+                aes.decrypt_bytes(packet[1:]),
+                dictionary
+            ))
+
+        return wire.decode(aes.decrypt_bytes(packet[1:]))
+
+    return encode, decode
+
+
+def measure(codec: tuple, message, repeat: int) -> dict:
+    """Измеряет размер пакета и время кодирования и декодирования."""
+    encode, decode = codec
+    packet = encode(message)
+    assert decode(packet) == loads(dumps(message))
+
+    started = perf_counter()
+
+    for _ in range(repeat):
+        encode(message)
+
+    encoded = perf_counter() - started
+    started = perf_counter()
+
+    for _ in range(repeat):
+        decode(packet)
+
+    decoded = perf_counter() - started
+
+    return {
+        "bytes": len(packet),
+        "datagrams": -(-len(packet) // FRAGMENT_SIZE),
+        "encode_us": encoded / repeat * 1e6,
+        "decode_us": decoded / repeat * 1e6
+    }
+
+
+def main() -> None:
+    """Основная функция."""
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+    aes = acrypt("0" * 64)
+    codecs = {
+        "json": json_codec(aes),
+        "binary": binary_codec(aes),
+        "zlib": compressed_codec(aes),
+        "zdict": compressed_codec(aes, wire.PRESET_DICTIONARY)
+    }
+
+    for name, (message, count) in samples(args.messages).items():
+        for codec_name, codec in codecs.items():
+            result = measure(codec, message, args.repeat)
+            print(
+                f"{name:13} {codec_name:6}: "
+                f"{result['bytes']:7} байт, "
+                f"{result['bytes'] / count:7.1f} байт/сообщение, "
+                f"датаграмм {result['datagrams']:3}, "
+                f"кодирование {result['encode_us']:8.1f} мкс, "
+                f"декодирование {result['decode_us']:8.1f} мкс"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""Нагрузочный тест сервера с несколькими процессами (--workers).
+
+Для каждого количества процессов сервера запускается сервер и несколько
+процессов нагрузки, каждый из которых держит по --clients клиентов,
+отправляющих быстрые запросы. Измеряется количество ответов в секунду и
+ускорение относительно одного процесса. Ускорение близко к линейному,
+только если у машины хватает ядер и для сервера, и для нагрузки.
+
+Запуск (только Linux):
+    python benchmarks/bench_workers.py --workers 1 2 4 --duration 10
+"""
+from argparse import ArgumentParser
+from multiprocessing import Pool
+from os import cpu_count
+from os import path
+from selectors import EVENT_READ
+from selectors import DefaultSelector
+from subprocess import DEVNULL
+from subprocess import Popen
+from sys import executable
+from sys import path as sys_path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+ROOT = path.dirname(path.dirname(path.realpath(__file__)))
+sys_path.insert(0, ROOT)
+
+from bench_server_modes import BenchClient  # noqa: E402
+from bench_server_modes import wait_server  # noqa: E402
+from server import Database  # noqa: E402
+
+
+def load(addr, clients: int, duration: float) -> int:
+    """Отправляет запросы от clients клиентов в течение duration секунд.
+
+    Возвращаемое значение: Количество полученных ответов.
+    """
+    bench_clients = [
+        BenchClient(addr, ["get_account_data"]) for _ in range(clients)
+    ]
+    selector = DefaultSelector()
+
+    for client in bench_clients:
+        selector.register(client.sock, EVENT_READ, client)
+
+    started = perf_counter()
+
+    while perf_counter() - started < duration:
+        now = perf_counter()
+
+        for client in bench_clients:
+            client.tick(now)
+
+        for key, _ in selector.select(0.05):
+            key.data.on_readable()
+
+    for client in bench_clients:
+        client.sock.close()
+
+    return sum(len(client.latencies) for client in bench_clients)
+
+
+def run_workers(workers: int, args, database: str) -> dict:
+    """Запускает сервер с workers процессами и измеряет его."""
+    addr = ("127.0.0.1", args.port)
+    process = Popen([
+        executable,
+        path.join(ROOT, "server.py"),
+        "--workers", str(workers),
+        "--hash-workers", "0",
+        "--host", addr[0],
+        "--port", str(args.port),
+        "--database", database
+    ], stdout=DEVNULL, stderr=DEVNULL)
+
+    try:
+        wait_server(addr)
+
+        with Pool(args.load_processes) as pool:
+            responses = sum(pool.starmap(load, [
+                (addr, args.clients, args.duration)
+                for _ in range(args.load_processes)
+            ]))
+    finally:
+        process.terminate()
+        process.wait()
+
+    return {
+        "workers": workers,
+        "responses_per_sec": responses / args.duration
+    }
+
+
+def main() -> None:
+    """Основная функция."""
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument(
+        "--load-processes",
+        type=int,
+        default=max(1, (cpu_count() or 2) // 2)
+    )
+    parser.add_argument("--port", type=int, default=17506)
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as directory:
+        database = path.join(directory, "bench.db")
+        dtb = Database(database)
+        dtb.reset_database()
+        dtb.close()
+        baseline = None
+
+        for workers in args.workers:
+            result = run_workers(workers, args, database)
+            baseline = baseline or result["responses_per_sec"]
+            print(
+                f"процессов {workers:2}: "
+                f"{result['responses_per_sec']:9.1f} ответов/с, "
+                f"ускорение {result['responses_per_sec'] / baseline:4.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""Модуль разбиения больших пакетов на фрагменты и их сборки.
+
+Пакет, который помещается в один фрагмент, отправляется без изменений.
+Больший пакет делится на фрагменты с заголовком FRAGMENT_MAGIC, ID
+сообщения, номером фрагмента и количеством фрагментов. Зашифрованные
+пакеты записаны в base64 или начинаются с wire.BINARY_MAGIC, поэтому не
+могут начинаться с FRAGMENT_MAGIC.
+"""
+from collections import OrderedDict
+from itertools import count
+from struct import Struct
+from time import monotonic
+
+FRAGMENT_MAGIC = b"\xfe"
+FRAGMENT_HEADER = Struct("!cIHH")
+# Фрагмент с заголовками IP и UDP помещается в минимальный MTU IPv6 (1280)
+FRAGMENT_SIZE = 1200
+MAX_FRAGMENTS = 0xffff
+REASSEMBLY_TIMEOUT = 5
+REASSEMBLY_BUFFER = 1024 * 1024
+REASSEMBLY_MESSAGES = 64
+# Память на незавершённый пакет без учёта данных фрагментов
+REASSEMBLY_OVERHEAD = 512
+
+
+class Fragmenter:
+    """Разбивает пакеты на фрагменты."""
+
+    def __init__(self, size: int = FRAGMENT_SIZE) -> None:
+        """Инициализация.
+
+        Аргументы:
+            size:   Максимальный размер данных одного фрагмента.
+        """
+        self.size = size
+        self.__ids = count()
+
+    def split(self, data: bytes) -> list:
+        """Разбивает пакет на фрагменты.
+
+        Аргументы:
+            data:   Пакет.
+
+        Возвращаемое значение: Фрагменты или [data], если пакет помещается в
+            один фрагмент.
+        """
+        if len(data) <= self.size:
+            return [data]
+
+        chunks = [
+            data[start:start + self.size]
+            for start in range(0, len(data), self.size)
+        ]
+
+        if len(chunks) > MAX_FRAGMENTS:
+            raise ValueError("Пакет слишком большой")
+
+        message_id = next(self.__ids) & 0xffffffff
+
+        return [
+            FRAGMENT_HEADER.pack(
+                FRAGMENT_MAGIC,
+                message_id,
+                index,
+                len(chunks)
+            ) + chunk
+            for index, chunk in enumerate(chunks)
+        ]
+
+
+class Reassembler:
+    """Собирает пакеты из фрагментов.
+
+    Незавершённые пакеты удаляются через timeout секунд после первого
+    фрагмента или раньше, если их общий размер превышает max_bytes или их
+    больше max_messages. Каждый пакет занимает в буфере REASSEMBLY_OVERHEAD
+    байт сверх размера фрагментов.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = REASSEMBLY_BUFFER,
+        timeout: float = REASSEMBLY_TIMEOUT,
+        max_messages: int = REASSEMBLY_MESSAGES
+    ) -> None:
+        """Инициализация.
+
+        Аргументы:
+            max_bytes:      Максимальный размер незавершённых пакетов.
+            timeout:        Сколько секунд ждать недостающие фрагменты.
+            max_messages:   Максимальное количество незавершённых пакетов.
+        """
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.max_messages = max_messages
+        self.buffered = 0
+        self.__messages = OrderedDict()
+
+    def __len__(self) -> int:
+        """Возвращает количество незавершённых пакетов."""
+        return len(self.__messages)
+
+    def feed(self, packet: bytes, now: float = None):
+        """Обрабатывает полученный пакет или фрагмент.
+
+        Аргументы:
+            packet: Полученные данные.
+            now:    Текущее время (по умолчанию time.monotonic()).
+
+        Возвращаемое значение: Собранный пакет или None, если фрагментов
+            пока не хватает.
+        """
+        if not packet.startswith(FRAGMENT_MAGIC):
+            return packet
+
+        if len(packet) < FRAGMENT_HEADER.size:
+            return None
+
+        if now is None:
+            now = monotonic()
+
+        self.expire(now)
+
+        _, message_id, index, total = FRAGMENT_HEADER.unpack_from(packet)
+        chunk = packet[FRAGMENT_HEADER.size:]
+
+        # Каждый фрагмент содержит данные, поэтому пакет из большего
+        # количества фрагментов не поместится в буфер
+        if not chunk or index >= total or total > MAX_FRAGMENTS or \
+                total > self.max_bytes:
+            return None
+
+        message = self.__messages.get(message_id)
+
+        if message is None:
+            while len(self.__messages) >= self.max_messages:
+                self.__drop(next(iter(self.__messages)))
+
+            message = self.__messages[message_id] = [now, total, {}]
+            self.buffered += REASSEMBLY_OVERHEAD
+        elif message[1] != total:
+            return None
+
+        if index in message[2]:
+            return None
+
+        message[2][index] = chunk
+        self.buffered += len(chunk)
+
+        if len(message[2]) == total:
+            self.__drop(message_id)
+            return b"".join(message[2][i] for i in range(total))
+
+        while self.buffered > self.max_bytes:
+            self.__drop(next(iter(self.__messages)))
+
+        return None
+
+    def expire(self, now: float) -> None:
+        """Удаляет пакеты, недостающие фрагменты которых не пришли вовремя."""
+        while self.__messages:
+            message_id, message = next(iter(self.__messages.items()))
+
+            if now - message[0] < self.timeout:
+                return
+
+            self.__drop(message_id)
+
+    def __drop(self, message_id: int) -> None:
+        """Удаляет незавершённый пакет из буфера."""
+        message = self.__messages.pop(message_id)
+        self.buffered -= REASSEMBLY_OVERHEAD + sum(
+            len(chunk) for chunk in message[2].values()
+        )
@@ -0,0 +1,209 @@
+"""Модуль журнала сервера.
+
+Записи передаются через ограниченную очередь в фоновый поток, который
+пишет их в stderr или файл. Если поток не успевает (медленный терминал или
+диск), новые записи отбрасываются, а не замедляют обработку пакетов.
+Количество отброшенных записей доступно в метрике log.dropped.
+"""
+from logging import DEBUG
+from logging import FileHandler
+from logging import Formatter
+from logging import NOTSET
+from logging import StreamHandler
+from logging import getLogger
+from logging.handlers import QueueHandler
+from logging.handlers import QueueListener
+from queue import Full
+from queue import Queue
+from threading import Lock
+
+from metrics import metrics
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(processName)s %(message)s"
+LOG_QUEUE_SIZE = 10000
+# Доля записываемых пакетов на уровне DEBUG
+PACKET_SAMPLE_RATE = 0.01
+# Сколько символов содержимого пакета попадает в журнал
+PAYLOAD_LIMIT = 64
+# Аргументы этих команд не записываются в журнал
+SECRET_COMMANDS = ("login", "register")
+
+logger = getLogger("messenger")
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler, отбрасывающий записи при заполненной очереди."""
+
+    def prepare(self, record):
+        """Форматирует запись до передачи в очередь.
+
+        В отличие от QueueHandler.prepare(), не копирует запись, так как
+        она не используется после передачи.
+        """
+        record.msg = self.format(record)
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+        return record
+
+    def enqueue(self, record) -> None:
+        """Добавляет запись в очередь без ожидания."""
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            metrics.inc("log.dropped")
+
+
+class LogListener(QueueListener):
+    """Фоновый поток, записывающий записи из очереди."""
+
+    def enqueue_sentinel(self) -> None:
+        """Ждёт места в заполненной очереди, чтобы не потерять остановку."""
+        self.queue.put(self._sentinel)
+
+
+class PacketSampler:
+    """Пропускает долю rate пакетов для записи в журнал.
+
+    Выбирается каждый round(1 / rate)-й пакет, поэтому решение не требует
+    генерации случайных чисел.
+    """
+
+    def __init__(self, rate: float = PACKET_SAMPLE_RATE) -> None:
+        """Инициализация.
+
+        Аргументы:
+            rate:   Доля пакетов от 0 до 1.
+        """
+        self.__every = round(1 / rate) if rate > 0 else 0
+        self.__count = 0
+        self.__lock = Lock()
+
+    def __call__(self) -> bool:
+        """Нужно ли записать текущий пакет."""
+        if self.__every == 0:
+            return False
+
+        with self.__lock:
+            self.__count += 1
+
+            if self.__count < self.__every:
+                return False
+
+            self.__count = 0
+            return True
+
+
+class Payload:
+    """Сокращённое представление пакета или команды для журнала.
+
+    Строка формируется только при записи, поэтому отброшенные уровнем
+    записи не тратят время на форматирование.
+    """
+
+    __slots__ = ("data",)
+
+    def __init__(self, data) -> None:
+        """Инициализация.
+
+        Аргументы:
+            data:   Пакет (bytes) или команда клиента (list).
+        """
+        self.data = data
+
+    def __str__(self) -> str:
+        """Возвращает сокращённое представление."""
+        return redact(self.data)
+
+
+def redact(data, limit: int = PAYLOAD_LIMIT) -> str:
+    """Сокращает пакет или команду для записи в журнал.
+
+    Из пакетов записывается только размер, так как они могут содержать
+    ключи шифрования. Аргументы команд входа и регистрации скрываются,
+    остальные обрезаются до limit символов.
+
+    Аргументы:
+        data:   Пакет (bytes) или команда клиента (list).
+        limit:  Максимальная длина аргументов.
+
+    Возвращаемое значение: Строка для журнала.
+    """
+    if isinstance(data, (bytes, bytearray)):
+        return f"<{len(data)} байт>"
+
+    if not isinstance(data, list) or len(data) == 0:
+        return f"<{type(data).__name__}>"
+
+    command = str(data[0])[:limit]
+
+    if command in SECRET_COMMANDS:
+        return f"{command} <скрыто>"
+
+    arguments = repr(data[1:])
+
+    if len(arguments) > limit:
+        arguments = f"{arguments[:limit]}... ({len(arguments)} символов)"
+
+    return f"{command} {arguments}"
+
+
+def setup(
+    level: str = "INFO",
+    filepath: str = None,
+    queue_size: int = LOG_QUEUE_SIZE
+) -> QueueListener:
+    """Настраивает журнал и запускает фоновый поток записи.
+
+    Аргументы:
+        level:      Уровень журнала (DEBUG, INFO, WARNING, ERROR).
+        filepath:   Файл журнала или None для stderr.
+        queue_size: Максимальное количество ожидающих записи записей.
+
+    Возвращаемое значение: Поток записи, который нужно остановить через
+        shutdown().
+    """
+    target = StreamHandler() if filepath is None else \
+        FileHandler(filepath, encoding="utf8")
+    target.setFormatter(Formatter(LOG_FORMAT))
+    records = Queue(queue_size)
+    handler = DroppingQueueHandler(records)
+
+    for old_handler in logger.handlers[:]:
+        logger.removeHandler(old_handler)
+
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
+    listener = LogListener(records, target)
+    listener.start()
+    return listener
+
+
+def shutdown(listener: QueueListener) -> None:
+    """Записывает оставшиеся записи и останавливает поток записи.
+
+    Журнал возвращается к настройкам по умолчанию.
+    """
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+
+    logger.setLevel(NOTSET)
+    logger.propagate = True
+
+    listener.stop()
+
+    for handler in listener.handlers:
+        handler.close()
+
+
+def trace(sampler: PacketSampler, message: str, data) -> None:
+    """Записывает выбранный sampler пакет на уровне DEBUG.
+
+    Аргументы:
+        sampler:    Выборка пакетов.
+        message:    Описание пакета.
+        data:       Пакет или команда клиента.
+    """
+    if logger.isEnabledFor(DEBUG) and sampler():
+        logger.debug("%s: %s", message, Payload(data))
@@ -12,11 +12,20 @@ from os import system
 from socket import AF_INET
 from socket import SOCK_DGRAM
 from socket import socket
+from collections import deque
+from threading import Lock
 from threading import Thread
+from time import monotonic
 from time import sleep
 from tkinter import ttk
 
 from aes_crypto import acrypt
+from aes_crypto import agcm
+from framing import Fragmenter
+from framing import Reassembler
+from reliable import ReliableChannel
+from reliable import is_reliable
+import wire
 
 KEY_EXTRA = "LX@$wmd3l8Yt9zxj9WH8yp@DOzNrDk2^flJzzNU!%oYy3EUoXabyGF~k%5TiJBH*"
 KEY_LOGIN_FILE = "rW9M8%KphnA*Jt1rCNG*8ANo51$h*8TRI&c@mPnD)8$*EMUzxq0Kr(B5M~qd\
@@ -106,7 +115,12 @@ class MessengerClient:
     FRAME_BG_COLOR = "#333"
     PANEL_BACKGROUND = "#222"
     _RECEIVE_SLEEP_TIME = 1 / 60
+    _CONVERSATION_PAGE = 50
     _IDLE_SLEEP_TIME = 1 / 3
+    _REASSEMBLY_BUFFER = 64 * 1024 * 1024
+    _RELIABLE_DELIVERY = True
+    _RETRANSMIT_SLEEP_TIME = 0.05
+    _CAPABILITIES = (wire.BINARY, wire.GCM, wire.ZLIB, wire.ZDICT)
 
     def __init__(self) -> None:
         """Инициализация класса."""
@@ -116,6 +130,9 @@ class MessengerClient:
         self._sock.connect(("127.0.0.1", 7505))
         self.__sended: list = []
         self.__received: list = []
+        self.__sync_version: int = 0
+        self.__conversations: dict = {}
+        self.__read_marks: dict = {}
         self._logins: dict = {}
         self._userid_selected: int = -1
         self.last_height: int = -1
@@ -123,6 +140,12 @@ class MessengerClient:
         self.__temp_messages: list = []
         self.__key = None
         self.__aes = None
+        self.__binary_aes = None
+        self.__fragmenter = Fragmenter()
+        self.__reassembler = Reassembler(self._REASSEMBLY_BUFFER)
+        self.__channel = None
+        self.__capabilities = ()
+        self.__send_lock = Lock()
         self.destroyed = False
         self.__queued_requests = []
         self.__last_login = None
@@ -130,11 +153,12 @@ class MessengerClient:
 
         Thread(target=self.receive, daemon=True).start()
         Thread(target=self.send_idle, daemon=True).start()
+        Thread(target=self.retransmit, daemon=True).start()
 
         self.main()
 
         if not self.destroyed:
-            self._sock.send(b"\x05\x03\xff\x01")
+            self._sock.send(wire.handshake(self._CAPABILITIES))
 
     @staticmethod
     def show_error(title: str, message: str) -> None:
@@ -161,10 +185,23 @@ class MessengerClient:
     def __encode_message(self, message) -> bytes:
         """Превращает объекты, преобразоваемые в JSON в байты."""
         if self.__key is None and not self.destroyed:
-            self._sock.send(b"\x05\x03\xff\x01")
+            self._sock.send(wire.handshake(self._CAPABILITIES))
             self.__queued_requests.append(message)
             return None
 
+        if wire.BINARY in self.__capabilities:
+            data = wire.encode(message)
+
+            if wire.ZLIB in self.__capabilities and \
+                    len(data) > wire.COMPRESSION_THRESHOLD:
+                compressed = wire.compress(data, self.__dictionary())
+
+                if len(compressed) < len(data):
+                    return wire.COMPRESSED_MAGIC + \
+                        self.__binary_aes.encrypt_bytes(compressed)
+
+            return wire.BINARY_MAGIC + self.__binary_aes.encrypt_bytes(data)
+
         return self.__aes.encrypt(dumps(
             message,
             separators=(",", ":"),
@@ -174,16 +211,46 @@ class MessengerClient:
     def __decode_message(self, message: bytes):
         """Превращает байты в объекты, преобразоваемые в JSON."""
         if self.__key is None:
-            self.__key = message.decode("ascii")
+            self.__key, self.__capabilities = wire.parse_handshake_reply(
+                message
+            )
             self.__aes = acrypt(KEY_EXTRA + self.__key)
+            self.__binary_aes = agcm(KEY_EXTRA + self.__key, agcm.CLIENT) \
+                if wire.GCM in self.__capabilities else self.__aes
+
+            # Номера пакетов надёжной доставки начинаются заново для
+            # каждого ключа, который выдал сервер
+            if self._RELIABLE_DELIVERY:
+                self.__channel = ReliableChannel()
 
             for req in self.__queued_requests:
                 self.send(req)
 
             return False
 
+        if wire.is_compressed(message):
+            return wire.decode(wire.decompress(
+                self.__binary_aes.decrypt_bytes(
+                    message[len(wire.COMPRESSED_MAGIC):]
+                ),
+                self.__dictionary(),
+                self._REASSEMBLY_BUFFER
+            ))
+
+        if wire.is_binary(message):
+            return wire.decode(self.__binary_aes.decrypt_bytes(
+                message[len(wire.BINARY_MAGIC):]
+            ))
+
         return loads(self.__aes.decrypt(message))
 
+    def __dictionary(self):
+        """Возвращает словарь сжатия, если он согласован с сервером."""
+        if wire.ZDICT in self.__capabilities:
+            return wire.PRESET_DICTIONARY
+
+        return None
+
     def send(self, message) -> None:
         """Отправляет сообщение message на сервер.
 
@@ -192,8 +259,49 @@ class MessengerClient:
         """
         msg = self.__encode_message(message)
 
-        if msg is not None:
-            self._sock.send(msg)
+        if msg is None:
+            return
+
+        packets = self.__fragmenter.split(msg)
+
+        if self.__channel is not None:
+            now = monotonic()
+            packets = [
+                packet
+                for fragment in packets
+                for packet in self.__channel.send(fragment, now)
+            ]
+
+        self.__transmit(packets)
+
+    def __transmit(self, packets: list) -> None:
+        """Отправляет готовые пакеты на сервер."""
+        with self.__send_lock:
+            for packet in packets:
+                self._sock.send(packet)
+
+    def __unwrap(self, jdata: bytes) -> list:
+        """Обрабатывает пакет надёжной доставки.
+
+        Аргументы:
+            jdata:  Полученный пакет.
+
+        Возвращаемое значение: Данные, доставленные по порядку.
+        """
+        if self.__channel is None or not is_reliable(jdata):
+            return [jdata]
+
+        payloads, replies = self.__channel.receive(jdata, monotonic())
+        self.__transmit(replies)
+        return payloads
+
+    def retransmit(self) -> None:
+        """Повторно отправляет пакеты, подтверждение которых не пришло."""
+        while True:
+            if self.__channel is not None:
+                self.__transmit(self.__channel.poll(monotonic()))
+
+            sleep(self._RETRANSMIT_SLEEP_TIME)
 
     def send_register(self, login, password):
         """Присылает сообщение регистрации на сервер."""
@@ -239,13 +347,62 @@ class MessengerClient:
         """Выходит из аккаунта."""
         system(f'rm {absolute(".logindata")}')
         self.__aes = None
+        self.__binary_aes = None
         self.__key = None
         self._is_on_main_tab = False
         self._logins = {}
         self.__sended = []
         self.__received = []
+        self.__sync_version = 0
+        self.__conversations = {}
         self.login_tab()
 
+    @staticmethod
+    def merge_messages(messages: list, changes: list) -> list:
+        """Объединяет известные сообщения с изменёнными.
+
+        Аргументы:
+            messages:   Известные сообщения.
+            changes:    Новые и изменённые сообщения.
+
+        Возвращаемое значение: Сообщения, отсортированные по ID.
+        """
+        if len(changes) == 0:
+            return messages
+
+        by_id = {message[0]: message for message in messages}
+
+        for message in changes:
+            by_id[message[0]] = message
+
+        return sorted(by_id.values(), key=lambda message: message[0])
+
+    @staticmethod
+    def set_status(
+        messages: list,
+        peer_id: int,
+        status: int,
+        up_to_id: int = None
+    ) -> list:
+        """Повышает статус сообщений, отправленных пользователю.
+
+        Аргументы:
+            messages:   Сообщения.
+            peer_id:    ID получателя.
+            status:     Новый статус (1 - получено, 2 - прочитано).
+            up_to_id:   Изменить статус только у сообщений с ID не больше
+                            этого. Если None, у всех сообщений.
+
+        Возвращаемое значение: Сообщения с обновлёнными статусами.
+        """
+        return [
+            list(message[:4]) + [status]
+            if message[3] == peer_id and message[4] < status and (
+                up_to_id is None or message[0] <= up_to_id
+            ) else message
+            for message in messages
+        ]
+
     @staticmethod
     def create_round_rectangle(
         cnv,
@@ -320,21 +477,13 @@ class MessengerClient:
 
         self._userid_selected = user_id
 
-        messages = []
-
-        for smsg in self.__sended:
-            if smsg[3] != self._userid_selected:
-                continue
-
-            messages.append(smsg)
-
-        for rmsg in self.__received:
-            if rmsg[1] != self._userid_selected:
-                continue
-
-            messages.append(rmsg)
+        conversation = self.__conversations.get(user_id)
 
-        messages.sort(key=lambda message: message[0])
+        if conversation is None:
+            self.load_conversation(user_id)
+            messages = []
+        else:
+            messages = conversation["messages"]
 
         cnv = self.win.messages
         cwh = cnv.winfo_width()
@@ -461,6 +610,213 @@ class MessengerClient:
             offset += diff
 
         cnv.configure(scrollregion=cnv.bbox("all"))
+        self.mark_read(user_id, messages)
+
+    def mark_read(self, user_id: int, messages: list) -> None:
+        """Сообщает серверу, что показанные сообщения собеседника прочитаны.
+
+        Аргументы:
+            user_id:    ID собеседника.
+            messages:   Показанные сообщения переписки.
+        """
+        read_id = max(
+            (message[0] for message in messages if message[1] == user_id),
+            default=0
+        )
+
+        if read_id > self.__read_marks.get(user_id, 0):
+            self.__read_marks[user_id] = read_id
+            self.send(["mark_read", user_id, read_id])
+
+    def load_conversation(self, user_id: int, before_id=None) -> None:
+        """Запрашивает страницу переписки с сервера.
+
+        Аргументы:
+            user_id:    ID собеседника.
+            before_id:  ID самого старого загруженного сообщения или None для
+                            самых новых сообщений.
+        """
+        conversation = self.__conversations.setdefault(user_id, {
+            "messages": [],
+            "has_more": False,
+            "loading": False
+        })
+
+        if conversation["loading"]:
+            return
+
+        conversation["loading"] = True
+        self.send([
+            "get_conversation",
+            user_id,
+            before_id,
+            self._CONVERSATION_PAGE
+        ])
+
+    def conversation_loaded(self, user_id: int, before_id, page) -> None:
+        """Обработчик страницы переписки от сервера.
+
+        Аргументы:
+            user_id:    ID собеседника.
+            before_id:  before_id из запроса.
+            page:       Сообщения и есть ли более старые сообщения.
+        """
+        conversation = self.__conversations.get(user_id)
+
+        if conversation is None or page is False:
+            return
+
+        conversation["messages"] = self.merge_messages(
+            conversation["messages"],
+            page[0]
+        )
+        conversation["has_more"] = page[1]
+        conversation["loading"] = False
+
+        if user_id != self._userid_selected:
+            return
+
+        try:
+            cnv = self.win.messages
+        except KeyError:
+            return
+
+        old_bbox = cnv.bbox("all")
+        self.redraw_messages()
+
+        if before_id is not None and old_bbox is not None:
+            new_bbox = cnv.bbox("all")
+            added = (new_bbox[3] - new_bbox[1]) - (old_bbox[3] - old_bbox[1])
+            cnv.yview_moveto(added / max(1, new_bbox[3] - new_bbox[1]))
+
+    def merge_conversations(self, sended: list, received: list) -> None:
+        """Добавляет изменённые сообщения в загруженные переписки.
+
+        Аргументы:
+            sended:     Изменённые отправленные сообщения.
+            received:   Изменённые полученные сообщения.
+        """
+        changes = {}
+
+        for smsg in sended:
+            changes.setdefault(smsg[3], []).append(smsg)
+
+        for rmsg in received:
+            changes.setdefault(rmsg[1], []).append(rmsg)
+
+        for user_id, messages in changes.items():
+            conversation = self.__conversations.get(user_id)
+
+            if conversation is not None:
+                conversation["messages"] = self.merge_messages(
+                    conversation["messages"],
+                    messages
+                )
+
+    def status_changed(
+        self,
+        peer_id: int,
+        status: int,
+        up_to_id: int = None
+    ) -> None:
+        """Обработчик изменения статуса отправленных сообщений.
+
+        Аргументы:
+            peer_id:    ID получателя сообщений.
+            status:     Новый статус.
+            up_to_id:   ID последнего сообщения с новым статусом или None.
+        """
+        self.__sended = self.set_status(
+            self.__sended,
+            peer_id,
+            status,
+            up_to_id
+        )
+        conversation = self.__conversations.get(peer_id)
+
+        if conversation is not None:
+            conversation["messages"] = self.set_status(
+                conversation["messages"],
+                peer_id,
+                status,
+                up_to_id
+            )
+
+    def message_pushed(self, message: list, logins: dict) -> None:
+        """Обработчик нового сообщения от другого пользователя.
+
+        Аргументы:
+            message:    Сообщение.
+            logins:     Логин отправителя по его ID.
+        """
+        self.__received = self.merge_messages(self.__received, [message])
+        # Отвечая, собеседник прочитал все отправленные ему сообщения
+        self.status_changed(message[1], 2)
+        self.merge_conversations([], [message])
+
+        new_logins = {
+            user_id: login
+            for user_id, login in logins.items()
+            if user_id not in self._logins
+        }
+        self._logins.update(logins)
+
+        if self._is_on_main_tab:
+            for login in new_logins.values():
+                self.win.userlist.insert(tk.END, f" {login}")
+
+        self.redraw_messages()
+
+    def message_acknowledged(self, message) -> None:
+        """Обработчик подтверждения отправки сообщения.
+
+        Аргументы:
+            message:    Сохранённое сообщение или False, если сообщение не
+                            удалось отправить.
+        """
+        if self.__temp_messages:
+            self.__temp_messages.pop(0)
+
+        if message:
+            self.__sended = self.merge_messages(self.__sended, [message])
+            self.merge_conversations([message], [])
+
+        self.redraw_messages()
+
+    def messages_scrolled(self, scrollbar, first, last) -> None:
+        """Обработчик прокрутки переписки.
+
+        Загружает более старые сообщения, когда переписка прокручена до
+        самого верха.
+
+        Аргументы:
+            scrollbar:  Полоса прокрутки переписки.
+            first:      Верхняя видимая доля переписки.
+            last:       Нижняя видимая доля переписки.
+        """
+        scrollbar.set(first, last)
+
+        if float(first) > 0:
+            return
+
+        conversation = self.__conversations.get(self._userid_selected)
+
+        if conversation is None or not conversation["has_more"]:
+            return
+
+        if len(conversation["messages"]) > 0:
+            self.load_conversation(
+                self._userid_selected,
+                conversation["messages"][0][0]
+            )
+
+    def redraw_messages(self) -> None:
+        """Перерисовывает переписку с выбранным пользователем."""
+        if self._userid_selected == -1:
+            return
+
+        self._userid_selected = -1
+        self.user_selected()
 
     def resize(self, event) -> None:
         """Обработчик изменения размера окна."""
@@ -527,15 +883,27 @@ class MessengerClient:
 
     def receive(self) -> None:
         """Получает сообщения от сервера."""
+        incoming = deque()
+
         while True:
-            try:
-                jdata = self._sock.recv(70000)
-            except ConnectionResetError:
-                self.login_tab()
-                self.show_error(
-                    "Сервер отключён",
-                    "Сервер принудительно разорвал подключение"
-                )
+            if len(incoming) == 0:
+                try:
+                    jdata = self._sock.recv(70000)
+                except ConnectionResetError:
+                    self.login_tab()
+                    self.show_error(
+                        "Сервер отключён",
+                        "Сервер принудительно разорвал подключение"
+                    )
+                    continue
+
+                incoming.extend(self.__unwrap(jdata))
+                continue
+
+            jdata = self.__reassembler.feed(incoming.popleft())
+
+            if jdata is None:
+                continue
 
             data = self.__decode_message(jdata)
 
@@ -549,7 +917,7 @@ class MessengerClient:
 
                 if status == 0:
                     self.remember_login()
-                    self.send(["get_account_data"])
+                    self.send(["sync", self.__sync_version, False])
                 elif status == 1:
                     self.show_error(
                         "Неверный логин",
@@ -570,12 +938,17 @@ class MessengerClient:
                         "Неверный логин",
                         "Аккаунт с указанным логином уже существует"
                     )
+                elif status == 5:
+                    self.show_error(
+                        "Ошибка сервера",
+                        "Не удалось создать аккаунт, попробуйте ещё раз"
+                    )
             elif com == "login_status":
                 status = data[1]
 
                 if status == 0:
                     self.remember_login()
-                    self.send(["get_account_data"])
+                    self.send(["sync", self.__sync_version, False])
                 elif status == 1:
                     self.show_error(
                         "Неверный логин",
@@ -601,14 +974,47 @@ class MessengerClient:
                         "Неверный пароль",
                         "Пароль от аккаунта не подходит"
                     )
+                elif status == 6:
+                    self.show_error(
+                        "Ошибка сервера",
+                        "Не удалось войти в аккаунт, попробуйте ещё раз"
+                    )
 
                 if status != 0:
                     self.login_tab()
-            elif com == "account_data":
-                adata = data[1]
-                self.__sended = adata[0]
-                self.__received = adata[1]
-                self._logins = adata[2]
+            elif com in ["account_data", "sync_data"]:
+                if com == "account_data":
+                    adata = data[1]
+                    self.__sended = adata[0]
+                    self.__received = adata[1]
+                    self._logins = adata[2]
+                elif data[1]:
+                    adata = data[3]
+                    self.__sync_version = data[2]
+                    self.__sended = adata[0]
+                    self.__received = adata[1]
+                    self._logins = adata[2]
+                    self.__conversations = {}
+                else:
+                    adata = data[3]
+                    self.__sync_version = data[2]
+                    self.__sended = self.merge_messages(
+                        self.__sended,
+                        adata[0]
+                    )
+                    self.__received = self.merge_messages(
+                        self.__received,
+                        adata[1]
+                    )
+                    self._logins.update(adata[2])
+                    self.merge_conversations(adata[0], adata[1])
+
+                    # Изменённые границы получения и прочтения
+                    receipts = adata[3] if len(adata) > 3 else []
+
+                    for peer_id, delivered_id, read_id in receipts:
+                        self.status_changed(peer_id, 1, delivered_id)
+                        self.status_changed(peer_id, 2, read_id)
 
                 main_tab = self._is_on_main_tab
 
@@ -665,7 +1071,10 @@ class MessengerClient:
                         h=-60
                     )
                     cnv_sbar.configure(command=cnv.yview)
-                    cnv.configure(yscrollcommand=cnv_sbar.set)
+                    cnv.configure(
+                        yscrollcommand=lambda first, last: self.
+                        messages_scrolled(cnv_sbar, first, last)
+                    )
                     self.win.place(
                         "messages",
                         cnv,
@@ -766,7 +1175,8 @@ class MessengerClient:
                     listbox.delete(0, tk.END)
 
                     for i, temp_msg in enumerate(self.__temp_messages):
-                        if temp_msg[0] == self.__sended[-1][2]:
+                        if self.__sended and \
+                                temp_msg[0] == self.__sended[-1][2]:
                             self.__temp_messages = self.__temp_messages[i + 1:]
                             break
 
@@ -784,6 +1194,15 @@ class MessengerClient:
                     listbox.select_set(0)
 
                 listbox.event_generate("<<ListboxSelect>>")
+            elif com == "conversation":
+                self.conversation_loaded(data[1], data[2], data[3])
+            elif com == "message_ack":
+                self.message_acknowledged(data[1])
+            elif com == "new_message":
+                self.message_pushed(data[1], data[2])
+            elif com == "message_status":
+                self.status_changed(*data[1:4])
+                self.redraw_messages()
             elif com == "find_user_result":
                 self.win.add_user_name.delete(0, tk.END)
 
@@ -829,12 +1248,16 @@ class MessengerClient:
         """Перемещает на начальную вкладку."""
         self.__sended = []
         self.__received = []
+        self.__sync_version = 0
+        self.__conversations = {}
+        self.__read_marks = {}
         self._logins = {}
         self._userid_selected = -1
         self._is_on_main_tab = False
         self.__temp_messages = []
         self.__key = None
         self.__aes = None
+        self.__binary_aes = None
 
         if clear:
             self.win.clear()
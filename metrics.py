@@ -0,0 +1,359 @@
+"""Модуль метрик сервера.
+
+Снимок метрик можно получить через UNIX сокет MetricsReporter:
+    python metrics.py путь_к_сокету
+
+Через этот же сокет выполняются команды сервера, например:
+    python metrics.py путь_к_сокету profile command.send_message 50
+"""
+from contextlib import contextmanager
+from json import dumps
+from json import loads
+from math import frexp
+from os import path
+from os import replace
+from os import unlink
+from socket import SHUT_WR
+from socket import socket
+from socket import timeout as SocketTimeout
+from sys import argv
+from threading import Event
+from threading import Lock
+from threading import Thread
+from time import perf_counter
+
+try:
+    from socket import AF_UNIX
+except ImportError:
+    # На Windows нет UNIX сокетов, доступна только запись в файл
+    AF_UNIX = None
+
+METRICS_INTERVAL = 10
+
+
+class Histogram:
+    """Гистограмма задержек с логарифмическими корзинами.
+
+    Каждая степень двойки делится на SUB_BUCKETS корзин, поэтому
+    относительная погрешность перцентилей не превышает 1 / SUB_BUCKETS.
+    """
+
+    SUB_BUCKETS = 16
+
+    def __init__(self) -> None:
+        """Инициализация гистограммы."""
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.__buckets = {}
+
+    def __bucket(self, value: float) -> int:
+        """Возвращает номер корзины для значения value."""
+        if value <= 0:
+            return -1 << 20
+
+        mantissa, exponent = frexp(value)
+        return exponent * self.SUB_BUCKETS + int(
+            (mantissa * 2 - 1) * self.SUB_BUCKETS
+        )
+
+    def __bucket_value(self, bucket: int) -> float:
+        """Возвращает верхнюю границу корзины."""
+        if bucket == -1 << 20:
+            return 0.0
+
+        exponent, sub = divmod(bucket, self.SUB_BUCKETS)
+        return (1 + (sub + 1) / self.SUB_BUCKETS) * 2.0 ** (exponent - 1)
+
+    def record(self, value: float) -> None:
+        """Записывает значение.
+
+        Аргументы:
+            value:  Значение (для задержек - в секундах).
+        """
+        bucket = self.__bucket(value)
+        self.__buckets[bucket] = self.__buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, part: float) -> float:
+        """Возвращает перцентиль.
+
+        Аргументы:
+            part:   Доля от 0 до 1.
+
+        Возвращаемое значение: Верхняя граница корзины перцентиля.
+        """
+        if self.count == 0:
+            return 0.0
+
+        rank = part * self.count
+        seen = 0
+
+        for bucket in sorted(self.__buckets):
+            seen += self.__buckets[bucket]
+
+            if seen >= rank:
+                return min(self.__bucket_value(bucket), self.max)
+
+        return self.max
+
+    def snapshot(self) -> dict:
+        """Возвращает сводку гистограммы в миллисекундах."""
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count * 1000 if self.count else 0.0,
+            "p50_ms": self.percentile(0.5) * 1000,
+            "p99_ms": self.percentile(0.99) * 1000,
+            "max_ms": self.max * 1000
+        }
+
+
+class Metrics:
+    """Реестр счётчиков, гистограмм и измеряемых значений."""
+
+    def __init__(self) -> None:
+        """Инициализация реестра."""
+        self.__lock = Lock()
+        self.__counters = {}
+        self.__histograms = {}
+        self.__gauges = {}
+
+    def inc(self, name: str, value: int = 1) -> None:
+        """Увеличивает счётчик name на value."""
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + value
+
+    def observe(self, name: str, value: float) -> None:
+        """Записывает значение value в гистограмму name."""
+        with self.__lock:
+            histogram = self.__histograms.get(name)
+
+            if histogram is None:
+                histogram = self.__histograms[name] = Histogram()
+
+            histogram.record(value)
+
+    @contextmanager
+    def timer(self, name: str):
+        """Записывает время выполнения блока with в гистограмму name."""
+        started = perf_counter()
+
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - started)
+
+    def counter(self, name: str) -> int:
+        """Возвращает значение счётчика name."""
+        with self.__lock:
+            return self.__counters.get(name, 0)
+
+    def gauge(self, name: str, func) -> None:
+        """Регистрирует значение, вычисляемое функцией func при снимке."""
+        self.__gauges[name] = func
+
+    def snapshot(self) -> dict:
+        """Возвращает текущие значения всех метрик."""
+        with self.__lock:
+            counters = dict(self.__counters)
+            histograms = {
+                name: histogram.snapshot()
+                for name, histogram in self.__histograms.items()
+            }
+
+        # Значения вычисляются без блокировки, поэтому могут читать счётчики
+        return {
+            "counters": counters,
+            "gauges": {
+                name: func() for name, func in list(self.__gauges.items())
+            },
+            "histograms": histograms
+        }
+
+
+class MetricsReporter:
+    """Отдаёт снимки метрик через UNIX сокет и периодически пишет их в файл.
+
+    Каждое подключение к сокету получает один снимок в JSON, после чего
+    соединение закрывается. Если клиент отправил строку запроса, вместо
+    снимка выполняется зарегистрированная команда с аргументами из этой
+    строки, и клиент получает её результат в JSON. Файл перезаписывается
+    целиком, поэтому читатель никогда не видит его наполовину записанным.
+    """
+
+    def __init__(
+        self,
+        registry: Metrics,
+        socket_path: str = None,
+        filepath: str = None,
+        interval: float = METRICS_INTERVAL,
+        commands: dict = None
+    ) -> None:
+        """Инициализация.
+
+        Аргументы:
+            registry:       Реестр метрик.
+            socket_path:    Путь к UNIX сокету или None.
+            filepath:       Файл для снимков или None.
+            interval:       Период записи файла в секундах.
+            commands:       Команды сокета {название: функция} или None.
+        """
+        self.__registry = registry
+        self.__socket_path = socket_path
+        self.__filepath = filepath
+        self.__interval = interval
+        self.__commands = commands or {}
+        self.__stopped = Event()
+        self.__threads = []
+        self.__sock = None
+
+    def snapshot(self) -> bytes:
+        """Возвращает снимок метрик в JSON."""
+        return dumps(
+            self.__registry.snapshot(),
+            ensure_ascii=False,
+            sort_keys=True
+        ).encode("utf8")
+
+    def execute(self, request: str) -> bytes:
+        """Выполняет команду сокета.
+
+        Аргументы:
+            request:    Название команды и аргументы через пробел.
+
+        Возвращаемое значение: Результат команды в JSON.
+        """
+        name, *args = request.split()
+        func = self.__commands.get(name)
+
+        if func is None:
+            result = {"error": f"Неизвестная команда: {name}"}
+        else:
+            try:
+                result = func(*args)
+            except (TypeError, ValueError) as exc:
+                result = {"error": str(exc)}
+
+        return dumps(result, ensure_ascii=False).encode("utf8")
+
+    def dump(self) -> None:
+        """Записывает снимок метрик в файл."""
+        temporary = f"{self.__filepath}.tmp"
+
+        with open(temporary, "wb") as file:
+            file.write(self.snapshot() + b"\n")
+
+        replace(temporary, self.__filepath)
+
+    def start(self) -> None:
+        """Запускает потоки сокета и записи файла."""
+        if self.__socket_path is not None:
+            if path.exists(self.__socket_path):
+                unlink(self.__socket_path)
+
+            self.__sock = socket(AF_UNIX)
+            self.__sock.bind(self.__socket_path)
+            self.__sock.listen()
+            self.__sock.settimeout(0.5)
+            self.__threads.append(Thread(target=self.__serve, daemon=True))
+
+        if self.__filepath is not None:
+            self.__threads.append(Thread(target=self.__dump, daemon=True))
+
+        for thread in self.__threads:
+            thread.start()
+
+    def __serve(self) -> None:
+        """Отвечает снимком на каждое подключение к сокету."""
+        while not self.__stopped.is_set():
+            try:
+                connection = self.__sock.accept()[0]
+            except SocketTimeout:
+                continue
+            except OSError:
+                return
+
+            with connection:
+                connection.settimeout(0.5)
+
+                try:
+                    request = self.__receive(connection)
+                except (SocketTimeout, UnicodeDecodeError):
+                    request = ""
+
+                if request.strip():
+                    connection.sendall(self.execute(request))
+                else:
+                    connection.sendall(self.snapshot())
+
+    @staticmethod
+    def __receive(connection: socket) -> str:
+        """Читает строку запроса до закрытия записи клиентом."""
+        chunks = []
+
+        while True:
+            chunk = connection.recv(4096)
+
+            if not chunk:
+                return b"".join(chunks).decode("utf8")
+
+            chunks.append(chunk)
+
+    def __dump(self) -> None:
+        """Записывает снимки в файл раз в interval секунд."""
+        while not self.__stopped.wait(self.__interval):
+            self.dump()
+
+    def close(self) -> None:
+        """Останавливает потоки и записывает последний снимок."""
+        self.__stopped.set()
+
+        for thread in self.__threads:
+            thread.join()
+
+        if self.__sock is not None:
+            self.__sock.close()
+            unlink(self.__socket_path)
+
+        if self.__filepath is not None:
+            self.dump()
+
+
+def fetch(socket_path: str, request: str = "") -> dict:
+    """Получает снимок метрик через UNIX сокет MetricsReporter.
+
+    Аргументы:
+        socket_path:    Путь к сокету.
+        request:        Команда с аргументами или "" для снимка.
+
+    Возвращаемое значение: Снимок метрик или результат команды.
+    """
+    chunks = []
+
+    with socket(AF_UNIX) as sock:
+        sock.connect(socket_path)
+        sock.sendall(request.encode("utf8"))
+        sock.shutdown(SHUT_WR)
+
+        while True:
+            chunk = sock.recv(65536)
+
+            if not chunk:
+                break
+
+            chunks.append(chunk)
+
+    return loads(b"".join(chunks))
+
+
+metrics = Metrics()
+
+
+if __name__ == "__main__":
+    print(dumps(
+        fetch(argv[1], " ".join(argv[2:])),
+        ensure_ascii=False,
+        indent=2
+    ))
@@ -0,0 +1,307 @@
+"""Модуль надёжной доставки пакетов поверх UDP.
+
+Каждый пакет данных получает номер. Получатель отвечает подтверждением с
+номером следующего ожидаемого пакета и диапазонами пакетов, полученных не
+по порядку. Отправитель держит не больше window неподтверждённых пакетов и
+повторяет пакет, если подтверждение не пришло за время RTO (RFC 6298) или
+если подтверждены DUPLICATE_THRESHOLD более поздних пакетов.
+
+Номера пакетов относятся к сессии отправителя: получатель, увидев новую
+сессию (например, после перезапуска собеседника), начинает приём заново.
+"""
+from collections import OrderedDict
+from collections import deque
+from random import randrange
+from struct import Struct
+from threading import Lock
+
+RELIABLE_MAGIC = b"\xfd"
+RELIABLE_HEADER = Struct("!cBII")
+SACK_COUNT = Struct("!B")
+SACK_RANGE = Struct("!II")
+DATA = 0
+ACK = 1
+WINDOW = 64
+MAX_SACK_RANGES = 8
+DUPLICATE_THRESHOLD = 3
+INITIAL_RTO = 1.0
+MIN_RTO = 0.2
+MAX_RTO = 10.0
+CLOCK_GRANULARITY = 0.01
+# Больший пакет клиент всё равно не соберёт из фрагментов
+PENDING_BUFFER = 64 * 1024 * 1024
+# Память на пакет в очереди отправки без учёта его данных
+PENDING_OVERHEAD = 64
+
+
+def is_reliable(packet: bytes) -> bool:
+    """Проверяет, относится ли пакет к надёжной доставке."""
+    return packet.startswith(RELIABLE_MAGIC)
+
+
+class ReliableChannel:
+    """Надёжная доставка пакетов одному собеседнику.
+
+    Класс не работает с сокетом: методы возвращают пакеты, которые нужно
+    отправить, поэтому его можно использовать и с сокетом, и с транспортом
+    asyncio, и с тестовым транспортом.
+
+    Пакеты, не поместившиеся в окно, ждут в очереди размером не больше
+    max_bytes (каждый занимает PENDING_OVERHEAD байт сверх своих данных),
+    поэтому собеседник, не отправляющий подтверждения, не может занять
+    неограниченно много памяти.
+    """
+
+    def __init__(
+        self,
+        window: int = WINDOW,
+        max_bytes: int = PENDING_BUFFER
+    ) -> None:
+        """Инициализация.
+
+        Аргументы:
+            window:     Максимальное количество неподтверждённых пакетов.
+            max_bytes:  Максимальный размер очереди отправки.
+        """
+        self.window = window
+        self.max_bytes = max_bytes
+        self.buffered = 0
+        self.session = randrange(1, 1 << 32)
+        self.rto = INITIAL_RTO
+        self.srtt = None
+        self.rttvar = None
+        self.retransmissions = 0
+        self.__lock = Lock()
+        self.__next_seq = 0
+        self.__pending = deque()
+        # seq: [пакет, время отправки, срок подтверждения, повторялся ли,
+        #       сколько более поздних пакетов подтверждено]
+        self.__in_flight = OrderedDict()
+        self.__peer_session = None
+        self.__expected = 0
+        self.__out_of_order = {}
+
+    def has_unacked(self) -> bool:
+        """Есть ли неподтверждённые или ожидающие отправки пакеты."""
+        with self.__lock:
+            return bool(self.__in_flight or self.__pending)
+
+    def send(self, payload: bytes, now: float) -> list:
+        """Добавляет пакет в очередь отправки.
+
+        Аргументы:
+            payload:    Данные.
+            now:        Текущее время.
+
+        Возвращаемое значение: Пакеты, которые нужно отправить сейчас.
+
+        Исключения:
+            ValueError: Очередь отправки переполнена, пакет не добавлен.
+        """
+        with self.__lock:
+            size = len(payload) + PENDING_OVERHEAD
+
+            if self.buffered + size > self.max_bytes:
+                raise ValueError("Очередь отправки переполнена")
+
+            self.__pending.append(payload)
+            self.buffered += size
+            return self.__fill_window(now)
+
+    def receive(self, packet: bytes, now: float) -> (list, list):
+        """Обрабатывает полученный пакет.
+
+        Аргументы:
+            packet: Пакет с RELIABLE_MAGIC.
+            now:    Текущее время.
+
+        Возвращаемое значение:
+            [
+                Данные, доставленные по порядку,
+                Пакеты, которые нужно отправить (подтверждения и данные).
+            ].
+        """
+        if len(packet) < RELIABLE_HEADER.size:
+            return [], []
+
+        _, kind, session, number = RELIABLE_HEADER.unpack_from(packet)
+
+        with self.__lock:
+            if kind == DATA:
+                delivered = self.__receive_data(
+                    session,
+                    number,
+                    packet[RELIABLE_HEADER.size:]
+                )
+                return delivered, [self.__ack()]
+
+            if kind == ACK and session == self.session:
+                return [], self.__receive_ack(
+                    number,
+                    packet[RELIABLE_HEADER.size:],
+                    now
+                )
+
+        return [], []
+
+    def poll(self, now: float) -> list:
+        """Возвращает пакеты, подтверждение которых не пришло вовремя."""
+        packets = []
+
+        with self.__lock:
+            for entry in self.__in_flight.values():
+                if entry[2] <= now:
+                    # После истечения таймера пакет снова может быть
+                    # повторён по подтверждениям более поздних пакетов
+                    entry[4] = 0
+                    packets.append(self.__retransmit(entry, now))
+
+            if packets:
+                # Экспоненциальная задержка после истечения таймера
+                self.rto = min(self.rto * 2, MAX_RTO)
+
+        return packets
+
+    def __fill_window(self, now: float) -> list:
+        """Отправляет ожидающие пакеты, пока окно не заполнено."""
+        packets = []
+
+        while self.__pending and len(self.__in_flight) < self.window:
+            payload = self.__pending.popleft()
+            self.buffered -= len(payload) + PENDING_OVERHEAD
+            packet = RELIABLE_HEADER.pack(
+                RELIABLE_MAGIC,
+                DATA,
+                self.session,
+                self.__next_seq
+            ) + payload
+            self.__in_flight[self.__next_seq] = [
+                packet,
+                now,
+                now + self.rto,
+                False,
+                0
+            ]
+            self.__next_seq += 1
+            packets.append(packet)
+
+        return packets
+
+    def __retransmit(self, entry: list, now: float) -> bytes:
+        """Отмечает пакет как повторно отправленный."""
+        entry[2] = now + self.rto
+        entry[3] = True
+        self.retransmissions += 1
+        return entry[0]
+
+    def __receive_data(self, session: int, seq: int, payload: bytes) -> list:
+        """Сохраняет пакет данных и возвращает доставленные по порядку."""
+        if session != self.__peer_session:
+            self.__peer_session = session
+            self.__expected = 0
+            self.__out_of_order.clear()
+
+        if seq < self.__expected or seq >= self.__expected + 2 * self.window:
+            return []
+
+        self.__out_of_order[seq] = payload
+        delivered = []
+
+        while self.__expected in self.__out_of_order:
+            delivered.append(self.__out_of_order.pop(self.__expected))
+            self.__expected += 1
+
+        return delivered
+
+    def __ack(self) -> bytes:
+        """Создаёт подтверждение с диапазонами пакетов не по порядку."""
+        ranges = []
+
+        for seq in sorted(self.__out_of_order):
+            if ranges and ranges[-1][1] == seq:
+                ranges[-1][1] = seq + 1
+            elif len(ranges) < MAX_SACK_RANGES:
+                ranges.append([seq, seq + 1])
+            else:
+                break
+
+        return RELIABLE_HEADER.pack(
+            RELIABLE_MAGIC,
+            ACK,
+            self.__peer_session or 0,
+            self.__expected
+        ) + SACK_COUNT.pack(len(ranges)) + b"".join(
+            SACK_RANGE.pack(start, end) for start, end in ranges
+        )
+
+    def __receive_ack(self, cumulative: int, body: bytes, now: float) -> list:
+        """Удаляет подтверждённые пакеты и отправляет следующие."""
+        acked = [seq for seq in self.__in_flight if seq < cumulative]
+        highest = cumulative - 1
+
+        if len(body) >= SACK_COUNT.size:
+            count = min(
+                SACK_COUNT.unpack_from(body)[0],
+                (len(body) - SACK_COUNT.size) // SACK_RANGE.size
+            )
+
+            for index in range(count):
+                start, end = SACK_RANGE.unpack_from(
+                    body,
+                    SACK_COUNT.size + index * SACK_RANGE.size
+                )
+                acked.extend(
+                    seq for seq in self.__in_flight if start <= seq < end
+                )
+                highest = max(highest, end - 1)
+
+        sample = None
+
+        for seq in acked:
+            entry = self.__in_flight.pop(seq, None)
+
+            # Алгоритм Карна: время повторно отправленных пакетов не
+            # измеряется
+            if entry is not None and not entry[3]:
+                sample = now - entry[1]
+
+        if sample is not None:
+            self.__update_rto(sample)
+        elif acked:
+            # Подтверждение новых данных отменяет экспоненциальную задержку
+            self.__reset_rto()
+
+        packets = []
+
+        for seq, entry in self.__in_flight.items():
+            if seq > highest:
+                break
+
+            entry[4] += 1
+
+            if entry[4] == DUPLICATE_THRESHOLD:
+                packets.append(self.__retransmit(entry, now))
+
+        return packets + self.__fill_window(now)
+
+    def __update_rto(self, sample: float) -> None:
+        """Обновляет оценку RTT и время ожидания подтверждения."""
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - sample)
+            self.srtt = 0.875 * self.srtt + 0.125 * sample
+
+        self.__reset_rto()
+
+    def __reset_rto(self) -> None:
+        """Вычисляет время ожидания подтверждения по оценке RTT."""
+        if self.srtt is None:
+            self.rto = INITIAL_RTO
+            return
+
+        self.rto = min(max(
+            self.srtt + max(CLOCK_GRANULARITY, 4 * self.rttvar),
+            MIN_RTO
+        ), MAX_RTO)
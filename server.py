@@ -1,30 +1,215 @@
 """Модуль сервера."""
+from argparse import ArgumentParser
+from asyncio import DatagramProtocol
+from asyncio import all_tasks
+from asyncio import gather
+from asyncio import new_event_loop
 from base64 import b64encode
+from collections import OrderedDict
+from collections import deque
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from contextlib import contextmanager
 from hashlib import sha256
 from json import dumps
 from json import loads
+from math import ceil
+from multiprocessing import Process
+from os import cpu_count
 from os import path
+from queue import Empty
+from queue import SimpleQueue
 from random import choice
+from re import compile as re_compile
+from signal import SIGTERM
+from signal import signal
 from socket import AF_INET
 from socket import SOCK_DGRAM
+from socket import SOL_SOCKET
+from socket import SO_RCVBUF
+from socket import SO_SNDBUF
 from socket import socket
+from socket import timeout as SocketTimeout
 from sqlite3 import connect
 from string import ascii_letters
 from string import digits
+from tempfile import TemporaryDirectory
+from threading import Lock
+from threading import RLock
 from threading import Thread
-from time import sleep
+from threading import get_ident
+from time import monotonic
+from time import perf_counter
 from time import time
+from zlib import crc32
 
 from aes_crypto import acrypt
+from aes_crypto import agcm
+from framing import Fragmenter
+from framing import Reassembler
+from log import PacketSampler
+from log import logger
+import log
+from reliable import ReliableChannel
+from reliable import is_reliable
+import wire
 from bcrypt import kdf
+from metrics import METRICS_INTERVAL
+from metrics import MetricsReporter
+from metrics import metrics
+from tracing import SLOW_REQUEST_TIME
+from tracing import tracer
+
+try:
+    from socket import AF_UNIX
+    from socket import SO_REUSEPORT
+except ImportError:
+    # На Windows нет UNIX сокетов и SO_REUSEPORT, поэтому --workers
+    # недоступен
+    AF_UNIX = None
+    SO_REUSEPORT = None
 
 PASSWORD_EXTRA_SALT = "Pu~w9cC+RV)Bfjnd1oSbLQhjwGP)mJ$R^%+DHp(u)LP@AgMq)dl&0T\
 (V$Thope)Q"
 KEY_EXTRA = "LX@$wmd3l8Yt9zxj9WH8yp@DOzNrDk2^flJzzNU!%oYy3EUoXabyGF~k%5TiJBH*"
 IDLE_MAX_TIME = 10
 IDLE_SLEEP_TIME = 1
+RETRANSMIT_INTERVAL = 0.05
+CONVERSATION_PAGE = 50
+CONVERSATION_PAGE_MAX = 200
+MAX_MESSAGE_ID = 2 ** 63 - 1
+USER_CACHE_SIZE = 4096
+SQL_MAX_VARIABLES = 500
+SQL_LITERAL = re_compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"")
+STATEMENT_CACHE_SIZE = 256
+GROUP_COMMIT_INTERVAL = 0.002
+READ_POOL_SIZE = 4
+STORAGE_PROFILES = {
+    # WAL позволяет читать параллельно с записью, а synchronous = NORMAL
+    # синхронизирует диск только при контрольных точках
+    "wal": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -16 * 1024
+    },
+    "durable": {
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -16 * 1024
+    }
+}
+GROUP_COMMIT_SIZE = 256
+# Версия синхронизации при разделении сообщений на несколько файлов
+# состоит из версий файлов по VERSION_BITS бит
+VERSION_BITS = 48
+# Версия передаётся одним числом zigzag varint, которое занимает на бит
+# больше версии
+MAX_SHARDS = (wire.MAX_VARINT_BITS - 1) // VERSION_BITS
+WORKER_BUS_BUFFER = 1024 * 1024
+# Возможности, которые клиент может запросить при рукопожатии
+CAPABILITIES = (wire.BINARY, wire.GCM, wire.ZLIB, wire.ZDICT)
+# Сообщения [id, sender, content, receiver, read]. Статус вычисляется по
+# границам получения и прочтения переписки получателя: сообщения с ID не
+# больше delivered_id получены, не больше read_id прочитаны
+MESSAGE_SELECT = (
+    "SELECT m.id, m.sender, m.content, m.receiver, "
+    "CASE WHEN m.id <= c.read_id THEN 2 "
+    "WHEN m.id <= c.delivered_id THEN 1 ELSE 0 END "
+    "FROM direct_messages AS m LEFT JOIN conversations AS c "
+    "ON c.user = m.receiver AND c.peer = m.sender"
+)
+
+# Миграции схемы базы данных. Номер миграции хранится в PRAGMA
+# user_version, новые миграции добавляются только в конец.
+MIGRATIONS = (
+    # 1: версия изменения для команды sync
+    """
+        ALTER TABLE direct_messages \
+        ADD COLUMN version INTEGER NOT NULL DEFAULT 0;
+
+        CREATE INDEX direct_messages_version \
+        ON direct_messages (version);
+    """,
+    # 2: страницы переписки, также используется для поиска по sender
+    """
+        CREATE INDEX direct_messages_conversation \
+        ON direct_messages (sender, receiver, id);
+    """,
+    # 3: поиск по получателю и непрочитанным, уникальные логины
+    """
+        CREATE INDEX direct_messages_receiver \
+        ON direct_messages (receiver, read);
 
-clients = {}
+        CREATE UNIQUE INDEX users_name ON users (name);
+    """,
+    # 4: список переписок с последним сообщением и количеством непрочитанных
+    """
+        CREATE TABLE conversations (
+            user INTEGER NOT NULL,
+            peer INTEGER NOT NULL,
+            last_id INTEGER NOT NULL,
+            last_time INTEGER NOT NULL DEFAULT 0,
+            unread INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user, peer)
+        ) WITHOUT ROWID;
+
+        INSERT INTO conversations (user, peer, last_id, unread) \
+        SELECT user, peer, MAX(id), SUM(unread) FROM (\
+            SELECT sender AS user, receiver AS peer, id, 0 AS unread \
+            FROM direct_messages \
+            UNION ALL SELECT receiver, sender, id, read != 2 \
+            FROM direct_messages\
+        ) GROUP BY user, peer;
+    """,
+    # 5: статус сообщений хранится границами получения и прочтения в
+    # conversations, столбец direct_messages.read больше не изменяется
+    """
+        ALTER TABLE conversations \
+        ADD COLUMN inbound_id INTEGER NOT NULL DEFAULT 0;
+        ALTER TABLE conversations \
+        ADD COLUMN delivered_id INTEGER NOT NULL DEFAULT 0;
+        ALTER TABLE conversations \
+        ADD COLUMN read_id INTEGER NOT NULL DEFAULT 0;
+        ALTER TABLE conversations \
+        ADD COLUMN version INTEGER NOT NULL DEFAULT 0;
+
+        UPDATE conversations SET \
+        inbound_id = COALESCE((\
+            SELECT MAX(id) FROM direct_messages \
+            WHERE sender = conversations.peer \
+            AND receiver = conversations.user\
+        ), 0), \
+        delivered_id = COALESCE((\
+            SELECT MAX(id) FROM direct_messages \
+            WHERE sender = conversations.peer \
+            AND receiver = conversations.user AND read > 0\
+        ), 0), \
+        read_id = COALESCE((\
+            SELECT MAX(id) FROM direct_messages \
+            WHERE sender = conversations.peer \
+            AND receiver = conversations.user AND read = 2\
+        ), 0), \
+        version = COALESCE((\
+            SELECT MAX(version) FROM direct_messages \
+            WHERE sender = conversations.peer \
+            AND receiver = conversations.user\
+        ), 0);
+
+        CREATE INDEX conversations_version ON conversations (version);
+        CREATE INDEX conversations_receipts ON conversations (peer, version);
+    """,
+    # 6: настройки файла, например количество файлов сообщений (shards)
+    """
+        CREATE TABLE settings (
+            name TEXT PRIMARY KEY NOT NULL,
+            value INTEGER NOT NULL
+        ) WITHOUT ROWID;
+    """
+)
 
 
 def absolute(path_: str) -> str:
@@ -35,6 +220,11 @@ def absolute(path_: str) -> str:
     ))
 
 
+def is_integer(value, low: int, high: int) -> bool:
+    """Проверяет, что value - целое число от low до high включительно."""
+    return type(value) is int and low <= value <= high
+
+
 def encrypt_password(user_id: int, password: str) -> str:
     """Шифрует пароль.
 
@@ -56,485 +246,2956 @@ def encrypt_password(user_id: int, password: str) -> str:
     return hashed_password
 
 
-class Database:
-    """Класс базы данных."""
+class PasswordHasher:
+    """Вычисляет хеши паролей в пуле процессов.
 
-    def __init__(self, filepath: str) -> None:
-        """Инициализация базы данных.
+    Метрики:
+        password_hash.queue_length: Количество ещё не вычисленных хешей.
+        password_hash.latency:      Время от постановки в очередь до
+                                        получения хеша.
+    """
+
+    def __init__(self, workers: int = 0) -> None:
+        """Инициализация пула.
 
         Аргументы:
-            filepath:   Путь к базе данных.
+            workers:    Количество процессов. Если 0, хеши вычисляются сразу
+                            в вызывающем потоке.
         """
-        self.__con = connect(filepath)
-        self.__cur = self.__con.cursor()
+        self.__pool = ProcessPoolExecutor(workers) if workers > 0 else None
+        self.__lock = Lock()
+        self.__futures = set()
+        self.__closed = False
+        self.queue_length = 0
 
-    def sql(
-        self,
-        sql_text: str,
-        format_=None,
-        noresult: bool = False
-    ):
-        """Выполняет SQL код.
+    def submit(self, user_id: int, password: str, callback) -> None:
+        """Вычисляет хеш пароля и передаёт его в callback.
 
         Аргументы:
-            sql_text:   SQL код.
-            format_:    Заменители '?' в SQL коде.
-            noresult:   Если включено, то результатом будет булевое значение.
-
-        Возвращаемое значение:
-            bool:   Если включено noresult, возвращает True, если результат
-                        выполнения SQL кода пустой, иначе False.
-            list:   Массив с результатами.
-            tuple:  Единственный результат.
+            user_id:    ID пользователя.
+            password:   Пароль пользователя.
+            callback:   Функция, принимающая хеш или None в случае ошибки.
+                            При использовании пула вызывается из другого
+                            потока.
         """
-        code = ""
-        results = []
+        started = perf_counter()
 
-        if format_ is None:
-            format_ = []
-        else:
-            format_ = format_[::-1]
+        if self.__pool is None:
+            with tracer.span("password_hash"):
+                try:
+                    hashed_password = encrypt_password(user_id, password)
+                except Exception as exc:
+                    logger.error("Ошибка хеширования пароля: %s", exc)
+                    hashed_password = None
 
-        try:
-            sql_text = sql_text[:sql_text.index("--")]
-        except ValueError:
-            pass
+            metrics.observe("password_hash.latency", perf_counter() - started)
+            callback(hashed_password)
+            return
 
-        for line in sql_text.split("\n"):
-            stripped_line = line.strip()
+        with self.__lock:
+            self.queue_length += 1
+            future = self.__pool.submit(encrypt_password, user_id, password)
+            self.__futures.add(future)
 
-            if len(stripped_line) == 0:
-                continue
+        trace = tracer.defer()
+        future.add_done_callback(
+            lambda future_: self.__done(future_, started, callback, trace)
+        )
 
-            code += stripped_line
+    def __done(self, future, started: float, callback, trace) -> None:
+        """Обработчик вычисленного хеша."""
+        with self.__lock:
+            self.queue_length -= 1
+            self.__futures.discard(future)
 
-            if stripped_line.endswith(";"):
-                formats = [format_.pop() for _ in range(len(format_))]
+        with tracer.resume(trace):
+            if self.__closed or future.cancelled():
+                return
 
-                cursor = self.__cur.execute(code, tuple(formats))
-                results.append(cursor.fetchall())
-                code = ""
+            elapsed = perf_counter() - started
+            metrics.observe("password_hash.latency", elapsed)
 
-        self.__con.commit()
+            if trace is not None:
+                trace.add("password_hash", elapsed)
 
-        if noresult:
-            return all(len(result) == 0 for result in results)
+            try:
+                hashed_password = future.result()
+            except Exception as exc:
+                logger.error("Ошибка хеширования пароля: %s", exc)
+                hashed_password = None
 
-        if len(results) == 1:
-            return results[0]
+            callback(hashed_password)
 
-        return results
+    def close(self) -> None:
+        """Останавливает пул процессов, отменяя невычисленные хеши."""
+        if self.__pool is None:
+            return
 
-    def reset_database(self) -> bool:
-        """Сбрасывает базу данных к начальному состоянию.
+        self.__closed = True
 
-        Возвращаемое значение: True, если удалось сбросить, иначе False.
-        """
-        return self.sql("""
-            DROP TABLE IF EXISTS users;
-            DROP TABLE IF EXISTS direct_messages;
+        with self.__lock:
+            futures = list(self.__futures)
 
-            CREATE TABLE users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
-                name VARCHAR(16) NOT NULL,
-                password CHAR(32) NOT NULL
-            );
+        for future in futures:
+            future.cancel()
 
-            CREATE TABLE direct_messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
-                sender INTEGER NOT NULL,
-                content TEXT NOT NULL,
-                receiver INTEGER NOT NULL,
-                read TINYINT NOT NULL DEFAULT 0
-            );
-        """, noresult=True)
+        self.__pool.shutdown()
 
-    def create_account(self, name: str, password: str):
-        """Создаёт аккаунт.
 
-        Аргументы:
-            name:       Логин аккаунта.
-            password:   Пароль от аккаунта.
+class UserDirectory:
+    """Кеш соответствия ID и логинов пользователей с вытеснением LRU."""
 
-        Возвращаемое значение:  Статус выполнения, id в случае успеха.
-        """
-        if len(name) < 1:
-            return 1  # ERR_SHORT_NAME
-        if len(name) > 16:
-            return 2  # ERR_LONG_NAME
+    def __init__(self, size: int = USER_CACHE_SIZE) -> None:
+        """Инициализация кеша.
 
-        if len(password) < 6:
-            return 3  # ERR_SHORT_PASSWORD
+        Аргументы:
+            size:   Максимальное количество пользователей в кеше.
+        """
+        self.size = size
+        self.__names = OrderedDict()
+        self.__ids = {}
+        self.__lock = Lock()
 
-        if not self.sql("SELECT * FROM users WHERE name = ?;", [name], True):
-            return 4  # ERR_ACCOUNT_EXISTS
+    def __len__(self) -> int:
+        """Возвращает количество пользователей в кеше."""
+        return len(self.__names)
 
-        count = self.sql("SELECT COUNT(*) FROM users;")[0][0] + 1
-        hashed_password = encrypt_password(count, password)
+    def get_name(self, user_id: int):
+        """Возвращает логин пользователя или None, если его нет в кеше."""
+        with self.__lock:
+            name = self.__names.get(user_id)
 
-        self.sql(
-            "INSERT INTO users (name, password) VALUES (?, ?);",
-            [name, hashed_password]
-        )
+            if name is not None:
+                self.__names.move_to_end(user_id)
 
-        # SUCCESSFULL
-        return [
-            0,
-            self.sql("SELECT id FROM users WHERE name = ?;", [name])[0][0]
-        ]
+            return name
 
-    def login_account(self, name: str, password: str):
-        """Входит в аккаунт.
+    def get_id(self, name: str):
+        """Возвращает ID пользователя или None, если его нет в кеше."""
+        with self.__lock:
+            user_id = self.__ids.get(name)
 
-        Аргументы:
-            name:       Логин аккаунта.
-            password:   Пароль от аккаунта.
+            if user_id is not None:
+                self.__names.move_to_end(user_id)
 
-        Возвращаемое значение:  Статус выполнения, id в случае успеха.
-        """
-        if len(name) < 1:
-            return 1  # ERR_SHORT_NAME
-        if len(name) > 16:
-            return 2  # ERR_LONG_NAME
+            return user_id
 
-        if len(password) < 6:
-            return 3  # ERR_SHORT_PASSWORD
+    def put(self, user_id: int, name: str) -> None:
+        """Добавляет пользователя в кеш, вытесняя самого старого."""
+        with self.__lock:
+            self.__names[user_id] = name
+            self.__names.move_to_end(user_id)
+            self.__ids[name] = user_id
 
-        result = self.sql("SELECT id FROM users WHERE name = ?;", [name])
+            while len(self.__names) > self.size:
+                _, old_name = self.__names.popitem(last=False)
+                del self.__ids[old_name]
 
-        if not result:
-            return 4  # ERR_ACCOUNT_NOT_EXISTS
+    def forget(self, user_id: int) -> None:
+        """Удаляет пользователя из кеша."""
+        with self.__lock:
+            name = self.__names.pop(user_id, None)
 
-        result = result[0][0]
+            if name is not None:
+                del self.__ids[name]
 
-        hashed_password = encrypt_password(result, password)
+    def clear(self) -> None:
+        """Очищает кеш."""
+        with self.__lock:
+            self.__names.clear()
+            self.__ids.clear()
 
-        if self.sql(
-            "SELECT * FROM users WHERE name = ? AND password = ?;",
-            [name, hashed_password],
-            True
-        ):
-            return 5  # ERR_INCORRECT_PASSWORD
 
-        # SUCCESSFULL
-        return [
-            0,
-            self.sql("SELECT id FROM users WHERE name = ?;", [name])[0][0]
-        ]
+class Database:
+    """Класс базы данных."""
 
-    def get_account_data(self, name: str) -> (tuple, list):
-        """Получает данные аккаунта.
+    def __init__(
+        self,
+        filepath: str,
+        user_cache_size: int = USER_CACHE_SIZE,
+        readers: int = 0,
+        profile=None,
+        shards: int = 0
+    ) -> None:
+        """Инициализация базы данных.
 
         Аргументы:
-            name:   Логин аккаунта.
-
-        Возвращаемое значение:
-            [
-                Отправленные и полученные сообщения,
-                ID пользователей, чей статус сообщений был изменён.
-            ].
+            filepath:           Путь к базе данных.
+            user_cache_size:    Размер кеша ID и логинов пользователей.
+            readers:            Количество соединений только для чтения. Если
+                                    0 (или база данных в памяти), чтение
+                                    выполняется через пишущее соединение.
+            profile:            Настройки PRAGMA из STORAGE_PROFILES.
+            shards:             Количество файлов для сообщений. Если 0,
+                                    сообщения хранятся в filepath, иначе в
+                                    filepath остаются только пользователи, а
+                                    переписки распределяются по файлам
+                                    shard_path(filepath, номер). Не больше
+                                    MAX_SHARDS.
         """
-        account_id = self.sql("SELECT id FROM users WHERE name = ?;", [name])
-
-        if not account_id:
-            return ()
+        if not 0 <= shards <= MAX_SHARDS:
+            raise ValueError(
+                f"Количество файлов для сообщений должно быть от 0 до "
+                f"{MAX_SHARDS}"
+            )
+
+        self.__lock = RLock()
+        self.__statements = OrderedDict()
+        self.__transaction_depth = 0
+        self.__transaction_owner = None
+        self.__enlisted = None
+        self.__enlisted_files = []
+        self.__savepoints = 0
+        self.__profile = profile or {}
+        self.__con = self.__connect(filepath)
+        self.__cur = self.__con.cursor()
 
-        account_id = account_id[0][0]
+        for pragma, value in self.__profile.items():
+            self.__cur.execute(f"PRAGMA {pragma} = {value};")
 
-        sended = self.sql(
-            "SELECT * FROM direct_messages WHERE sender = ?;",
-            [account_id]
-        )
-        received = self.sql(
-            "SELECT * FROM direct_messages WHERE receiver = ?;",
-            [account_id]
-        )
+        if filepath == ":memory:":
+            readers = 0
 
-        usernames = []
-        usernames_logins = {}
+        self.__reader_connections = [
+            self.__connect(filepath, True) for _ in range(readers)
+        ]
+        self.__readers = None
+
+        if readers > 0:
+            self.__readers = SimpleQueue()
+
+            for con in self.__reader_connections:
+                self.__readers.put(con)
+
+        self.users = UserDirectory(user_cache_size)
+        self.__shards = [self]
+        stored = self.__stored_shards(filepath)
+
+        if stored is not None and stored != shards:
+            self.__con.close()
+
+            for con in self.__reader_connections:
+                con.close()
+
+            raise ValueError(
+                f"База данных {filepath} создана с --shards {stored}, "
+                f"указано {shards}: переписки из других файлов не будут "
+                "найдены"
+            )
+
+        if shards > 0:
+            self.__shards = [
+                Database(
+                    self.shard_path(filepath, index),
+                    user_cache_size,
+                    readers,
+                    profile
+                )
+                for index in range(shards)
+            ]
+
+        # Файлы с сообщениями блокируются для записи в начале транзакции:
+        # иначе транзакция, прочитавшая данные до записи другого процесса,
+        # не сможет записать свои изменения (database is locked)
+        self.__begin = "BEGIN IMMEDIATE;" if self in self.__shards \
+            else "BEGIN;"
+
+        # Все файлы базы данных, начиная с файла пользователей
+        self.__databases = [self] + [
+            shard for shard in self.__shards if shard is not self
+        ]
 
-        for smsg in sended:
-            if smsg[3] not in usernames:
-                usernames.append(smsg[3])
+    def __stored_shards(self, filepath: str):
+        """Возвращает количество файлов сообщений, с которым создана база.
 
-        for rmsg in received:
-            if rmsg[1] not in usernames:
-                usernames.append(rmsg[1])
+        Количество хранится в таблице settings (миграция 6). Для баз данных
+        до этой миграции оно определяется по существующим файлам сообщений
+        и по сообщениям в файле пользователей.
 
-        for uname in usernames:
-            usernames_logins[uname] = self.sql(
-                "SELECT name FROM users WHERE id = ?;",
-                [uname]
-            )[0][0]
+        Возвращаемое значение: Количество файлов или None для новой базы
+            данных.
+        """
+        tables = {row[0] for row in self.sql("""
+            SELECT name FROM sqlite_master WHERE type = 'table';
+        """)}
 
-        status_changed = self.sql("""
-            SELECT sender FROM direct_messages WHERE receiver = ? AND read = 0;
-        """, [account_id])
+        if "settings" in tables:
+            result = self.sql("""
+                SELECT value FROM settings WHERE name = 'shards';
+            """)
 
-        st_changed = []
+            if result:
+                return result[0][0]
 
-        for id_ in status_changed:
-            if id_[0] not in st_changed:
-                st_changed.append(id_[0])
+        if filepath != ":memory:":
+            count = 0
 
-        if len(st_changed) > 0:
-            self.sql("""
-                UPDATE direct_messages \
-                SET read = 1 \
-                WHERE receiver = ? AND read = 0;
-            """, [account_id])
+            while path.exists(self.shard_path(filepath, count)):
+                count += 1
 
-        return ((sended, received, usernames_logins), st_changed)
+            if count > 0:
+                return count
 
-    def send_message(self, login: str, receiver: int, message: str) -> bool:
-        """Создаёт запись в базе данных о сообщении."""
-        sender_id = self.sql(
-            "SELECT id FROM users WHERE name = ?;",
-            [login]
-        )
-        exists_receiver = not self.sql(
-            "SELECT id FROM users WHERE id = ?;",
-            [receiver],
-            noresult=True
-        )
+        if "direct_messages" in tables and \
+                self.sql("SELECT 1 FROM direct_messages LIMIT 1;"):
+            return 0
 
-        if len(sender_id) == 0:
-            return False
+        return None
 
-        if not exists_receiver:
-            return False
+    @staticmethod
+    def shard_path(filepath: str, index: int) -> str:
+        """Возвращает путь к файлу сообщений номер index."""
+        if filepath == ":memory:":
+            return filepath
 
-        sender_id = sender_id[0][0]
+        root, extension = path.splitext(filepath)
+        return f"{root}.shard{index}{extension}"
 
-        result = self.sql("""
-            INSERT INTO direct_messages (sender, receiver, content)
-            VALUES (?, ?, ?);
-        """, [sender_id, receiver, message], noresult=True)
+    def __shard(self, first_id: int, second_id: int) -> (int, "Database"):
+        """Возвращает номер и базу данных переписки двух пользователей.
 
-        self.sql("""
-            UPDATE direct_messages \
-            SET read = 2 \
-            WHERE receiver = ? AND sender = ? AND (read = 0 OR read = 1);
-        """, [sender_id, receiver])
+        Переписка целиком хранится в одном файле, который выбирается по хешу
+        упорядоченной пары ID.
+        """
+        if len(self.__shards) == 1:
+            return 0, self.__shards[0]
+
+        key = f"{min(first_id, second_id)}:{max(first_id, second_id)}"
+        index = crc32(key.encode("ascii")) % len(self.__shards)
+        return index, self.__enlist(self.__shards[index])
+
+    def __compose_version(self, versions: list) -> int:
+        """Объединяет версии файлов сообщений в одну версию синхронизации."""
+        return sum(
+            version << (VERSION_BITS * index)
+            for index, version in enumerate(versions)
+        )
 
-        return result
+    def __split_version(self, version: int) -> list:
+        """Разделяет версию синхронизации на версии файлов сообщений."""
+        mask = (1 << VERSION_BITS) - 1
+        return [
+            version >> (VERSION_BITS * index) & mask
+            for index in range(len(self.__shards))
+        ]
 
-    def find_user(self, username: str):
-        """Ищет пользователя по username.
+    def __connect(self, filepath: str, read_only: bool = False):
+        """Открывает соединение с базой данных.
 
         Аргументы:
-            username:   Имя пользователя.
+            filepath:   Путь к базе данных.
+            read_only:  Запретить изменения через это соединение.
 
-        Возвращаемое значение:
-            False:          Пользователь не найден.
-            list[int, str]: ID пользователя и его имя.
+        Возвращаемое значение: Соединение.
         """
-        result = self.sql("SELECT id FROM users WHERE name = ?;", [username])
+        con = connect(
+            filepath,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE
+        )
 
-        if len(result) == 0:
-            return False
+        if read_only:
+            con.execute("PRAGMA query_only = ON;")
 
-        return [result[0][0], username]
+            # journal_mode и synchronous задаются пишущим соединением
+            for pragma in ("mmap_size", "cache_size"):
+                if pragma in self.__profile:
+                    con.execute(
+                        f"PRAGMA {pragma} = {self.__profile[pragma]};"
+                    )
 
-    def close(self) -> None:
-        """Закрывает базу данных."""
-        self.__con.close()
+        return con
 
+    def __execute(self, cursor, sql_text: str, format_) -> list:
+        """Выполняет SQL код через курсор cursor.
 
-class NetworkedClient:
-    """Класс клиента."""
+        Возвращаемое значение: Результаты каждого запроса.
+        """
+        results = []
+        format_ = [] if format_ is None else list(format_)
 
-    _instances = []
+        with metrics.timer("db.query"), tracer.span("db"):
+            for code, count in self.__prepare(sql_text):
+                formats = format_[:count]
+                format_ = format_[count:]
 
-    def __init__(self, sock: socket, addr, key: str) -> None:
-        self.sock: socket = sock
-        self.addr = addr
-        self.login = None
-        self.id_ = None
-        self.__password = None
-        self.__key = key
-        self.__aes = acrypt(KEY_EXTRA + self.__key)
-        self._instances.append(self)
+                results.append(
+                    cursor.execute(code, tuple(formats)).fetchall()
+                )
 
-    def __encode_message(self, message) -> bytes:
-        """Превращает объекты, преобразоваемые в JSON в байты."""
-        return self.__aes.encrypt(dumps(
-            message,
-            separators=(",", ":"),
-            ensure_ascii=False
-        ))
+        return results
 
-    def __decode_message(self, message: bytes):
-        """Превращает байты в объекты, преобразоваемые в JSON."""
-        return loads(self.__aes.decrypt(message))
+    @staticmethod
+    def __result(results: list, noresult: bool):
+        """Преобразует результаты запросов в результат sql()."""
+        if noresult:
+            return all(len(result) == 0 for result in results)
 
-    def send(self, message: list) -> None:
-        """Отправляет сообщение клиенту.
+        if len(results) == 1:
+            return results[0]
+
+        return results
+
+    def sql(
+        self,
+        sql_text: str,
+        format_=None,
+        noresult: bool = False
+    ):
+        """Выполняет SQL код.
+
+        Вне transaction() изменения сохраняются после выполнения кода, внутри
+        - при выходе из самой внешней транзакции.
 
         Аргументы:
-            message:    Сообщение.
-        """
-        print("Отправлено клиенту:", message)
-        encoded = self.__encode_message(message)
-        self.sock.sendto(encoded, self.addr)
+            sql_text:   SQL код.
+            format_:    Заменители '?' в SQL коде.
+            noresult:   Если включено, то результатом будет булевое значение.
 
-    def send_account_data(self) -> None:
-        """Отправляет данные об аккаунте."""
-        if self.login is None:
-            return
+        Возвращаемое значение:
+            bool:   Если включено noresult, возвращает True, если результат
+                        выполнения SQL кода пустой, иначе False.
+            list:   Массив с результатами.
+            tuple:  Единственный результат.
+        """
+        with self.__lock:
+            results = self.__execute(self.__cur, sql_text, format_)
+            self.__autocommit()
 
-        adata = dtb.get_account_data(self.login)
+        return self.__result(results, noresult)
 
-        self.send(["account_data", adata[0]])
+    def read(self, sql_text: str, format_=None, noresult: bool = False):
+        """Выполняет SQL код, не изменяющий базу данных.
 
-        for receiver in adata[1]:
-            for inst in self._instances:
-                if inst.id_ == receiver:
-                    inst.send_account_data()
+        Запрос выполняется через свободное соединение только для чтения и не
+        ждёт окончания записей в других потоках.
 
-    def receive(self, jdata: bytes) -> bool:
-        """Получает сообщение от клиента.
+        Аргументы и возвращаемое значение такие же, как у sql().
+        """
+        with self.snapshot() as read:
+            return read(sql_text, format_, noresult)
 
-        Аргументы:
-            jdata:  Данные от клиента.
+    @contextmanager
+    def snapshot(self):
+        """Открывает транзакцию чтения.
 
-        Возвращаемое значаени: Надо ли обновлять таймер сообщений?
+        Все запросы функции, которую возвращает блок with, видят одно и то же
+        состояние базы данных. Внутри transaction() этого же потока запросы
+        выполняются через пишущее соединение, чтобы видеть свои изменения.
         """
-        data = self.__decode_message(jdata)
+        if self.__readers is None or \
+                self.__transaction_owner == get_ident():
+            with self.__lock:
+                yield self.sql
 
-        if data == ["client_alive"]:
-            return True
+            return
 
-        print("Получено от клиента:", data)
+        con = self.__readers.get()
+        cursor = con.cursor()
 
-        com = data[0]
-        args = data[1:]
+        def read(sql_text: str, format_=None, noresult: bool = False):
+            return self.__result(
+                self.__execute(cursor, sql_text, format_),
+                noresult
+            )
 
-        if com == "register":
-            result = dtb.create_account(*args[:2])
+        try:
+            cursor.execute("BEGIN;")
+            yield read
+        finally:
+            con.rollback()
+            cursor.close()
+            self.__readers.put(con)
 
-            if isinstance(result, list):
-                status = result[0]
-                self.id_ = result[1]
-                self.send(["register_status", status])
+    def sql_many(self, sql_text: str, formats) -> int:
+        """Выполняет один SQL запрос для каждого набора заменителей.
 
-                if status == 0:
-                    self.login, self.__password = args[:2]
-        elif com == "login":
-            result = dtb.login_account(*args[:2])
+        Аргументы:
+            sql_text:   SQL код из одного запроса.
+            formats:    Наборы заменителей '?'.
 
-            if isinstance(result, list):
-                status = result[0]
-                self.id_ = result[1]
-                self.send(["login_status", status])
+        Возвращаемое значение: Количество изменённых строк.
+        """
+        statements = self.__prepare(sql_text)
+
+        if len(statements) != 1:
+            raise ValueError("sql_many() принимает ровно один запрос")
+
+        with self.__lock:
+            cursor = self.__cur.executemany(
+                statements[0][0],
+                (tuple(format_) for format_ in formats)
+            )
+            self.__autocommit()
+            return cursor.rowcount
+
+    @contextmanager
+    def transaction(self):
+        """Объединяет все запросы внутри блока with в одну транзакцию.
+
+        Изменения сохраняются один раз при выходе из самой внешней
+        транзакции и отменяются, если внутри возникло исключение. Файлы
+        сообщений, к которым обращались внутри транзакции, сохраняются
+        перед файлом пользователей, каждый своим COMMIT.
+        """
+        with self.__lock:
+            outermost = self.__transaction_depth == 0
 
-                if status == 0:
-                    self.login, self.__password = args[:2]
-        elif com == "disconnect":
-            self.close()
-            return False
-        elif not (self.login is None and self.__password is None):
-            if com == "get_account_data":
-                self.send_account_data()
-            elif com == "send_message":
-                msg = args[0][:65535]
-                dtb.send_message(self.login, args[1], msg)
+            if outermost and not self.__con.in_transaction:
+                self.__cur.execute(self.__begin)
 
-                self.send_account_data()
+            self.__transaction_depth += 1
+            self.__transaction_owner = get_ident()
 
-                for instance in self._instances:
-                    if args[1] == instance.login:
-                        instance.send_account_data()
-                        break
-            elif com == "find_user":
-                if args[0] == self.login:
-                    self.send(["find_user_result", False])
-                else:
-                    self.send(["find_user_result", dtb.find_user(args[0])])
-            else:
-                return False
-        elif com in ["get_account_data", "send_message", "find_user"]:
-            self.send(["not_logged"])
-            return False
-        else:
-            return False
+            try:
+                with self.__enlistment(outermost):
+                    yield self
+            except BaseException:
+                self.__transaction_depth -= 1
 
-        return True
+                if self.__transaction_depth == 0:
+                    self.__transaction_owner = None
+                    self.__con.rollback()
 
-    def close(self) -> None:
-        """Закрывает соединение с клиентом."""
-        del clients[self.addr]
+                raise
 
+            self.__transaction_depth -= 1
 
-dtb = Database(absolute("messenger.db"))
+            if self.__transaction_depth == 0:
+                self.__transaction_owner = None
+                self.__con.commit()
 
+    @contextmanager
+    def __enlistment(self, outermost: bool):
+        """Собирает транзакции файлов сообщений внешней транзакции."""
+        if not outermost or len(self.__databases) == 1:
+            yield
+            return
 
-def check_idle() -> None:
-    """Отключает неактивных клиентов.
+        with ExitStack() as stack:
+            self.__enlisted = stack
+            self.__enlisted_files = []
 
-    Аргументы:
-        clients:    Словарь всех клиентов.
-    """
-    while True:
-        inactive_clients = []
+            try:
+                yield
+            finally:
+                self.__enlisted = None
+                self.__enlisted_files = []
 
-        for client in clients.values():
-            if client[1] < time() - IDLE_MAX_TIME:
-                inactive_clients.append(client[0])
+    def __enlist(self, shard: "Database") -> "Database":
+        """Присоединяет файл сообщений к открытой в этом потоке транзакции.
 
-        for client in inactive_clients:
-            client.close()
+        Аргументы:
+            shard:  Файл сообщений.
 
-        sleep(IDLE_SLEEP_TIME)
+        Возвращаемое значение: shard.
+        """
+        if shard is self or self.__enlisted is None or \
+                self.__transaction_owner != get_ident() or \
+                shard in self.__enlisted_files:
+            return shard
 
+        self.__enlisted.enter_context(shard.transaction())
+        self.__enlisted_files.append(shard)
 
-def main() -> None:
-    """Основная функция."""
-    sock = socket(AF_INET, SOCK_DGRAM)
-    sock.bind(("0.0.0.0", 7505))
+        for _ in range(self.__savepoints):
+            shard.sql("SAVEPOINT part;")
 
-    print("Сервер запущен")
+        return shard
 
-    Thread(target=check_idle, daemon=True).start()
+    @contextmanager
+    def savepoint(self):
+        """Позволяет отменить часть транзакции.
 
-    with sock:
-        while True:
-            try:
-                adrdata = sock.recvfrom(70000)
-            except (ConnectionResetError, ConnectionAbortedError):
-                continue
+        Если внутри блока with возникло исключение, изменения блока
+        отменяются во всех файлах, присоединённых к транзакции, а сама
+        транзакция продолжается.
+        """
+        with self.__lock:
+            self.sql("SAVEPOINT part;")
 
-            data = adrdata[0]
-            addr = adrdata[1]
-            key = None
-            print("<", data)
-
-            if addr not in clients:
-                key = "".join(
-                    [choice(ascii_letters + digits) for _ in range(64)]
-                             )
-                clients[addr] = [
-                    NetworkedClient(sock, addr, key),
-                    time() - IDLE_MAX_TIME + 5
-                ]
+            for shard in self.__enlisted_files:
+                shard.sql("SAVEPOINT part;")
+
+            self.__savepoints += 1
 
-                if data == b"\x05\x03\xff\x01":
-                    key = key.encode("ascii")
-                    sock.sendto(key, addr)
-                    print(">", key)
-                    key = None
+            try:
+                yield self
+            except BaseException:
+                for database in [self] + self.__enlisted_files:
+                    database.sql("ROLLBACK TO part;")
+                    database.sql("RELEASE part;")
+
+                raise
             else:
-                try:
-                    if clients[addr][0].receive(data):
-                        clients[addr][1] = time()
-                except BaseException as exc:
-                    clients[addr][0].close()
-                    print(exc)
+                for database in [self] + self.__enlisted_files:
+                    database.sql("RELEASE part;")
+            finally:
+                self.__savepoints -= 1
 
-    dtb.close()
+    def __autocommit(self) -> None:
+        """Сохраняет изменения, если нет открытой транзакции."""
+        if self.__transaction_depth == 0 and self.__con.in_transaction:
+            self.__con.commit()
 
+    def __prepare(self, sql_text: str) -> tuple:
+        """Разбирает SQL код на отдельные запросы.
+
+        Результат кешируется, поэтому один и тот же текст разбирается только
+        один раз, а sqlite3 повторно использует скомпилированные запросы.
+
+        Аргументы:
+            sql_text:   SQL код.
+
+        Возвращаемое значение: Запросы и количество '?' в каждом из них.
+        """
+        statements = self.__statements.get(sql_text)
+
+        if statements is not None:
+            return statements
+
+        code = ""
+        parsed = []
+
+        try:
+            cut_text = sql_text[:sql_text.index("--")]
+        except ValueError:
+            cut_text = sql_text
+
+        for line in cut_text.split("\n"):
+            stripped_line = line.strip()
+
+            if len(stripped_line) == 0:
+                continue
+
+            code += stripped_line
+
+            if stripped_line.endswith(";"):
+                parsed.append((code, SQL_LITERAL.sub("", code).count("?")))
+                code = ""
+
+        # Единственный запрос получает все заменители, как и раньше
+        if len(parsed) == 1:
+            parsed[0] = (parsed[0][0], None)
+
+        statements = tuple(parsed)
+
+        with self.__lock:
+            self.__statements[sql_text] = statements
+
+            if len(self.__statements) > STATEMENT_CACHE_SIZE:
+                self.__statements.popitem(last=False)
+
+        return statements
+
+    def reset_database(self) -> bool:
+        """Сбрасывает базу данных к начальному состоянию.
+
+        Возвращаемое значение: True, если удалось сбросить, иначе False.
+        """
+        for database in self.__databases[1:]:
+            database.reset_database()
+
+        with self.__lock:
+            result = self.sql("""
+                DROP TABLE IF EXISTS users;
+                DROP TABLE IF EXISTS direct_messages;
+                DROP TABLE IF EXISTS conversations;
+                DROP TABLE IF EXISTS settings;
+
+                CREATE TABLE users (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+                    name VARCHAR(16) NOT NULL,
+                    password CHAR(32) NOT NULL
+                );
+
+                CREATE TABLE direct_messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+                    sender INTEGER NOT NULL,
+                    content TEXT NOT NULL,
+                    receiver INTEGER NOT NULL,
+                    read TINYINT NOT NULL DEFAULT 0
+                );
+
+                PRAGMA user_version = 0;
+            """, noresult=True)
+            self.users.clear()
+            self.migrate()
+
+        return result
+
+    def schema_version(self) -> int:
+        """Возвращает номер последней применённой миграции."""
+        return self.sql("PRAGMA user_version;")[0][0]
+
+    def migrate(self) -> int:
+        """Применяет к базе данных недостающие миграции из MIGRATIONS.
+
+        Каждая миграция выполняется в отдельной транзакции вместе с
+        обновлением PRAGMA user_version, поэтому база данных не может
+        остаться в частично обновлённом состоянии. Файлы сообщений
+        обновляются после файла пользователей.
+
+        После миграций в settings записывается количество файлов
+        сообщений, если оно ещё не записано.
+
+        Возвращаемое значение: Номер версии схемы после обновления.
+        """
+        with self.__lock:
+            version = self.schema_version()
+
+            for number, migration in enumerate(
+                MIGRATIONS[version:],
+                version + 1
+            ):
+                with self.transaction():
+                    self.sql(migration)
+                    self.sql(f"PRAGMA user_version = {number};")
+
+            self.sql("""
+                INSERT OR IGNORE INTO settings (name, value) \
+                VALUES ('shards', ?);
+            """, [len(self.__databases) - 1])
+
+            for database in self.__databases[1:]:
+                database.migrate()
+
+            return self.schema_version()
+
+    def user_id(self, name: str):
+        """Возвращает ID пользователя по логину.
+
+        Аргументы:
+            name:   Логин пользователя.
+
+        Возвращаемое значение: ID или None, если пользователь не найден.
+        """
+        user_id = self.users.get_id(name)
+
+        if user_id is not None:
+            return user_id
+
+        result = self.read("SELECT id FROM users WHERE name = ?;", [name])
+
+        if not result:
+            return None
+
+        self.users.put(result[0][0], name)
+        return result[0][0]
+
+    def user_names(self, user_ids) -> dict:
+        """Возвращает логины пользователей одним запросом.
+
+        Аргументы:
+            user_ids:   ID пользователей.
+
+        Возвращаемое значение: Словарь {ID: логин} найденных пользователей.
+        """
+        names = {}
+        missing = []
+
+        for user_id in user_ids:
+            name = self.users.get_name(user_id)
+
+            if name is None:
+                missing.append(user_id)
+            else:
+                names[user_id] = name
+
+        for start in range(0, len(missing), SQL_MAX_VARIABLES):
+            chunk = missing[start:start + SQL_MAX_VARIABLES]
+            params = ", ".join("?" * len(chunk))
+
+            for user_id, name in self.read(
+                f"SELECT id, name FROM users WHERE id IN ({params});",
+                chunk
+            ):
+                self.users.put(user_id, name)
+                names[user_id] = name
+
+        return {
+            user_id: names[user_id]
+            for user_id in user_ids
+            if user_id in names
+        }
+
+    def sync_version(self) -> int:
+        """Возвращает номер последнего изменения сообщений."""
+        return self.__compose_version([
+            shard.__file_version() for shard in self.__shards
+        ])
+
+    def __file_version(self, read=None) -> int:
+        """Возвращает номер последнего изменения сообщений в этом файле.
+
+        Аргументы:
+            read:   Функция чтения из snapshot() или None для sql().
+        """
+        return (read or self.sql)("""
+            SELECT MAX(\
+                (SELECT COALESCE(MAX(version), 0) FROM direct_messages), \
+                (SELECT COALESCE(MAX(version), 0) FROM conversations)\
+            );
+        """)[0][0]
+
+    def reserve_account(self, name: str, password: str):
+        """Проверяет данные и занимает логин для нового аккаунта.
+
+        Пароль занятого аккаунта пустой, пока не будет вызван finish_account.
+
+        Аргументы:
+            name:       Логин аккаунта.
+            password:   Пароль от аккаунта.
+
+        Возвращаемое значение:  Статус выполнения, id в случае успеха.
+        """
+        if len(name) < 1:
+            return 1  # ERR_SHORT_NAME
+        if len(name) > 16:
+            return 2  # ERR_LONG_NAME
+
+        if len(password) < 6:
+            return 3  # ERR_SHORT_PASSWORD
+
+        with self.__lock:
+            if self.users.get_id(name) is not None or not self.sql(
+                "SELECT id FROM users WHERE name = ?;",
+                [name],
+                noresult=True
+            ):
+                return 4  # ERR_ACCOUNT_EXISTS
+
+            self.sql(
+                "INSERT INTO users (name, password) VALUES (?, '');",
+                [name]
+            )
+
+            # SUCCESSFULL
+            return [0, self.user_id(name)]
+
+    def finish_account(self, user_id: int, hashed_password) -> bool:
+        """Устанавливает пароль аккаунта, занятого reserve_account.
+
+        Аргументы:
+            user_id:            ID аккаунта.
+            hashed_password:    Зашифрованный пароль. Если None, аккаунт
+                                    удаляется.
+
+        Возвращаемое значение: True, если пароль установлен, False, если
+            хеша нет или аккаунт уже удалён drop_unfinished_accounts().
+        """
+        if hashed_password is None:
+            self.sql("DELETE FROM users WHERE id = ?;", [user_id])
+            self.users.forget(user_id)
+            return False
+
+        return self.sql_many(
+            "UPDATE users SET password = ? WHERE id = ? AND password = '';",
+            [[hashed_password, user_id]]
+        ) == 1
+
+    def drop_unfinished_accounts(self) -> int:
+        """Удаляет аккаунты, занятые reserve_account, но не завершённые.
+
+        Такие аккаунты остаются, если сервер остановился до вычисления
+        хеша пароля. Вызывается при запуске, пока хеши не вычисляются ни
+        одним процессом сервера.
+
+        Возвращаемое значение: Количество удалённых аккаунтов.
+        """
+        with self.__lock:
+            rows = self.sql("SELECT id FROM users WHERE password = '';")
+
+            if rows:
+                self.sql("DELETE FROM users WHERE password = '';")
+
+                for row in rows:
+                    self.users.forget(row[0])
+
+            return len(rows)
+
+    def create_account(self, name: str, password: str):
+        """Создаёт аккаунт.
+
+        Аргументы:
+            name:       Логин аккаунта.
+            password:   Пароль от аккаунта.
+
+        Возвращаемое значение:  Статус выполнения, id в случае успеха.
+        """
+        result = self.reserve_account(name, password)
+
+        if isinstance(result, list):
+            self.finish_account(
+                result[1],
+                encrypt_password(result[1], password)
+            )
+
+        return result
+
+    def find_account(self, name: str, password: str):
+        """Ищет аккаунт перед проверкой пароля.
+
+        Аргументы:
+            name:       Логин аккаунта.
+            password:   Пароль от аккаунта.
+
+        Возвращаемое значение:  Статус выполнения, id в случае успеха.
+        """
+        if len(name) < 1:
+            return 1  # ERR_SHORT_NAME
+        if len(name) > 16:
+            return 2  # ERR_LONG_NAME
+
+        if len(password) < 6:
+            return 3  # ERR_SHORT_PASSWORD
+
+        user_id = self.user_id(name)
+
+        if user_id is None:
+            return 4  # ERR_ACCOUNT_NOT_EXISTS
+
+        return [0, user_id]
+
+    def check_password(self, name: str, hashed_password: str):
+        """Проверяет зашифрованный пароль аккаунта.
+
+        Аргументы:
+            name:               Логин аккаунта.
+            hashed_password:    Зашифрованный пароль.
+
+        Возвращаемое значение:  Статус выполнения, id в случае успеха.
+        """
+        result = self.read(
+            "SELECT id FROM users WHERE name = ? AND password = ?;",
+            [name, hashed_password]
+        )
+
+        if not result:
+            return 5  # ERR_INCORRECT_PASSWORD
+
+        # SUCCESSFULL
+        return [0, result[0][0]]
+
+    def login_account(self, name: str, password: str):
+        """Входит в аккаунт.
+
+        Аргументы:
+            name:       Логин аккаунта.
+            password:   Пароль от аккаунта.
+
+        Возвращаемое значение:  Статус выполнения, id в случае успеха.
+        """
+        result = self.find_account(name, password)
+
+        if not isinstance(result, list):
+            return result
+
+        return self.check_password(name, encrypt_password(result[1], password))
+
+    def get_account_data(self, name: str) -> (tuple, list):
+        """Получает данные аккаунта.
+
+        Аргументы:
+            name:   Логин аккаунта.
+
+        Возвращаемое значение:
+            [
+                Отправленные и полученные сообщения,
+                ID пользователей, чей статус сообщений был изменён.
+            ].
+        """
+        result = self.get_account_changes(name, 0)
+
+        if not result:
+            return ()
+
+        return result[:2]
+
+    def get_account_changes(
+        self,
+        name: str,
+        since: int,
+        history: bool = True
+    ) -> (tuple, list, int):
+        """Отмечает сообщения полученными и возвращает изменения аккаунта.
+
+        Аргументы:
+            name:       Логин аккаунта.
+            since:      Последняя версия, известная клиенту. Если 0,
+                            возвращаются все сообщения.
+            history:    Если False и since равен 0, вместо сообщений
+                            возвращаются только собеседники, а переписка
+                            загружается через get_conversation().
+
+        Возвращаемое значение:
+            [
+                Отправленные и полученные сообщения,
+                ID пользователей, чей статус сообщений был изменён,
+                Текущая версия.
+            ].
+        """
+        changes = self.read_account_changes(name, since, history)
+
+        if not changes:
+            return ()
+
+        return self.merge_received(changes, self.mark_received(name))
+
+    @staticmethod
+    def merge_received(changes: tuple, marked: tuple) -> (tuple, list, int):
+        """Объединяет результаты read_account_changes() и mark_received().
+
+        Статус полученных сообщений важен только отправителю, поэтому
+        клиенту возвращается версия после их отметки, если между чтением и
+        отметкой база данных не изменилась. Иначе возвращается версия
+        чтения, и новые изменения попадут в следующую синхронизацию.
+
+        Аргументы:
+            changes:    Результат read_account_changes().
+            marked:     Результат mark_received().
+
+        Возвращаемое значение: Как у get_account_changes().
+        """
+        st_changed, previous_version, version = marked
+
+        if previous_version != changes[1]:
+            version = changes[1]
+
+        return (changes[0], st_changed, version)
+
+    def mark_received(self, name: str):
+        """Отмечает полученными новые сообщения для аккаунта.
+
+        Аргументы:
+            name:   Логин аккаунта.
+
+        Возвращаемое значение:
+            [
+                ID пользователей, чей статус сообщений был изменён,
+                Версия до отметки,
+                Версия после отметки.
+            ].
+        """
+        account_id = self.user_id(name)
+
+        if account_id is None:
+            return ([], 0, 0)
+
+        st_changed = {}
+        previous_versions = []
+        versions = []
+
+        for shard in self.__shards:
+            changed, previous_version, version = \
+                self.__enlist(shard).__mark_file_received(account_id)
+            st_changed.update(dict.fromkeys(changed))
+            previous_versions.append(previous_version)
+            versions.append(version)
+
+        return (
+            list(st_changed),
+            self.__compose_version(previous_versions),
+            self.__compose_version(versions)
+        )
+
+    def __mark_file_received(self, account_id: int) -> (list, int, int):
+        """Отмечает полученными новые сообщения в этом файле.
+
+        Возвращаемое значение: Как у mark_received(), версии этого файла.
+        """
+        with self.transaction():
+            previous_version = self.__file_version()
+            st_changed = [peer[0] for peer in self.sql("""
+                SELECT peer FROM conversations \
+                WHERE user = ? AND delivered_id < inbound_id \
+                ORDER BY inbound_id;
+            """, [account_id])]
+
+            if len(st_changed) > 0:
+                self.sql("""
+                    UPDATE conversations \
+                    SET delivered_id = inbound_id, version = ? \
+                    WHERE user = ? AND delivered_id < inbound_id;
+                """, [previous_version + 1, account_id])
+
+            return (st_changed, previous_version, self.__file_version())
+
+    def read_account_changes(
+        self,
+        name: str,
+        since: int,
+        history: bool = True
+    ) -> (tuple, int):
+        """Получает сообщения аккаунта, изменённые после версии since.
+
+        Сообщения и версия читаются из одного состояния базы данных, поэтому
+        изменения, сделанные после чтения, попадут в следующую
+        синхронизацию. Аргументы такие же, как у get_account_changes().
+
+        Возвращаемое значение:
+            [
+                [
+                    Новые отправленные сообщения,
+                    Новые полученные сообщения,
+                    Логины собеседников,
+                    Изменённые статусы [ID получателя, ID последнего
+                        полученного, ID последнего прочитанного сообщения].
+                ],
+                Текущая версия.
+            ].
+        """
+        account_id = self.user_id(name)
+
+        if account_id is None:
+            return ()
+
+        peers_only = not since and not history
+        sinces = self.__split_version(since) if since else \
+            [-1] * len(self.__shards)
+        versions = []
+        sended = []
+        received = []
+        peers = []
+        receipts = []
+
+        for shard, shard_since in zip(self.__shards, sinces):
+            changes = shard.__read_file_changes(
+                account_id,
+                shard_since,
+                peers_only
+            )
+            versions.append(changes[0])
+            sended += changes[1]
+            received += changes[2]
+            peers += changes[3]
+            receipts += changes[4]
+
+        if len(self.__shards) > 1:
+            sended.sort()
+            received.sort()
+
+        usernames = dict.fromkeys(peer[0] for peer in peers)
+        usernames.update(dict.fromkeys(smsg[3] for smsg in sended))
+        usernames.update(dict.fromkeys(rmsg[1] for rmsg in received))
+        usernames_logins = self.user_names(list(usernames))
+
+        return (
+            (sended, received, usernames_logins, receipts),
+            self.__compose_version(versions)
+        )
+
+    def __read_file_changes(
+        self,
+        account_id: int,
+        since: int,
+        peers_only: bool
+    ) -> (int, list, list, list, list):
+        """Читает изменения аккаунта из этого файла.
+
+        Возвращаемое значение: Версия файла, отправленные и полученные
+            сообщения, собеседники (если peers_only) и изменённые границы
+            получения и прочтения отправленных сообщений.
+        """
+        with self.snapshot() as read:
+            version = self.__file_version(read)
+
+            if peers_only:
+                return (version, [], [], read("""
+                    SELECT peer FROM conversations WHERE user = ?;
+                """, [account_id]), [])
+
+            sended = read(f"""
+                {MESSAGE_SELECT} \
+                WHERE m.sender = ? AND m.version > ? ORDER BY m.id;
+            """, [account_id, since])
+            received = read(f"""
+                {MESSAGE_SELECT} \
+                WHERE m.receiver = ? AND m.version > ? ORDER BY m.id;
+            """, [account_id, since])
+            receipts = []
+
+            # При полной синхронизации статус уже есть в сообщениях
+            if since >= 0:
+                receipts = read("""
+                    SELECT user, delivered_id, read_id FROM conversations \
+                    WHERE peer = ? AND version > ?;
+                """, [account_id, since])
+
+        return (version, sended, received, [], receipts)
+
+    def get_conversation(
+        self,
+        name: str,
+        peer_id: int,
+        before_id=None,
+        limit: int = CONVERSATION_PAGE
+    ):
+        """Получает страницу переписки с пользователем.
+
+        Аргументы:
+            name:       Логин аккаунта.
+            peer_id:    ID собеседника.
+            before_id:  Вернуть сообщения с ID меньше этого. Если None,
+                            возвращаются самые новые сообщения.
+            limit:      Максимальное количество сообщений (не больше
+                            CONVERSATION_PAGE_MAX).
+
+        Возвращаемое значение:
+            False:  Аккаунт не найден или аргументы не целые числа.
+            [
+                Сообщения по возрастанию ID,
+                Есть ли более старые сообщения.
+            ].
+        """
+        if not is_integer(peer_id, 1, MAX_MESSAGE_ID) or \
+                not is_integer(limit, 1, MAX_MESSAGE_ID) or \
+                before_id is not None and \
+                not is_integer(before_id, 1, MAX_MESSAGE_ID):
+            return False
+
+        account_id = self.user_id(name)
+
+        if account_id is None:
+            return False
+
+        limit = min(limit, CONVERSATION_PAGE_MAX)
+
+        if before_id is None:
+            before_id = MAX_MESSAGE_ID
+
+        # Каждая половина UNION читает индекс (sender, receiver, id) с конца
+        messages = self.__shard(account_id, peer_id)[1].read(f"""
+            SELECT * FROM (\
+                {MESSAGE_SELECT} \
+                WHERE m.sender = ? AND m.receiver = ? AND m.id < ? \
+                ORDER BY m.id DESC LIMIT ?\
+            ) UNION ALL SELECT * FROM (\
+                {MESSAGE_SELECT} \
+                WHERE m.sender = ? AND m.receiver = ? AND m.id < ? \
+                ORDER BY m.id DESC LIMIT ?\
+            ) ORDER BY 1 DESC LIMIT ?;
+        """, [
+            account_id, peer_id, before_id, limit + 1,
+            peer_id, account_id, before_id, limit + 1,
+            limit + 1
+        ])
+
+        return [messages[:limit][::-1], len(messages) > limit]
+
+    def get_conversations(self, name: str):
+        """Получает список переписок аккаунта.
+
+        Список хранится в таблице conversations и обновляется при отправке
+        сообщений, поэтому не зависит от количества сообщений.
+
+        Аргументы:
+            name:   Логин аккаунта.
+
+        Возвращаемое значение:
+            False:  Аккаунт не найден.
+            [
+                Переписки [ID собеседника, ID последнего сообщения, время
+                    последнего сообщения, количество непрочитанных] от
+                    новых к старым,
+                Логины собеседников.
+            ].
+        """
+        account_id = self.user_id(name)
+
+        if account_id is None:
+            return False
+
+        conversations = []
+
+        for shard in self.__shards:
+            conversations += shard.read("""
+                SELECT peer, last_id, last_time, unread \
+                FROM conversations WHERE user = ?;
+            """, [account_id])
+
+        conversations.sort(key=lambda conversation: -conversation[1])
+        peers = [conversation[0] for conversation in conversations]
+        return [conversations, self.user_names(peers)]
+
+    def mark_read(self, name: str, peer_id: int, up_to_id: int):
+        """Отмечает прочитанными сообщения собеседника до up_to_id.
+
+        Статус хранится одной границей на переписку, поэтому отметка
+        изменяет одну строку conversations независимо от количества
+        сообщений.
+
+        Аргументы:
+            name:       Логин аккаунта.
+            peer_id:    ID собеседника.
+            up_to_id:   ID последнего прочитанного сообщения.
+
+        Возвращаемое значение:
+            False:  Аккаунт или переписка не найдены, или сообщения уже
+                        были прочитаны.
+            int:    Новая граница прочтения.
+        """
+        account_id = self.user_id(name)
+
+        if account_id is None:
+            return False
+
+        shard = self.__shard(account_id, peer_id)[1]
+
+        with shard.transaction():
+            bounds = shard.sql("""
+                SELECT inbound_id, read_id FROM conversations \
+                WHERE user = ? AND peer = ?;
+            """, [account_id, peer_id])
+
+            if not bounds:
+                return False
+
+            read_id = min(int(up_to_id), bounds[0][0])
+
+            if read_id <= bounds[0][1]:
+                return False
+
+            shard.sql("""
+                UPDATE conversations SET \
+                read_id = ?, \
+                delivered_id = MAX(delivered_id, ?), \
+                unread = (\
+                    SELECT COUNT(*) FROM direct_messages \
+                    WHERE sender = ? AND receiver = ? AND id > ?\
+                ), \
+                version = ? \
+                WHERE user = ? AND peer = ?;
+            """, [
+                read_id, read_id, peer_id, account_id, read_id,
+                shard.__file_version() + 1, account_id, peer_id
+            ])
+
+        return read_id
+
+    def send_message(self, login: str, receiver: int, message: str):
+        """Создаёт запись в базе данных о сообщении.
+
+        Все сообщения получателя отправителю при этом отмечаются
+        прочитанными.
+
+        Аргументы:
+            login:      Логин отправителя.
+            receiver:   ID получателя.
+            message:    Текст сообщения.
+
+        Возвращаемое значение:
+            False:  Отправитель или получатель не найден.
+            list:   Созданное сообщение [id, sender, content, receiver, read].
+        """
+        sender_id = self.user_id(login)
+
+        if sender_id is None:
+            return False
+
+        if receiver not in self.user_names([receiver]):
+            return False
+
+        index, shard = self.__shard(sender_id, receiver)
+
+        with shard.transaction():
+            version = shard.__file_version() + 1
+            message_id = None
+
+            if len(self.__shards) > 1:
+                # ID в файле номер index равны index + 1 + k * количество
+                # файлов, поэтому не повторяются в других файлах
+                message_id = shard.sql("""
+                    SELECT COALESCE(MAX(id), ?) FROM direct_messages;
+                """, [index + 1 - len(self.__shards)])[0][0] + \
+                    len(self.__shards)
+
+            shard.sql("""
+                INSERT INTO direct_messages \
+                (id, sender, receiver, content, version) \
+                VALUES (?, ?, ?, ?, ?);
+            """, [message_id, sender_id, receiver, message, version])
+            message_id = shard.sql("SELECT last_insert_rowid();")[0][0]
+
+            # Отвечая, отправитель прочитал все сообщения получателя
+            shard.sql("""
+                INSERT INTO conversations \
+                (user, peer, last_id, last_time, unread, inbound_id) \
+                VALUES (?, ?, ?, ?, 1, ?) \
+                ON CONFLICT (user, peer) DO UPDATE SET \
+                last_id = excluded.last_id, \
+                last_time = excluded.last_time, \
+                unread = unread + 1, \
+                inbound_id = excluded.inbound_id;
+                INSERT INTO conversations \
+                (user, peer, last_id, last_time, unread) \
+                VALUES (?, ?, ?, ?, 0) \
+                ON CONFLICT (user, peer) DO UPDATE SET \
+                last_id = excluded.last_id, \
+                last_time = excluded.last_time, \
+                unread = 0, \
+                delivered_id = inbound_id, \
+                read_id = inbound_id, \
+                version = CASE WHEN read_id < inbound_id \
+                THEN ? ELSE version END;
+            """, [
+                receiver, sender_id, message_id, int(time()), message_id,
+                sender_id, receiver, message_id, int(time()), version
+            ])
+
+        return [message_id, sender_id, message, receiver, 0]
+
+    def find_user(self, username: str):
+        """Ищет пользователя по username.
+
+        Аргументы:
+            username:   Имя пользователя.
+
+        Возвращаемое значение:
+            False:          Пользователь не найден.
+            list[int, str]: ID пользователя и его имя.
+        """
+        user_id = self.user_id(username)
+
+        if user_id is None:
+            return False
+
+        return [user_id, username]
+
+    def set_trace(self, callback) -> None:
+        """Включает трассировку выполняемых SQL запросов.
+
+        Аргументы:
+            callback:   Функция, принимающая текст запроса с подставленными
+                            значениями, или None, чтобы выключить трассировку.
+        """
+        for database in self.__databases:
+            for con in [database.__con] + database.__reader_connections:
+                con.set_trace_callback(callback)
+
+    def vacuum(self) -> None:
+        """Сжимает файлы базы данных.
+
+        Файлы обрабатываются по одному, поэтому запись в остальные файлы
+        сообщений в это время не блокируется.
+        """
+        for database in self.__databases:
+            database.sql("VACUUM;")
+
+    def backup(self, filepath: str) -> list:
+        """Копирует базу данных в filepath.
+
+        Файлы сообщений копируются по одному в shard_path(filepath, номер).
+
+        Аргументы:
+            filepath:   Путь к копии файла пользователей.
+
+        Возвращаемое значение: Пути к созданным файлам.
+        """
+        paths = [filepath] + [
+            self.shard_path(filepath, index)
+            for index in range(len(self.__databases) - 1)
+        ]
+
+        for database, target_path in zip(self.__databases, paths):
+            target = connect(target_path)
+
+            try:
+                with database.__lock:
+                    database.__con.backup(target)
+            finally:
+                target.close()
+
+        return paths
+
+    def close(self) -> None:
+        """Закрывает базу данных."""
+        for database in self.__databases:
+            for con in database.__reader_connections:
+                con.close()
+
+            database.__con.close()
+
+
+class GroupCommitWriter:
+    """Поток записи, объединяющий изменения многих клиентов в транзакции.
+
+    Операции собираются в пакет в течение interval секунд или пока их не
+    станет max_batch, затем выполняются в одной транзакции. Future каждой
+    операции завершается только после сохранения всего пакета.
+
+    Метрики:
+        group_commit.batches:       Количество сохранённых пакетов.
+        group_commit.operations:    Количество выполненных операций.
+        group_commit.commit:        Время выполнения и сохранения пакета.
+    """
+
+    def __init__(
+        self,
+        database: Database,
+        interval: float = 0,
+        max_batch: int = GROUP_COMMIT_SIZE
+    ) -> None:
+        """Инициализация потока записи.
+
+        Аргументы:
+            database:   База данных.
+            interval:   Сколько секунд собирать пакет. Если 0, операции
+                            выполняются сразу в вызывающем потоке.
+            max_batch:  Максимальное количество операций в пакете.
+        """
+        self.__database = database
+        self.__interval = interval
+        self.__max_batch = max_batch
+        self.__queue = SimpleQueue()
+        self.__thread = None
+
+        if interval > 0:
+            self.__thread = Thread(target=self.__run, daemon=True)
+            self.__thread.start()
+
+    def submit(self, func, *args) -> Future:
+        """Добавляет операцию записи в очередь.
+
+        Аргументы:
+            func:   Функция, изменяющая базу данных.
+            *args:  Аргументы func.
+
+        Возвращаемое значение: Future с результатом func.
+        """
+        future = Future()
+
+        if self.__thread is None:
+            try:
+                future.set_result(func(*args))
+            except Exception as exc:
+                future.set_exception(exc)
+
+            return future
+
+        self.__queue.put((func, args, future, tracer.defer(), perf_counter()))
+        return future
+
+    def __run(self) -> None:
+        """Собирает операции в пакеты и сохраняет их."""
+        while True:
+            item = self.__queue.get()
+
+            if item is None:
+                return
+
+            batch = [item]
+            deadline = perf_counter() + self.__interval
+
+            while len(batch) < self.__max_batch:
+                timeout = deadline - perf_counter()
+
+                if timeout <= 0:
+                    break
+
+                try:
+                    item = self.__queue.get(timeout=timeout)
+                except Empty:
+                    break
+
+                if item is None:
+                    self.__commit(batch)
+                    return
+
+                batch.append(item)
+
+            self.__commit(batch)
+
+    def __commit(self, batch: list) -> None:
+        """Выполняет пакет операций в одной транзакции."""
+        started = perf_counter()
+        results = []
+
+        for _, _, _, trace, submitted in batch:
+            if trace is not None:
+                trace.add("group_commit.queue", started - submitted)
+
+        try:
+            with self.__database.transaction():
+                for func, args, _, trace, _ in batch:
+                    with tracer.activate(trace):
+                        results.append(self.__apply(func, args))
+        except Exception as exc:
+            for _, _, future, trace, _ in batch:
+                with tracer.resume(trace):
+                    future.set_exception(exc)
+
+            return
+
+        elapsed = perf_counter() - started
+        metrics.observe("group_commit.commit", elapsed)
+        metrics.inc("group_commit.batches")
+        metrics.inc("group_commit.operations", len(batch))
+
+        for (_, _, future, trace, _), (success, value) in zip(batch, results):
+            with tracer.resume(trace):
+                if trace is not None:
+                    trace.add("group_commit", elapsed)
+
+                if success:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+    def __apply(self, func, args) -> tuple:
+        """Выполняет одну операцию так, чтобы её ошибка не отменила пакет.
+
+        Возвращаемое значение: Успешна ли операция и её результат или ошибка.
+        """
+        try:
+            with self.__database.savepoint():
+                result = func(*args)
+        except Exception as exc:
+            return (False, exc)
+
+        return (True, result)
+
+    def close(self) -> None:
+        """Сохраняет оставшиеся операции и останавливает поток."""
+        if self.__thread is not None:
+            self.__queue.put(None)
+            self.__thread.join()
+            self.__thread = None
+
+
+class SessionRegistry:
+    """Реестр подключённых клиентов.
+
+    Клиенты хранятся в словарях по адресу, ID и логину, поэтому поиск
+    получателя не зависит от количества подключавшихся клиентов. У одного
+    пользователя может быть несколько сессий.
+
+    Время отключения хранится в колесе таймеров: клиент лежит в корзине
+    такта, в котором истечёт его время ожидания. Пакет от клиента переносит
+    его в другую корзину, а expire() просматривает только наступившие такты.
+    """
+
+    def __init__(
+        self,
+        timeout: float = IDLE_MAX_TIME,
+        resolution: float = IDLE_SLEEP_TIME
+    ) -> None:
+        """Инициализация реестра.
+
+        Аргументы:
+            timeout:    Через сколько секунд без пакетов отключать клиента.
+            resolution: Длительность такта колеса таймеров в секундах.
+        """
+        self.__lock = Lock()
+        self.__by_addr = {}
+        self.__by_id = {}
+        self.__by_login = {}
+        self.__timeout = timeout
+        self.__resolution = resolution
+        self.__wheel = {}
+        self.__ticks = {}
+        self.__next_tick = int(time() // resolution)
+
+    def __len__(self) -> int:
+        """Возвращает количество подключённых клиентов."""
+        return len(self.__by_addr)
+
+    def __contains__(self, addr) -> bool:
+        """Проверяет, подключён ли клиент с адресом addr."""
+        return addr in self.__by_addr
+
+    def add(self, client, last_seen: float) -> None:
+        """Добавляет клиента, заменяя прежнего клиента с тем же адресом.
+
+        Аргументы:
+            client:     Клиент.
+            last_seen:  Время последнего пакета от клиента.
+        """
+        with self.__lock:
+            old = self.__by_addr.get(client.addr)
+
+            if old is not None:
+                self.__unschedule(old.addr)
+                self.__unindex(old)
+
+            self.__by_addr[client.addr] = client
+            self.__schedule(client, last_seen)
+
+    def get(self, addr):
+        """Возвращает клиента по адресу или None."""
+        return self.__by_addr.get(addr)
+
+    def touch(self, client) -> None:
+        """Обновляет время последнего пакета, если клиент подключён."""
+        with self.__lock:
+            if self.__by_addr.get(client.addr) is client:
+                self.__schedule(client, time())
+
+    def __schedule(self, client, last_seen: float) -> None:
+        """Переносит клиента в корзину такта, когда истечёт его время."""
+        tick = max(
+            ceil((last_seen + self.__timeout) / self.__resolution),
+            self.__next_tick
+        )
+        if self.__ticks.get(client.addr) == tick:
+            return
+
+        self.__unschedule(client.addr)
+        self.__wheel.setdefault(tick, {})[client.addr] = client
+        self.__ticks[client.addr] = tick
+
+    def __unschedule(self, addr) -> None:
+        """Удаляет клиента из колеса таймеров, если он там есть."""
+        tick = self.__ticks.pop(addr, None)
+
+        if tick is None:
+            return
+
+        bucket = self.__wheel[tick]
+        del bucket[addr]
+
+        if len(bucket) == 0:
+            del self.__wheel[tick]
+
+    def authenticate(self, client, id_: int, login) -> None:
+        """Запоминает, в какой аккаунт вошёл клиент.
+
+        Аргументы:
+            client: Клиент.
+            id_:    ID аккаунта.
+            login:  Логин аккаунта или None, если вход не завершён.
+        """
+        with self.__lock:
+            registered = self.__by_addr.get(client.addr) is client
+
+            if registered:
+                self.__unindex(client)
+
+            client.id_ = id_
+            client.login = login
+
+            if registered:
+                self.__index(self.__by_id, id_, client)
+                self.__index(self.__by_login, login, client)
+
+    def by_id(self, id_: int) -> list:
+        """Возвращает клиентов, вошедших в аккаунт с ID id_."""
+        with self.__lock:
+            return list(self.__by_id.get(id_, {}).values())
+
+    def by_login(self, login: str) -> list:
+        """Возвращает клиентов, вошедших в аккаунт с логином login."""
+        with self.__lock:
+            return list(self.__by_login.get(login, {}).values())
+
+    def remove(self, client) -> None:
+        """Удаляет клиента из реестра."""
+        with self.__lock:
+            if self.__by_addr.get(client.addr) is client:
+                del self.__by_addr[client.addr]
+                self.__unschedule(client.addr)
+                self.__unindex(client)
+
+    def expire(self, now: float) -> list:
+        """Возвращает клиентов, время ожидания которых истекло к now.
+
+        Клиенты остаются в реестре до вызова remove().
+
+        Аргументы:
+            now:    Текущее время.
+
+        Возвращаемое значение: Клиенты, которых нужно отключить.
+        """
+        expired = []
+        current = int(now // self.__resolution)
+
+        with self.__lock:
+            while self.__next_tick <= current:
+                bucket = self.__wheel.pop(self.__next_tick, None)
+                self.__next_tick += 1
+
+                if bucket is None:
+                    continue
+
+                for addr, client in bucket.items():
+                    del self.__ticks[addr]
+                    expired.append(client)
+
+        return expired
+
+    @staticmethod
+    def __index(index: dict, key, client) -> None:
+        """Добавляет клиента в индекс по ключу key."""
+        if key is not None:
+            index.setdefault(key, {})[client.addr] = client
+
+    def __unindex(self, client) -> None:
+        """Удаляет клиента из индексов по ID и логину."""
+        for index, key in (
+            (self.__by_id, client.id_),
+            (self.__by_login, client.login)
+        ):
+            sessions = index.get(key)
+
+            if sessions is not None and \
+                    sessions.get(client.addr) is client:
+                del sessions[client.addr]
+
+                if len(sessions) == 0:
+                    del index[key]
+
+
+class WorkerBus:
+    """Канал событий между процессами сервера.
+
+    Каждый процесс слушает свой UNIX сокет в общей папке и отправляет
+    события сокетам остальных процессов. Ядро распределяет клиентов по
+    процессам через SO_REUSEPORT, поэтому получатель сообщения может быть
+    подключён к другому процессу.
+    """
+
+    def __init__(self, directory: str, index: int, count: int) -> None:
+        """Инициализация канала.
+
+        Аргументы:
+            directory:  Папка с сокетами процессов.
+            index:      Номер текущего процесса.
+            count:      Количество процессов.
+        """
+        self.__peers = [
+            self.path(directory, i) for i in range(count) if i != index
+        ]
+        self.__sock = socket(AF_UNIX, SOCK_DGRAM)
+        # Событие с длинным сообщением не помещается в буфер по умолчанию
+        self.__sock.setsockopt(SOL_SOCKET, SO_SNDBUF, WORKER_BUS_BUFFER)
+        self.__sock.setsockopt(SOL_SOCKET, SO_RCVBUF, WORKER_BUS_BUFFER)
+        self.__sock.bind(self.path(directory, index))
+        self.__thread = None
+
+    @staticmethod
+    def path(directory: str, index: int) -> str:
+        """Возвращает путь к сокету процесса index."""
+        return path.join(directory, f"worker{index}.sock")
+
+    def publish(self, event: list) -> None:
+        """Отправляет событие остальным процессам.
+
+        Аргументы:
+            event:  Событие, преобразуемое в JSON.
+        """
+        data = dumps(event, separators=(",", ":"), ensure_ascii=False)
+
+        for peer in self.__peers:
+            try:
+                self.__sock.sendto(data.encode("utf8"), peer)
+            except OSError as exc:
+                # Процесс ещё не запущен или уже завершён
+                logger.warning("Событие не доставлено %s: %s", peer, exc)
+
+    def start(self, handler) -> None:
+        """Запускает поток, передающий полученные события в handler."""
+        self.__thread = Thread(target=self.__run, args=(handler,), daemon=True)
+        self.__thread.start()
+
+    def __run(self, handler) -> None:
+        """Получает события от других процессов."""
+        while True:
+            try:
+                data = self.__sock.recv(WORKER_BUS_BUFFER)
+            except OSError:
+                return
+
+            try:
+                handler(loads(data))
+            except Exception:
+                logger.exception("Ошибка обработки события")
+
+    def close(self) -> None:
+        """Закрывает сокет канала."""
+        self.__sock.close()
+
+
+class NetworkedClient:
+    """Класс клиента."""
+
+    FAST_COMMANDS = ("client_alive", "disconnect")
+    SLOW_COMMANDS = ("register", "login")
+    PROTECTED_COMMANDS = (
+        "get_account_data",
+        "sync",
+        "get_conversation",
+        "get_conversations",
+        "mark_read",
+        "send_message",
+        "find_user"
+    )
+
+    def __init__(
+        self,
+        sock: socket,
+        addr,
+        key: str,
+        capabilities=()
+    ) -> None:
+        self.sock: socket = sock
+        self.addr = addr
+        self.capabilities = frozenset(capabilities)
+        self.login = None
+        self.id_ = None
+        self.__password = None
+        self.__key = key
+        self.__aes = acrypt(KEY_EXTRA + self.__key)
+        self.__binary_aes = agcm(KEY_EXTRA + self.__key, agcm.SERVER) \
+            if wire.GCM in self.capabilities else self.__aes
+        self.__dictionary = wire.PRESET_DICTIONARY \
+            if wire.ZDICT in self.capabilities else None
+        self.__fragmenter = Fragmenter()
+        self.__reassembler = Reassembler()
+        self.__channel = None
+        self.__send_lock = Lock()
+        self.__traces = {}
+        self.sync_version = None
+
+    def __encode_message(self, message) -> bytes:
+        """Превращает объекты, преобразоваемые в JSON в байты."""
+        if wire.BINARY in self.capabilities:
+            data = wire.encode(message)
+
+            if wire.ZLIB in self.capabilities and \
+                    len(data) > wire.COMPRESSION_THRESHOLD:
+                compressed = self.__compress(data)
+
+                if len(compressed) < len(data):
+                    with metrics.timer("crypto.encrypt"):
+                        return wire.COMPRESSED_MAGIC + \
+                            self.__binary_aes.encrypt_bytes(compressed)
+
+            with metrics.timer("crypto.encrypt"):
+                return wire.BINARY_MAGIC + \
+                    self.__binary_aes.encrypt_bytes(data)
+
+        text = dumps(message, separators=(",", ":"), ensure_ascii=False)
+
+        with metrics.timer("crypto.encrypt"):
+            return self.__aes.encrypt(text)
+
+    def __compress(self, data: bytes) -> bytes:
+        """Сжимает пакет и записывает степень сжатия и затраченное время."""
+        started = perf_counter()
+        compressed = wire.compress(data, self.__dictionary)
+        metrics.observe("compression.time", perf_counter() - started)
+        metrics.inc("compression.packets")
+        metrics.inc("compression.bytes_in", len(data))
+        metrics.inc("compression.bytes_out", min(len(compressed), len(data)))
+        return compressed
+
+    def __decode_message(self, message: bytes):
+        """Превращает байты в объекты, преобразоваемые в JSON."""
+        if wire.is_compressed(message):
+            with metrics.timer("crypto.decrypt"):
+                data = self.__binary_aes.decrypt_bytes(
+                    message[len(wire.COMPRESSED_MAGIC):]
+                )
+
+            return wire.decode(wire.decompress(
+                data,
+                self.__dictionary,
+                self.__reassembler.max_bytes
+            ))
+
+        if wire.is_binary(message):
+            with metrics.timer("crypto.decrypt"):
+                data = self.__binary_aes.decrypt_bytes(
+                    message[len(wire.BINARY_MAGIC):]
+                )
+
+            return wire.decode(data)
+
+        with metrics.timer("crypto.decrypt"):
+            text = self.__aes.decrypt(message)
+
+        return loads(text)
+
+    def send(self, message: list) -> None:
+        """Отправляет сообщение клиенту.
+
+        Аргументы:
+            message:    Сообщение.
+        """
+        log.trace(sampler, "Отправлено клиенту", message)
+
+        with tracer.span("encode"):
+            encoded = self.__encode_message(message)
+
+        packets = self.__fragmenter.split(encoded)
+
+        if self.__channel is not None:
+            now = monotonic()
+
+            try:
+                packets = [
+                    packet
+                    for fragment in packets
+                    for packet in self.__channel.send(fragment, now)
+                ]
+            except ValueError as exc:
+                # Клиент не подтверждает пакеты, поэтому сессия закрывается
+                metrics.inc("net.send_overflow")
+                logger.warning("Клиент %s отключён: %s", self.addr, exc)
+                self.close()
+                return
+
+            unacked_clients.add(self)
+
+        self.__transmit(packets)
+
+    def __transmit(self, packets: list) -> None:
+        """Отправляет готовые пакеты клиенту."""
+        with self.__send_lock, tracer.span("sendto"):
+            for packet in packets:
+                self.sock.sendto(packet, self.addr)
+
+        metrics.inc("net.packets_out", len(packets))
+        metrics.inc("net.bytes_out", sum(len(packet) for packet in packets))
+
+    def retransmit(self, now: float) -> bool:
+        """Повторно отправляет пакеты, подтверждение которых не пришло.
+
+        Аргументы:
+            now:    Текущее время (time.monotonic()).
+
+        Возвращаемое значение: Остались ли неподтверждённые пакеты.
+        """
+        if self.__channel is None:
+            return False
+
+        self.__transmit(self.__channel.poll(now))
+        return self.__channel.has_unacked()
+
+    def send_account_data(self) -> None:
+        """Отправляет данные об аккаунте.
+
+        Клиенту, который уже синхронизировался командой sync, отправляются
+        только изменения.
+        """
+        if self.login is None:
+            return
+
+        if self.sync_version is not None:
+            self.send_sync(self.sync_version)
+            return
+
+        self.__load_changes(
+            0,
+            True,
+            lambda adata: self.send(["account_data", adata[0]])
+        )
+
+    def send_sync(self, since: int, history: bool = True) -> None:
+        """Отправляет сообщения, изменённые после версии since.
+
+        Аргументы:
+            since:      Последняя версия, известная клиенту. Если 0,
+                            отправляются все сообщения.
+            history:    Если False и since равен 0, отправляются только
+                            собеседники.
+        """
+        self.__load_changes(
+            since,
+            history,
+            lambda adata: self.__synced(since, adata)
+        )
+
+    def __synced(self, since: int, adata: tuple) -> None:
+        """Отправляет изменения после команды sync.
+
+        Аргументы:
+            since:  Версия из запроса.
+            adata:  Результат Database.get_account_changes().
+        """
+        self.sync_version = adata[2]
+        self.send(["sync_data", not since, adata[2], adata[0]])
+
+    def __load_changes(self, since: int, history: bool, callback) -> None:
+        """Получает изменения аккаунта и отмечает новые сообщения полученными.
+
+        Сообщения читаются сразу через соединение для чтения, а отметка о
+        получении сохраняется через writer. callback вызывается после
+        сохранения отметки.
+
+        Аргументы:
+            since:      Последняя версия, известная клиенту.
+            history:    Отправлять ли сообщения при since равном 0.
+            callback:   Функция, принимающая результат как у
+                            Database.get_account_changes().
+        """
+        changes = dtb.read_account_changes(self.login, since, history)
+
+        if not changes:
+            return
+
+        def marked(future: Future) -> None:
+            if future.exception() is not None:
+                logger.error("Ошибка записи: %s", future.exception())
+                return
+
+            adata = dtb.merge_received(changes, future.result())
+            callback(adata)
+            self.__notify_status_changed(adata[1])
+
+        writer.submit(dtb.mark_received, self.login).add_done_callback(marked)
+
+    def __message_saved(self, receiver, future: Future) -> None:
+        """Отправляет изменения участникам, когда сообщение сохранено.
+
+        Аргументы:
+            receiver:   ID получателя из запроса.
+            future:     Результат Database.send_message().
+        """
+        if future.exception() is not None:
+            logger.error("Ошибка записи: %s", future.exception())
+            return
+
+        message = future.result()
+
+        if self.sync_version is None:
+            self.send_account_data()
+        else:
+            self.send(["message_ack", message])
+
+        if not message:
+            return
+
+        publish_event(["new_message", receiver, message, self.login])
+
+    def push_message(self, message: list, sender_login: str) -> None:
+        """Отправляет клиенту новое сообщение и отмечает его полученным.
+
+        Клиентам, которые не используют команду sync, отправляются все
+        данные аккаунта.
+
+        Аргументы:
+            message:        Сообщение [id, sender, content, receiver, read].
+            sender_login:   Логин отправителя.
+        """
+        if self.sync_version is None:
+            self.send_account_data()
+            return
+
+        self.send(["new_message", message, {message[1]: sender_login}])
+
+        def marked(future: Future) -> None:
+            if future.exception() is not None:
+                logger.error("Ошибка записи: %s", future.exception())
+                return
+
+            self.__notify_status_changed(future.result()[0])
+
+        writer.submit(dtb.mark_received, self.login).add_done_callback(marked)
+
+    def push_status(
+        self,
+        peer_id: int,
+        status: int,
+        up_to_id: int = None
+    ) -> None:
+        """Сообщает клиенту, что его сообщения пользователю получены.
+
+        Аргументы:
+            peer_id:    ID пользователя, получившего сообщения.
+            status:     Новый статус сообщений (1 - получено, 2 - прочитано).
+            up_to_id:   Статус изменён у сообщений с ID не больше этого. Если
+                            None, у всех сообщений.
+        """
+        if self.sync_version is None:
+            self.send_account_data()
+        elif up_to_id is None:
+            self.send(["message_status", peer_id, status])
+        else:
+            self.send(["message_status", peer_id, status, up_to_id])
+
+    def __read_marked(self, peer_id: int, future: Future) -> None:
+        """Сообщает собеседнику, что его сообщения прочитаны.
+
+        Аргументы:
+            peer_id:    ID собеседника из запроса.
+            future:     Результат Database.mark_read().
+        """
+        if future.exception() is not None:
+            logger.error("Ошибка записи: %s", future.exception())
+            return
+
+        read_id = future.result()
+
+        if read_id is not False:
+            publish_event(["message_status", peer_id, self.id_, 2, read_id])
+
+    def __notify_status_changed(self, receivers: list) -> None:
+        """Отправляет изменения пользователям, чьи сообщения были получены.
+
+        Аргументы:
+            receivers:  ID пользователей.
+        """
+        for receiver in receivers:
+            publish_event(["message_status", receiver, self.id_, 1])
+
+    def receive(self, jdata: bytes) -> bool:
+        """Получает сообщение от клиента.
+
+        Аргументы:
+            jdata:  Данные от клиента.
+
+        Возвращаемое значаени: Надо ли обновлять таймер сообщений?
+        """
+        results = [self.handle(data) for data in self.parse(jdata)]
+        return all(results)
+
+    def parse(self, jdata: bytes) -> list:
+        """Собирает и расшифровывает сообщения от клиента.
+
+        Если клиент использует надёжную доставку, отвечает подтверждением.
+        Для каждой команды начинается трассировка, которую продолжает
+        handle().
+
+        Аргументы:
+            jdata:  Данные, фрагмент или пакет надёжной доставки от клиента.
+
+        Возвращаемое значение: Команды клиента с аргументами, которые можно
+            обработать (пустой список, если получены ещё не все фрагменты).
+        """
+        started = perf_counter()
+
+        if is_reliable(jdata):
+            if self.__channel is None:
+                self.__channel = ReliableChannel()
+
+            payloads, replies = self.__channel.receive(jdata, monotonic())
+            self.__transmit(replies)
+        else:
+            payloads = [jdata]
+
+        requests = []
+
+        for payload in payloads:
+            payload = self.__reassembler.feed(payload)
+
+            if payload is not None:
+                decode_started = perf_counter()
+                request = self.__decode_message(payload)
+                requests.append(request)
+                trace = tracer.start(self.metric_name(request))
+
+                if trace is not None:
+                    decoded = perf_counter()
+                    trace.started = started
+                    trace.add("decode", decoded - decode_started)
+                    # Команда хранится вместе с трассировкой, чтобы её id()
+                    # не достался другому объекту до вызова handle()
+                    self.__traces[id(request)] = (request, trace, decoded)
+
+        return requests
+
+    def is_fast(self, data) -> bool:
+        """Можно ли обработать команду, не обращаясь к базе данных.
+
+        Аргументы:
+            data:   Расшифрованная команда клиента.
+
+        Возвращаемое значение: True, если команда не обращается к базе данных.
+        """
+        com = data[0]
+
+        if com in self.SLOW_COMMANDS:
+            return False
+
+        if com in self.FAST_COMMANDS:
+            return True
+
+        return self.login is None and self.__password is None
+
+    def handle(self, data) -> bool:
+        """Обрабатывает расшифрованное сообщение от клиента.
+
+        Время обработки записывается в гистограмму command.<команда>.
+        Команды, которые сохраняются через writer, измеряются до передачи
+        в writer, время записи - в group_commit.commit.
+
+        Трассировка команды из parse() (или новая) получает этапы wait
+        (ожидание обработки) и handle (обработка вместе с вложенными этапами
+        db, encode и sendto). Если включено профилирование этой команды,
+        обработка выполняется под cProfile.
+
+        Аргументы:
+            data:   Команда клиента и её аргументы.
+
+        Возвращаемое значаени: Надо ли обновлять таймер сообщений?
+        """
+        name = self.metric_name(data)
+        _, trace, decoded = self.__traces.pop(id(data), (None, None, None))
+
+        if trace is None:
+            trace = tracer.start(name)
+        else:
+            trace.add("wait", perf_counter() - decoded)
+
+        with tracer.resume(trace), tracer.profiled(name):
+            with metrics.timer(name), tracer.span("handle"):
+                return self.__handle(data)
+
+    @classmethod
+    def metric_name(cls, data) -> str:
+        """Возвращает имя метрики команды.
+
+        Неизвестные команды объединяются в command.other, чтобы клиент не
+        мог создать произвольное количество метрик.
+        """
+        com = data[0] if isinstance(data, list) and data else None
+
+        if com in cls.FAST_COMMANDS or com in cls.SLOW_COMMANDS or \
+                com in cls.PROTECTED_COMMANDS:
+            return f"command.{com}"
+
+        return "command.other"
+
+    def __handle(self, data) -> bool:
+        """Обрабатывает команду клиента, аргументы как у handle()."""
+        if data == ["client_alive"]:
+            return True
+
+        log.trace(sampler, "Получено от клиента", data)
+
+        com = data[0]
+        args = data[1:]
+
+        if com == "register":
+            result = dtb.reserve_account(*args[:2])
+
+            if isinstance(result, list):
+                hasher.submit(
+                    result[1],
+                    args[1],
+                    lambda hashed: self.__registered(args[:2], result, hashed)
+                )
+        elif com == "login":
+            result = dtb.find_account(*args[:2])
+
+            if isinstance(result, list):
+                hasher.submit(
+                    result[1],
+                    args[1],
+                    lambda hashed: self.__logged_in(args[:2], hashed)
+                )
+        elif com == "disconnect":
+            self.close()
+            return False
+        elif not (self.login is None and self.__password is None):
+            if com == "get_account_data":
+                self.send_account_data()
+            elif com == "sync":
+                self.send_sync(
+                    int(args[0] or 0) if args else 0,
+                    bool(args[1]) if len(args) > 1 else True
+                )
+            elif com == "get_conversation":
+                peer_id, before_id = (args + [None, None])[:2]
+                limit = args[2] if len(args) > 2 else CONVERSATION_PAGE
+                self.send([
+                    "conversation",
+                    peer_id,
+                    before_id,
+                    dtb.get_conversation(self.login, peer_id, before_id, limit)
+                ])
+            elif com == "get_conversations":
+                self.send([
+                    "conversations",
+                    dtb.get_conversations(self.login)
+                ])
+            elif com == "mark_read":
+                peer_id, up_to_id = args[:2]
+
+                writer.submit(
+                    dtb.mark_read,
+                    self.login,
+                    peer_id,
+                    up_to_id
+                ).add_done_callback(
+                    lambda future: self.__read_marked(peer_id, future)
+                )
+            elif com == "send_message":
+                msg = args[0][:65535]
+                receiver = args[1]
+
+                writer.submit(
+                    dtb.send_message,
+                    self.login,
+                    receiver,
+                    msg
+                ).add_done_callback(
+                    lambda future: self.__message_saved(receiver, future)
+                )
+            elif com == "find_user":
+                if args[0] == self.login:
+                    self.send(["find_user_result", False])
+                else:
+                    self.send(["find_user_result", dtb.find_user(args[0])])
+            else:
+                return False
+        elif com in self.PROTECTED_COMMANDS:
+            self.send(["not_logged"])
+            return False
+        else:
+            return False
+
+        return True
+
+    def __registered(self, credentials: list, result: list, hashed) -> None:
+        """Завершает регистрацию, когда хеш пароля вычислен.
+
+        Аргументы:
+            credentials:    Логин и пароль.
+            result:         Результат Database.reserve_account().
+            hashed:         Хеш пароля или None в случае ошибки.
+        """
+        if not dtb.finish_account(result[1], hashed):
+            self.send(["register_status", 5])  # ERR_SERVER
+            return
+
+        status = result[0]
+        self.__authenticate(status, result[1], credentials)
+        self.send(["register_status", status])
+
+    def __logged_in(self, credentials: list, hashed) -> None:
+        """Завершает вход, когда хеш пароля вычислен.
+
+        Аргументы:
+            credentials:    Логин и пароль.
+            hashed:         Хеш пароля или None в случае ошибки.
+        """
+        if hashed is None:
+            self.send(["login_status", 6])  # ERR_SERVER
+            return
+
+        result = dtb.check_password(credentials[0], hashed)
+
+        if isinstance(result, list):
+            status = result[0]
+            self.__authenticate(status, result[1], credentials)
+            self.send(["login_status", status])
+
+    def __authenticate(self, status: int, id_: int, credentials) -> None:
+        """Запоминает аккаунт клиента после регистрации или входа.
+
+        Аргументы:
+            status:         Статус регистрации или входа.
+            id_:            ID аккаунта.
+            credentials:    Логин и пароль.
+        """
+        if status == 0:
+            self.__password = credentials[1]
+            clients.authenticate(self, id_, credentials[0])
+        else:
+            clients.authenticate(self, id_, self.login)
+
+    def close(self) -> None:
+        """Закрывает соединение с клиентом."""
+        clients.remove(self)
+        unacked_clients.discard(self)
+
+
+started_at = monotonic()
+clients = SessionRegistry()
+unacked_clients = set()
+# База данных открывается в run_server() с параметрами командной строки:
+# при импорте количество шардов ещё неизвестно
+dtb = None
+hasher = PasswordHasher()
+writer = None
+bus = None
+sampler = PacketSampler()
+metrics.gauge("password_hash.queue_length", lambda: hasher.queue_length)
+metrics.gauge("clients.active", lambda: len(clients))
+metrics.gauge("clients.unacked", lambda: len(unacked_clients))
+metrics.gauge("server.uptime", lambda: monotonic() - started_at)
+metrics.gauge(
+    "compression.ratio",
+    lambda: metrics.counter("compression.bytes_out") / max(
+        metrics.counter("compression.bytes_in"),
+        1
+    )
+)
+
+
+def dispatch_event(event: list) -> None:
+    """Доставляет событие клиентам, подключённым к этому процессу.
+
+    Аргументы:
+        event:  ["new_message", ID получателя, сообщение, логин отправителя]
+            или ["message_status", ID получателя, ID собеседника, статус,
+            ID последнего сообщения с этим статусом (необязательно)].
+    """
+    if event[0] == "new_message":
+        for instance in clients.by_id(event[1]):
+            instance.push_message(event[2], event[3])
+    elif event[0] == "message_status":
+        for instance in clients.by_id(event[1]):
+            instance.push_status(*event[2:])
+
+
+def publish_event(event: list) -> None:
+    """Доставляет событие клиентам этого и остальных процессов сервера."""
+    dispatch_event(event)
+
+    if bus is not None:
+        bus.publish(event)
+
+
+def retransmit_lost() -> None:
+    """Повторно отправляет пакеты, подтверждение которых не пришло."""
+    now = monotonic()
+
+    for client in list(unacked_clients):
+        if not client.retransmit(now):
+            unacked_clients.discard(client)
+
+            # Клиент мог отправить новый пакет во время проверки
+            if client.retransmit(now):
+                unacked_clients.add(client)
+
+
+def close_idle_clients() -> None:
+    """Отключает клиентов, от которых давно не было сообщений."""
+    for client in clients.expire(time()):
+        client.close()
+
+
+def accept_client(sock, addr, data: bytes) -> None:
+    """Регистрирует нового клиента и отправляет ему ключ шифрования.
+
+    Аргументы:
+        sock:   Сокет или транспорт, через который отправляются ответы.
+        addr:   Адрес клиента.
+        data:   Первый пакет от клиента.
+    """
+    key = "".join(
+        [choice(ascii_letters + digits) for _ in range(64)]
+    )
+    requested = wire.parse_handshake(data)
+    capabilities = [
+        capability
+        for capability in requested or ()
+        if capability in CAPABILITIES
+    ]
+    clients.add(
+        NetworkedClient(sock, addr, key, capabilities),
+        time() - IDLE_MAX_TIME + 5
+    )
+
+    if requested is not None:
+        reply = wire.handshake_reply(key.encode("ascii"), capabilities)
+        sock.sendto(reply, addr)
+        metrics.inc("net.packets_out")
+        metrics.inc("net.bytes_out", len(reply))
+        log.trace(sampler, "Отправлено", reply)
+
+
+def serve_blocking(sock: socket) -> None:
+    """Обрабатывает пакеты по одному в блокирующем цикле.
+
+    Неактивные клиенты отключаются в этом же цикле между пакетами.
+
+    Аргументы:
+        sock:   Привязанный UDP сокет.
+    """
+    sock.settimeout(RETRANSMIT_INTERVAL)
+    next_reap = time() + IDLE_SLEEP_TIME
+    next_retransmit = time() + RETRANSMIT_INTERVAL
+
+    while True:
+        if time() >= next_reap:
+            close_idle_clients()
+            next_reap = time() + IDLE_SLEEP_TIME
+
+        if time() >= next_retransmit:
+            retransmit_lost()
+            next_retransmit = time() + RETRANSMIT_INTERVAL
+
+        try:
+            adrdata = sock.recvfrom(70000)
+        except (
+            SocketTimeout,
+            ConnectionResetError,
+            ConnectionAbortedError
+        ):
+            continue
+
+        data = adrdata[0]
+        addr = adrdata[1]
+        log.trace(sampler, "Получено", data)
+        metrics.inc("net.packets_in")
+        metrics.inc("net.bytes_in", len(data))
+
+        client = clients.get(addr)
+
+        if client is None:
+            accept_client(sock, addr, data)
+        else:
+            try:
+                if client.receive(data):
+                    clients.touch(client)
+            except Exception as exc:
+                client.close()
+                logger.warning("Ошибка пакета от %s: %r", addr, exc)
+
+
+class LoopSender:
+    """Потокобезопасная отправка пакетов через транспорт asyncio."""
+
+    def __init__(self, loop, transport) -> None:
+        """Инициализация отправителя.
+
+        Аргументы:
+            loop:       Цикл событий asyncio.
+            transport:  Транспорт DatagramProtocol.
+        """
+        self.__loop = loop
+        self.__transport = transport
+        self.__loop_thread = get_ident()
+
+    def sendto(self, data: bytes, addr) -> None:
+        """Отправляет пакет из любого потока.
+
+        Аргументы:
+            data:   Данные.
+            addr:   Адрес получателя.
+        """
+        if get_ident() == self.__loop_thread:
+            self.__transport.sendto(data, addr)
+        else:
+            self.__loop.call_soon_threadsafe(
+                self.__transport.sendto,
+                data,
+                addr
+            )
+
+
+class AsyncServerProtocol(DatagramProtocol):
+    """Асинхронный сервер на основе DatagramProtocol.
+
+    Команды, которым не нужна база данных (client_alive, disconnect, ответы
+    not_logged), обрабатываются сразу в цикле событий. Остальные команды
+    выполняются в отдельном потоке, при этом порядок команд одного клиента
+    сохраняется.
+    """
+
+    def __init__(self, loop, executor) -> None:
+        """Инициализация протокола.
+
+        Аргументы:
+            loop:       Цикл событий asyncio.
+            executor:   Пул потоков для медленных команд.
+        """
+        self.__loop = loop
+        self.__executor = executor
+        self.__sender = None
+        self.__queues = {}
+
+    def connection_made(self, transport) -> None:
+        """Обработчик создания транспорта."""
+        self.__sender = LoopSender(self.__loop, transport)
+        self.__loop.call_later(IDLE_SLEEP_TIME, self.__reap_idle)
+        self.__loop.call_later(RETRANSMIT_INTERVAL, self.__retransmit)
+
+    def __reap_idle(self) -> None:
+        """Периодически отключает неактивных клиентов."""
+        close_idle_clients()
+        self.__loop.call_later(IDLE_SLEEP_TIME, self.__reap_idle)
+
+    def __retransmit(self) -> None:
+        """Периодически повторяет неподтверждённые пакеты."""
+        retransmit_lost()
+        self.__loop.call_later(RETRANSMIT_INTERVAL, self.__retransmit)
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        """Обработчик входящего пакета."""
+        log.trace(sampler, "Получено", data)
+        metrics.inc("net.packets_in")
+        metrics.inc("net.bytes_in", len(data))
+
+        client = clients.get(addr)
+
+        if client is None:
+            accept_client(self.__sender, addr, data)
+            return
+
+        try:
+            requests = client.parse(data)
+        except Exception as exc:
+            client.close()
+            logger.warning("Ошибка пакета от %s: %r", addr, exc)
+            return
+
+        if len(requests) == 0:
+            clients.touch(client)
+
+        for request in requests:
+            self.__dispatch(addr, client, request)
+
+    def __dispatch(self, addr, client, request) -> None:
+        """Выполняет команду сразу или ставит её в очередь клиента.
+
+        Аргументы:
+            addr:       Адрес клиента.
+            client:     Клиент.
+            request:    Расшифрованная команда клиента.
+        """
+        try:
+            if request == ["client_alive"] or (
+                addr not in self.__queues and client.is_fast(request)
+            ):
+                if client.handle(request):
+                    clients.touch(client)
+
+                return
+        except Exception as exc:
+            client.close()
+            logger.warning("Ошибка пакета от %s: %r", addr, exc)
+            return
+
+        queue = self.__queues.get(addr)
+
+        if queue is None:
+            queue = self.__queues[addr] = deque()
+            self.__loop.create_task(self.__drain(addr, client, queue))
+
+        queue.append(request)
+
+    async def __drain(self, addr, client, queue) -> None:
+        """Выполняет медленные команды клиента по очереди.
+
+        Аргументы:
+            addr:   Адрес клиента.
+            client: Клиент.
+            queue:  Очередь расшифрованных команд клиента.
+        """
+        try:
+            while queue:
+                try:
+                    result = await self.__loop.run_in_executor(
+                        self.__executor,
+                        client.handle,
+                        queue[0]
+                    )
+                except Exception as exc:
+                    client.close()
+                    logger.warning("Ошибка пакета от %s: %r", addr, exc)
+                    break
+
+                queue.popleft()
+
+                if result:
+                    clients.touch(client)
+        finally:
+            del self.__queues[addr]
+
+
+def serve_asyncio(sock: socket, threads: int = 1) -> None:
+    """Обрабатывает пакеты в цикле событий asyncio.
+
+    Медленные команды выполняются в пуле потоков. Команды одного клиента
+    выполняются по очереди, команды разных клиентов - параллельно: чтение
+    идёт через отдельные соединения только для чтения, а запись - через
+    writer и блокировку пишущего соединения.
+
+    Аргументы:
+        sock:       Привязанный UDP сокет.
+        threads:    Количество потоков для медленных команд.
+    """
+    loop = new_event_loop()
+    executor = ThreadPoolExecutor(max_workers=threads)
+
+    try:
+        loop.run_until_complete(loop.create_datagram_endpoint(
+            lambda: AsyncServerProtocol(loop, executor),
+            sock=sock
+        ))
+        loop.run_forever()
+    finally:
+        # Очереди клиентов, ждущие пул потоков, отменяются до закрытия цикла
+        tasks = all_tasks(loop)
+
+        for task in tasks:
+            task.cancel()
+
+        loop.run_until_complete(gather(*tasks, return_exceptions=True))
+        executor.shutdown(wait=False)
+        loop.close()
+
+
+def stop(*_) -> None:
+    """Обработчик SIGTERM: завершает сервер так же, как Ctrl+C."""
+    raise KeyboardInterrupt
+
+
+def main(argv=None) -> None:
+    """Основная функция.
+
+    Аргументы:
+        argv:   Аргументы командной строки.
+    """
+    parser = ArgumentParser(description="Сервер Messenger")
+    parser.add_argument(
+        "--mode",
+        choices=["blocking", "asyncio"],
+        default="blocking",
+        help="Способ обработки пакетов"
+    )
+    parser.add_argument("--host", default="0.0.0.0", help="Адрес сервера")
+    parser.add_argument("--port", type=int, default=7505, help="Порт сервера")
+    parser.add_argument(
+        "--hash-workers",
+        type=int,
+        default=cpu_count() or 1,
+        help="Количество процессов для хеширования паролей (0 - без пула)"
+    )
+    parser.add_argument(
+        "--group-commit-ms",
+        type=float,
+        default=GROUP_COMMIT_INTERVAL * 1000,
+        help="Сколько миллисекунд собирать записи в одну транзакцию \
+(0 - без объединения)"
+    )
+    parser.add_argument(
+        "--group-commit-size",
+        type=int,
+        default=GROUP_COMMIT_SIZE,
+        help="Максимальное количество записей в одной транзакции"
+    )
+    parser.add_argument(
+        "--database",
+        default=None,
+        help="Путь к базе данных (по умолчанию messenger.db)"
+    )
+    parser.add_argument(
+        "--read-connections",
+        type=int,
+        default=READ_POOL_SIZE,
+        help="Количество соединений с базой данных только для чтения"
+    )
+    parser.add_argument(
+        "--storage-profile",
+        choices=list(STORAGE_PROFILES),
+        default="wal",
+        help="Настройки хранения базы данных"
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=0,
+        help=f"Количество файлов для сообщений (0 - хранить в файле базы \
+данных, не больше {MAX_SHARDS})"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Количество процессов сервера на одном порту (SO_REUSEPORT)"
+    )
+    parser.add_argument(
+        "--log-level",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        default="INFO",
+        help="Уровень журнала (DEBUG - с пакетами)"
+    )
+    parser.add_argument(
+        "--log-file",
+        default=None,
+        help="Файл журнала (по умолчанию stderr)"
+    )
+    parser.add_argument(
+        "--log-sample",
+        type=float,
+        default=log.PACKET_SAMPLE_RATE,
+        help="Доля пакетов, записываемых в журнал на уровне DEBUG"
+    )
+    parser.add_argument(
+        "--metrics-socket",
+        default=None,
+        help="UNIX сокет, отдающий снимок метрик (python metrics.py путь)"
+    )
+    parser.add_argument(
+        "--metrics-file",
+        default=None,
+        help="Файл, в который периодически записывается снимок метрик"
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=METRICS_INTERVAL,
+        help="Период записи --metrics-file в секундах"
+    )
+    parser.add_argument(
+        "--slow-request-ms",
+        type=float,
+        default=SLOW_REQUEST_TIME * 1000,
+        help="Запросы дольше этого времени записываются в журнал с \
+разбивкой по этапам (0 - не отслеживать)"
+    )
+    args = parser.parse_args(argv)
+
+    if not 0 <= args.shards <= MAX_SHARDS:
+        parser.error(f"--shards должно быть от 0 до {MAX_SHARDS}")
+
+    if args.metrics_socket is not None and AF_UNIX is None:
+        parser.error("--metrics-socket не поддерживается на этой платформе")
+
+    if args.workers > 1:
+        if SO_REUSEPORT is None or AF_UNIX is None:
+            parser.error("--workers не поддерживается на этой платформе")
+
+        run_workers(args)
+    else:
+        run_server(args)
+
+
+def database_path(args) -> str:
+    """Возвращает путь к базе данных из аргументов командной строки."""
+    return absolute("messenger.db") if args.database is None \
+        else args.database
+
+
+def run_server(args, worker: int = None, directory: str = None) -> None:
+    """Запускает сервер в текущем процессе.
+
+    Аргументы:
+        args:       Аргументы командной строки.
+        worker:     Номер процесса при запуске нескольких процессов.
+        directory:  Папка с сокетами WorkerBus.
+    """
+    global dtb
+    global hasher
+    global writer
+    global bus
+    global sampler
+
+    listener = log.setup(args.log_level, args.log_file)
+    sampler = PacketSampler(args.log_sample)
+    tracer.threshold = args.slow_request_ms / 1000
+    suffix = "" if worker is None else f".{worker}"
+    reporter = MetricsReporter(
+        metrics,
+        args.metrics_socket and args.metrics_socket + suffix,
+        args.metrics_file and args.metrics_file + suffix,
+        args.metrics_interval,
+        {"profile": tracer.profile}
+    )
+    reporter.start()
+    dtb = Database(
+        database_path(args),
+        readers=args.read_connections,
+        profile=STORAGE_PROFILES[args.storage_profile],
+        shards=args.shards
+    )
 
-if __name__ == "__main__":
     # dtb.reset_database()
     # print(len(dtb.create_account("Werryx", "123456")) > 1)
     # print(len(dtb.create_account("Werland", "123456")) > 1)
@@ -552,4 +3213,97 @@ if __name__ == "__main__":
     # """, [f"А ты?{' ОЧЕНЬ ДЛИННАЯ СТРОКА!' * 20}"], noresult=True))
     # print(dtb.sql("SELECT * FROM direct_messages;"))
 
+    dtb.migrate()
+
+    # Процессы run_workers() не удаляют аккаунты, которые ещё регистрируют
+    # другие процессы: это делается один раз до их запуска
+    if worker is None and dtb.drop_unfinished_accounts():
+        logger.warning("Удалены незавершённые регистрации")
+
+    writer = GroupCommitWriter(
+        dtb,
+        args.group_commit_ms / 1000,
+        args.group_commit_size
+    )
+
+    hasher = PasswordHasher(args.hash_workers)
+
+    sock = socket(AF_INET, SOCK_DGRAM)
+
+    if worker is not None:
+        # Ядро распределяет клиентов между процессами по хешу адреса,
+        # поэтому все пакеты клиента приходят в один процесс
+        sock.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+        bus = WorkerBus(directory, worker, args.workers)
+        bus.start(dispatch_event)
+
+    sock.bind((args.host, args.port))
+
+    logger.info("Сервер запущен")
+
+    signal(SIGTERM, stop)
+
+    try:
+        with sock:
+            if args.mode == "asyncio":
+                # Больше потоков, чем соединений для чтения, ждали бы
+                # свободного соединения
+                serve_asyncio(sock, max(1, args.read_connections))
+            else:
+                serve_blocking(sock)
+    finally:
+        hasher.close()
+        writer.close()
+        dtb.close()
+
+        if bus is not None:
+            bus.close()
+
+        reporter.close()
+        log.shutdown(listener)
+
+
+def run_workers(args) -> None:
+    """Запускает args.workers процессов сервера на одном порту.
+
+    Аргументы:
+        args:   Аргументы командной строки.
+    """
+    # Соединение с базой данных нельзя использовать после fork(), а
+    # миграции выполняются один раз до запуска процессов
+    database = Database(database_path(args), shards=args.shards)
+    database.migrate()
+
+    if database.drop_unfinished_accounts():
+        logger.warning("Удалены незавершённые регистрации")
+
+    database.close()
+
+    if args.hash_workers > 0:
+        args.hash_workers = max(1, args.hash_workers // args.workers)
+
+    signal(SIGTERM, stop)
+
+    with TemporaryDirectory() as directory:
+        processes = [
+            Process(target=run_server, args=(args, index, directory))
+            for index in range(args.workers)
+        ]
+
+        for process in processes:
+            process.start()
+
+        try:
+            for process in processes:
+                process.join()
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+
+            for process in processes:
+                process.join()
+
+
+if __name__ == "__main__":
     main()
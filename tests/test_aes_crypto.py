@@ -0,0 +1,64 @@
+"""Тестирование AES шифрования."""
+from pytest import mark
+from pytest import raises
+
+from aes_crypto import acrypt
+from aes_crypto import agcm
+
+
+@mark.parametrize("size", [0, 1, 15, 16, 17, 5000])
+def test_encrypt_decrypt(size):
+    """Все режимы расшифровывают то, что зашифровали."""
+    text = "Я" * size
+    data = text.encode()
+    sender = agcm("key", agcm.CLIENT)
+    receiver = agcm("key", agcm.SERVER)
+    first = sender.encrypt_bytes(data)
+    second = sender.encrypt_bytes(data)
+
+    assert acrypt("key").decrypt(acrypt("key").encrypt(text)) == text
+    assert acrypt("key").decrypt_bytes(acrypt("key").encrypt_bytes(data)) \
+        == data
+    assert receiver.decrypt_bytes(first) == receiver.decrypt_bytes(second) \
+        == data
+    assert sender.decrypt_bytes(receiver.encrypt_bytes(data)) == data
+    assert first[:agcm.NONCE_SIZE] != second[:agcm.NONCE_SIZE]
+    assert len(first) == len(data) + agcm.NONCE_SIZE + agcm.TAG_SIZE
+
+
+def test_gcm_directions():
+    """Клиент и сервер шифруют разными ключами.
+
+    Одинаковые nonce двух сторон не дают одинаковый поток ключа, а пакет
+    нельзя отправить обратно его отправителю.
+    """
+    client = agcm("key", agcm.CLIENT)
+    server = agcm("key", agcm.SERVER)
+    from_client = client.encrypt_bytes(b"\0" * 32)
+    from_server = server.encrypt_bytes(b"\0" * 32)
+
+    assert from_client[agcm.NONCE_SIZE:] != from_server[agcm.NONCE_SIZE:]
+
+    with raises(ValueError):
+        client.decrypt_bytes(from_client)
+
+    with raises(ValueError):
+        agcm("key", "both")
+
+
+@mark.parametrize("position", [0, 12, -1])
+def test_gcm_tampering(position):
+    """Изменённый пакет или другой ключ вызывают ValueError."""
+    encrypted = bytearray(agcm("key", agcm.CLIENT).encrypt_bytes(b"message"))
+    encrypted[position] ^= 1
+
+    with raises(ValueError):
+        agcm("key", agcm.SERVER).decrypt_bytes(bytes(encrypted))
+
+    with raises(ValueError):
+        agcm("other", agcm.SERVER).decrypt_bytes(
+            agcm("key", agcm.CLIENT).encrypt_bytes(b"message")
+        )
+
+    with raises(ValueError):
+        agcm("key", agcm.SERVER).decrypt_bytes(b"short")
@@ -34,3 +34,53 @@ def test_show_error(title, message, expected_result):
     assert all(char == "-" for char in lines[0])
     assert len(lines[0]) == len(lines[1]) == len(lines[3])
     assert len(lines[0]) == expected_result
+
+
+@mark.parametrize("messages, changes, expected_result", [
+    ([], [], []),
+    ([[1, 1, "A", 2, 0]], [], [[1, 1, "A", 2, 0]]),
+    ([[1, 1, "A", 2, 0]], [[1, 1, "A", 2, 1]], [[1, 1, "A", 2, 1]]),
+    (
+        [[1, 1, "A", 2, 0], [3, 2, "C", 1, 0]],
+        [[2, 1, "B", 2, 0], [1, 1, "A", 2, 2]],
+        [[1, 1, "A", 2, 2], [2, 1, "B", 2, 0], [3, 2, "C", 1, 0]]
+    )
+])
+def test_merge_messages(messages, changes, expected_result):
+    """Тесты для main.MessengerClient.merge_messages()."""
+    assert main.MessengerClient.merge_messages(
+        messages,
+        changes
+    ) == expected_result
+
+
+@mark.parametrize("messages, peer_id, status, expected_result", [
+    ([], 2, 1, []),
+    (
+        [[1, 1, "A", 2, 0], [2, 1, "B", 3, 0], [3, 2, "C", 1, 0]],
+        2,
+        1,
+        [[1, 1, "A", 2, 1], [2, 1, "B", 3, 0], [3, 2, "C", 1, 0]]
+    ),
+    ([[1, 1, "A", 2, 2], [2, 1, "B", 2, 0]], 2, 1, [
+        [1, 1, "A", 2, 2],
+        [2, 1, "B", 2, 1]
+    ])
+])
+def test_set_status(messages, peer_id, status, expected_result):
+    """Тесты для main.MessengerClient.set_status()."""
+    assert main.MessengerClient.set_status(
+        messages,
+        peer_id,
+        status
+    ) == expected_result
+
+
+def test_set_status_up_to():
+    """set_status() с границей меняет только сообщения до неё."""
+    assert main.MessengerClient.set_status(
+        [[1, 1, "A", 2, 1], [2, 1, "B", 2, 1], [3, 1, "C", 2, 0]],
+        2,
+        2,
+        2
+    ) == [[1, 1, "A", 2, 2], [2, 1, "B", 2, 2], [3, 1, "C", 2, 0]]
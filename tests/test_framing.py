@@ -0,0 +1,78 @@
+"""Тестирование разбиения пакетов на фрагменты."""
+from random import Random
+
+from pytest import mark
+
+import framing
+
+
+@mark.parametrize("size", [0, 1, 1200, 1201, 65535 * 3])
+def test_split_feed(size):
+    """Фрагменты в любом порядке собираются в исходный пакет."""
+    data = bytes(Random(size).getrandbits(8) for _ in range(size))
+    fragments = framing.Fragmenter().split(data)
+    Random(1).shuffle(fragments)
+    reassembler = framing.Reassembler()
+    results = [reassembler.feed(fragment, 0) for fragment in fragments]
+
+    assert len(fragments) == max(1, -(-size // framing.FRAGMENT_SIZE))
+    assert all(len(fragment) <= 1210 for fragment in fragments)
+    assert [result for result in results if result is not None] == [data]
+    assert len(reassembler) == reassembler.buffered == 0
+
+
+def test_reassembler_limits():
+    """Незавершённые пакеты удаляются по времени и по размеру буфера."""
+    fragmenter = framing.Fragmenter(10)
+    reassembler = framing.Reassembler(
+        max_bytes=2 * framing.REASSEMBLY_OVERHEAD + 25,
+        timeout=5
+    )
+    first = fragmenter.split(b"a" * 30)
+    second = fragmenter.split(b"b" * 30)
+
+    reassembler.feed(first[0], 0)
+    reassembler.feed(first[0], 0)
+    reassembler.feed(first[1], 0)
+    buffered = reassembler.buffered
+    reassembler.feed(second[0], 1)
+    evicted = len(reassembler)
+    reassembler.feed(first[2], 1)
+    reassembler.feed(second[1], 7)
+    expired = len(reassembler)
+
+    assert buffered == framing.REASSEMBLY_OVERHEAD + 20
+    assert evicted == 1
+    assert expired == 1
+    assert reassembler.feed(second[0], 7) is None
+    assert reassembler.feed(second[2], 7) == b"b" * 30
+
+
+def test_reassembler_flood():
+    """Фрагменты с новыми ID не занимают память сверх ограничений."""
+    def fragment(message_id, index, total, chunk=b""):
+        return framing.FRAGMENT_HEADER.pack(
+            framing.FRAGMENT_MAGIC,
+            message_id,
+            index,
+            total
+        ) + chunk
+
+    reassembler = framing.Reassembler(max_bytes=32 * 1024, max_messages=16)
+
+    for message_id in range(200000):
+        reassembler.feed(fragment(message_id, 0, 2), 0)
+
+    empty = len(reassembler), reassembler.buffered
+
+    reassembler.feed(fragment(1, 2, 2, b"a"), 0)
+    reassembler.feed(fragment(2, 0, 0xffff, b"a"), 0)
+    invalid = len(reassembler)
+
+    for message_id in range(200000):
+        reassembler.feed(fragment(message_id, 0, 2, b"a"), 0)
+
+    assert empty == (0, 0)
+    assert invalid == 0
+    assert len(reassembler) == 16
+    assert reassembler.buffered == 16 * (framing.REASSEMBLY_OVERHEAD + 1)
@@ -0,0 +1,69 @@
+"""Тестирование журнала сервера."""
+from logging import getLogger
+from queue import Queue
+from time import perf_counter
+
+from pytest import mark
+
+import log
+from metrics import metrics
+
+
+@mark.parametrize("data, expected_result", [
+    (b"\x00" * 10, "<10 байт>"),
+    (["login", "Account", "12345678"], "login <скрыто>"),
+    (["register", "Account", "12345678"], "register <скрыто>"),
+    (["send_message", "Привет", 2], "send_message ['Привет', 2]"),
+    (
+        ["account_data", ["x" * 100]],
+        f"account_data {repr([['x' * 100]])[:16]}... (106 символов)"
+    ),
+    ({}, "<dict>")
+])
+def test_redact(data, expected_result):
+    """Тесты для log.redact()."""
+    assert log.redact(data, 16) == expected_result
+
+
+def test_packet_sampler():
+    """Тесты для log.PacketSampler."""
+    sampler = log.PacketSampler(0.25)
+    disabled = log.PacketSampler(0)
+
+    assert [sampler() for _ in range(8)] == [False, False, False, True] * 2
+    assert not any(disabled() for _ in range(8))
+
+
+def test_full_queue_drops_records():
+    """Заполненная очередь не блокирует запись в журнал."""
+    logger = getLogger("messenger.test")
+    logger.propagate = False
+    handler = log.DroppingQueueHandler(Queue(1))
+    logger.addHandler(handler)
+    dropped = metrics.counter("log.dropped")
+    started = perf_counter()
+
+    for i in range(100):
+        logger.warning("Запись %d", i)
+
+    elapsed = perf_counter() - started
+    logger.removeHandler(handler)
+
+    assert handler.queue.get_nowait().getMessage() == "Запись 0"
+    assert metrics.counter("log.dropped") - dropped == 99
+    assert elapsed < 1
+
+
+def test_setup_writes_file(tmp_path):
+    """log.setup() пишет записи в файл в фоновом потоке."""
+    filepath = tmp_path / "server.log"
+    listener = log.setup("DEBUG", str(filepath))
+    sampler = log.PacketSampler(1)
+    log.logger.info("Сервер запущен")
+    log.trace(sampler, "Получено от клиента", ["login", "Account", "1"])
+    log.shutdown(listener)
+    lines = filepath.read_text("utf8").splitlines()
+
+    assert lines[0].endswith("INFO MainProcess Сервер запущен")
+    assert lines[1].endswith("Получено от клиента: login <скрыто>")
+    assert log.logger.handlers == []
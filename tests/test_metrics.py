@@ -0,0 +1,71 @@
+"""Тестирование метрик."""
+from json import loads
+
+from pytest import mark
+
+from metrics import AF_UNIX
+from metrics import Metrics
+from metrics import MetricsReporter
+from metrics import fetch
+
+
+def test_timer_and_snapshot():
+    """Metrics.timer() записывает время блока в гистограмму."""
+    registry = Metrics()
+    registry.inc("net.packets_in", 2)
+    registry.gauge("clients.active", lambda: 3)
+
+    with registry.timer("command.login"):
+        pass
+
+    try:
+        with registry.timer("command.login"):
+            raise ValueError
+    except ValueError:
+        pass
+
+    snapshot = registry.snapshot()
+
+    assert snapshot["counters"] == {"net.packets_in": 2}
+    assert snapshot["gauges"] == {"clients.active": 3}
+    assert snapshot["histograms"]["command.login"]["count"] == 2
+
+
+@mark.skipif(AF_UNIX is None, reason="Нет UNIX сокетов")
+def test_metrics_reporter(tmp_path):
+    """MetricsReporter отдаёт снимок через сокет и пишет его в файл."""
+    registry = Metrics()
+    registry.inc("net.packets_in")
+    socket_path = str(tmp_path / "metrics.sock")
+    filepath = tmp_path / "metrics.json"
+    reporter = MetricsReporter(registry, socket_path, str(filepath), 0.01)
+    reporter.start()
+    fetched = fetch(socket_path)
+    registry.inc("net.packets_in")
+    reporter.close()
+
+    assert fetched["counters"] == {"net.packets_in": 1}
+    assert loads(filepath.read_text("utf8"))["counters"] == {
+        "net.packets_in": 2
+    }
+    assert not (tmp_path / "metrics.sock").exists()
+
+
+@mark.skipif(AF_UNIX is None, reason="Нет UNIX сокетов")
+def test_metrics_reporter_commands(tmp_path):
+    """MetricsReporter выполняет команды, переданные через сокет."""
+    socket_path = str(tmp_path / "metrics.sock")
+    reporter = MetricsReporter(
+        Metrics(),
+        socket_path,
+        commands={"profile": lambda name, requests: [name, int(requests)]}
+    )
+    reporter.start()
+    result = fetch(socket_path, "profile command.login 5")
+    unknown = fetch(socket_path, "restart")
+    wrong = fetch(socket_path, "profile")
+    reporter.close()
+
+    assert result == ["command.login", 5]
+    assert "error" in unknown
+    assert "error" in wrong
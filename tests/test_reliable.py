@@ -0,0 +1,160 @@
+"""Тестирование надёжной доставки пакетов."""
+from heapq import heappop
+from heapq import heappush
+from random import Random
+
+from pytest import mark
+from pytest import raises
+
+import reliable
+
+POLL_INTERVAL = 0.01
+
+
+class LossyTransport:
+    """Транспорт в памяти, теряющий и задерживающий пакеты."""
+
+    def __init__(self, loss: float, delay: float = 0.02, jitter: float = 0.01):
+        """Инициализация транспорта.
+
+        Аргументы:
+            loss:   Доля потерянных пакетов.
+            delay:  Задержка доставки в секундах.
+            jitter: Максимальная случайная добавка к задержке.
+        """
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.random = Random(int(loss * 1000))
+        self.sent = 0
+        self.__queue = []
+        self.__last = {}
+
+    def send(self, packets: list, channel, now: float) -> None:
+        """Отправляет пакеты каналу channel."""
+        for packet in packets:
+            self.sent += 1
+
+            if self.random.random() < self.loss:
+                continue
+
+            # Пакеты в одном направлении приходят в порядке отправки
+            arrival = max(
+                now + self.delay + self.random.random() * self.jitter,
+                self.__last.get(id(channel), 0)
+            )
+            self.__last[id(channel)] = arrival
+            heappush(self.__queue, (arrival, self.sent, channel, packet))
+
+    def next_time(self) -> float:
+        """Возвращает время доставки следующего пакета."""
+        return self.__queue[0][0] if self.__queue else float("inf")
+
+    def pop(self) -> tuple:
+        """Возвращает следующий доставленный пакет и его получателя."""
+        time, _, channel, packet = heappop(self.__queue)
+        return time, channel, packet
+
+
+def transfer(loss: float, count: int = 500, size: int = 1000) -> dict:
+    """Передаёт count пакетов через LossyTransport.
+
+    Возвращаемое значение: Доставленные данные, время и количество пакетов.
+    """
+    transport = LossyTransport(loss)
+    sender = reliable.ReliableChannel()
+    receiver = reliable.ReliableChannel()
+    payloads = [i.to_bytes(4, "big") * (size // 4) for i in range(count)]
+    delivered = []
+    now = 0.0
+    next_poll = POLL_INTERVAL
+
+    for payload in payloads:
+        transport.send(sender.send(payload, now), receiver, now)
+
+    while len(delivered) < count and now < 600:
+        if transport.next_time() <= next_poll:
+            now, channel, packet = transport.pop()
+            data, replies = channel.receive(packet, now)
+            peer = sender if channel is receiver else receiver
+            transport.send(replies, peer, now)
+
+            if channel is receiver:
+                delivered.extend(data)
+        else:
+            now = next_poll
+            next_poll += POLL_INTERVAL
+            transport.send(sender.poll(now), receiver, now)
+
+    return {
+        "delivered": delivered,
+        "payloads": payloads,
+        "time": now,
+        "goodput": len(delivered) * size / now,
+        "retransmissions": sender.retransmissions,
+        "sent": transport.sent
+    }
+
+
+@mark.parametrize("loss", [0.01, 0.05, 0.2])
+def test_lossy_transfer(loss):
+    """Все пакеты доставляются по порядку при потерях."""
+    result = transfer(loss)
+
+    print(
+        f"Потери {loss:.0%}: {result['goodput'] / 1024:.1f} КиБ/с, "
+        f"{result['time']:.2f} с, повторов {result['retransmissions']}"
+    )
+
+    assert result["delivered"] == result["payloads"]
+    assert result["retransmissions"] > 0
+
+
+def test_reliable_channel():
+    """Тесты подтверждений и повторной отправки."""
+    sender = reliable.ReliableChannel(window=2)
+    receiver = reliable.ReliableChannel()
+
+    first = sender.send(b"a", 0)
+    second = sender.send(b"b", 0)
+    queued = sender.send(b"c", 0)
+    early = sender.poll(0.5)
+    data, acks = receiver.receive(second[0], 0.1)
+    lost = sender.poll(1)
+    backoff = sender.rto
+    freed = sender.receive(acks[0], 1.1)[1]
+    delivered = receiver.receive(lost[0], 1.2)[0]
+    duplicate = receiver.receive(lost[0], 1.2)[0]
+
+    assert reliable.is_reliable(first[0]) and queued == early == data == []
+    assert lost == first + second
+    assert backoff == reliable.INITIAL_RTO * 2
+    assert sender.rto == reliable.INITIAL_RTO
+    assert len(freed) == 1 and freed[0].endswith(b"c")
+    assert delivered == [b"a", b"b"] and duplicate == []
+    assert sender.has_unacked()
+
+
+def test_pending_limit():
+    """Очередь отправки ограничена, подтверждения освобождают место."""
+    size = 10 + reliable.PENDING_OVERHEAD
+    sender = reliable.ReliableChannel(window=1, max_bytes=3 * size)
+    receiver = reliable.ReliableChannel()
+
+    first = sender.send(b"0" * 10, 0)
+
+    for _ in range(3):
+        sender.send(b"1" * 10, 0)
+
+    buffered = sender.buffered
+
+    with raises(ValueError):
+        sender.send(b"2" * 10, 0)
+
+    acks = receiver.receive(first[0], 0.1)[1]
+    sent = sender.receive(acks[0], 0.2)[1]
+    sender.send(b"3" * 10, 0.2)
+
+    assert buffered == 3 * size
+    assert len(sent) == 1
+    assert sender.buffered == 3 * size
@@ -1,11 +1,30 @@
 """Тестирование сервера."""
+from glob import glob
+from json import loads
 from os import path
+from shutil import copy
+from socket import AF_INET
+from socket import SOCK_DGRAM
+from socket import socket
+from subprocess import run
+from sqlite3 import IntegrityError
 from sqlite3 import OperationalError
 from sqlite3 import ProgrammingError
+from threading import Thread
+from threading import get_ident
+from time import perf_counter
+from time import sleep
+import sys
+import tracemalloc
 
 from pytest import mark
+from pytest import raises
 
+from framing import Fragmenter
+from framing import Reassembler
+from reliable import ReliableChannel
 import server
+import wire
 
 
 @mark.parametrize("path_, expected_result", [
@@ -219,7 +238,7 @@ def test_get_account_data_not_exists(name):
             (3, 3, "Очень приятно.", 1, 0),
             (4, 3, "Я TestAccount.", 1, 0),
             (5, 2, "Понял.", 1, 0)
-        ], {2: "Account2", 3: "TestAcc"}),
+        ], {2: "Account2", 3: "TestAcc"}, []),
         [3, 2]
     ))
 ])
@@ -244,6 +263,13 @@ def test_get_account_data_exists(
             (sender, receiver, content) \
             VALUES (?, ?, ?);", [sender, receiver, text], noresult=True)
 
+    # Сообщения добавлены без send_message(), как в базе данных до
+    # миграции 4, поэтому сводки переписок заполняет миграция
+    dtb.sql("DROP TABLE conversations;")
+    dtb.sql("DROP TABLE settings;")
+    dtb.sql("PRAGMA user_version = 3;")
+    dtb.migrate()
+
     result = dtb.get_account_data(name)
 
     dtb.close()
@@ -252,3 +278,1328 @@ def test_get_account_data_exists(
     print("\n\n" + str(expected_result))
 
     assert result == expected_result
+
+
+def test_serve_asyncio(monkeypatch):
+    """Быстрые и медленные команды асинхронного сервера получают ответы."""
+    dtb = server.Database(":memory:")
+    dtb.reset_database()
+    monkeypatch.setattr(server, "dtb", dtb)
+    monkeypatch.setattr(server, "writer", server.GroupCommitWriter(dtb))
+    monkeypatch.setattr(server, "hasher", server.PasswordHasher())
+    monkeypatch.setattr(server, "clients", server.SessionRegistry())
+
+    loops = []
+    handled = {}
+    new_event_loop = server.new_event_loop
+    handle = server.NetworkedClient.handle
+
+    def record_loop():
+        loops.append(new_event_loop())
+        return loops[-1]
+
+    def record_thread(client, request):
+        handled[request[0]] = get_ident()
+        return handle(client, request)
+
+    monkeypatch.setattr(server, "new_event_loop", record_loop)
+    monkeypatch.setattr(server.NetworkedClient, "handle", record_thread)
+
+    sock = socket(AF_INET, SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    thread = Thread(target=server.serve_asyncio, args=(sock, 2))
+    thread.start()
+
+    def receive():
+        received = FakeSocket()
+        received.sent.append(peer.recvfrom(65535))
+        return decode_sent(received, key)[0]
+
+    try:
+        with socket(AF_INET, SOCK_DGRAM) as peer:
+            peer.settimeout(10)
+            peer.sendto(wire.handshake(["binary"]), sock.getsockname())
+            key = wire.parse_handshake_reply(peer.recvfrom(65535)[0])[0]
+            aes = server.acrypt(server.KEY_EXTRA + key)
+            replies = []
+
+            for request in (
+                ["get_account_data"],
+                ["register", "Account", "12345678"]
+            ):
+                packet = aes.encrypt_bytes(wire.encode(request))
+                peer.sendto(wire.BINARY_MAGIC + packet, sock.getsockname())
+                replies.append(receive())
+    finally:
+        loops[0].call_soon_threadsafe(loops[0].stop)
+        thread.join()
+        sock.close()
+        dtb.close()
+
+    assert replies == [["not_logged"], ["register_status", 0]]
+    assert handled["get_account_data"] == thread.ident
+    assert handled["register"] != thread.ident
+
+
+def test_get_account_data_replied():
+    """Ответ отмечает сообщения собеседника прочитанными."""
+    dtb = server.Database(":memory:")
+    dtb.reset_database()
+    dtb.create_account("Account", "12345678")
+    dtb.create_account("Account2", "12345678")
+    dtb.create_account("TestAcc", "87654321")
+    dtb.send_message("Account2", 1, "Привет")
+    dtb.send_message("TestAcc", 1, "Привет")
+    dtb.send_message("Account", 2, "Ответ")
+
+    result = dtb.get_account_data("Account")
+    dtb.close()
+
+    assert result == (([(3, 1, "Ответ", 2, 0)], [
+        (1, 2, "Привет", 1, 2),
+        (2, 3, "Привет", 1, 0)
+    ], {2: "Account2", 3: "TestAcc"}, []), [3])
+
+
+@mark.parametrize("data, logged, expected_result", [
+    (["client_alive"], False, True),
+    (["disconnect"], True, True),
+    (["login", "Account", "12345678"], False, False),
+    (["register", "Account", "12345678"], True, False),
+    (["get_account_data"], False, True),
+    (["get_account_data"], True, False),
+    (["send_message", "Текст", 2], True, False)
+])
+def test_is_fast(data, logged, expected_result):
+    """Тесты для server.NetworkedClient.is_fast()."""
+    client = server.NetworkedClient(None, ("127.0.0.1", 0), "0" * 64)
+
+    if logged:
+        client.login = "Account"
+
+    assert client.is_fast(data) == expected_result
+
+
+class FakeSocket:
+    """Сокет, запоминающий отправленные пакеты."""
+
+    def __init__(self):
+        """Инициализация сокета."""
+        self.sent = []
+
+    def sendto(self, data, addr):
+        """Запоминает отправленный пакет."""
+        self.sent.append((data, addr))
+
+
+def decode_sent(sock, key, binary_aes=None, dictionary=None):
+    """Собирает и расшифровывает пакеты, отправленные через FakeSocket."""
+    aes = server.acrypt(server.KEY_EXTRA + key)
+    binary_aes = binary_aes or aes
+    reassembler = Reassembler()
+    packets = [reassembler.feed(data) for data, _ in sock.sent]
+    return [
+        wire.decode(wire.decompress(
+            binary_aes.decrypt_bytes(data[1:]),
+            dictionary
+        ))
+        if wire.is_compressed(data) else
+        wire.decode(binary_aes.decrypt_bytes(data[1:]))
+        if wire.is_binary(data) else loads(aes.decrypt(data))
+        for data in packets
+        if data is not None
+    ]
+
+
+@mark.parametrize("workers", [0, 1])
+def test_register_login_hasher(monkeypatch, workers):
+    """Регистрация и вход через server.PasswordHasher."""
+    dtb = server.Database(":memory:")
+    dtb.reset_database()
+    hasher = server.PasswordHasher(workers)
+    monkeypatch.setattr(server, "dtb", dtb)
+    monkeypatch.setattr(server, "hasher", hasher)
+
+    sock = FakeSocket()
+    client = server.NetworkedClient(sock, ("127.0.0.1", 0), "0" * 64)
+    client.handle(["register", "Account", "12345678"])
+    client.handle(["login", "Account", "87654321"])
+    client.handle(["login", "Account", "12345678"])
+
+    for _ in range(100):
+        if hasher.queue_length == 0 and len(sock.sent) == 2:
+            break
+
+        sleep(0.1)
+
+    hasher.close()
+
+    result = dtb.login_account("Account", "12345678")
+    dtb.close()
+
+    assert sorted(decode_sent(sock, "0" * 64)) == [
+        ["login_status", 0],
+        ["register_status", 0]
+    ]
+    assert client.login == "Account"
+    assert result == [0, 1]
+
+
+def test_register_hash_error(monkeypatch):
+    """Ошибка хеширования освобождает логин и возвращает ошибку клиенту."""
+    def fail(user_id, password):
+        raise ValueError("hash")
+
+    dtb = server.Database(":memory:")
+    dtb.reset_database()
+    monkeypatch.setattr(server, "dtb", dtb)
+    monkeypatch.setattr(server, "hasher", server.PasswordHasher())
+    monkeypatch.setattr(server, "encrypt_password", fail)
+
+    sock = FakeSocket()
+    client = server.NetworkedClient(sock, ("127.0.0.1", 0), "0" * 64)
+    client.handle(["register", "Account", "12345678"])
+    user_id = dtb.user_id("Account")
+    dtb.close()
+
+    assert decode_sent(sock, "0" * 64) == [["register_status", 5]]
+    assert client.login is None
+    assert user_id is None
+
+
+def test_drop_unfinished_accounts():
+    """Тесты для server.Database.drop_unfinished_accounts()."""
+    dtb = server.Database(":memory:")
+    dtb.reset_database()
+    dtb.create_account("Account", "12345678")
+    reserved = dtb.reserve_account("Account2", "12345678")
+
+    dropped = dtb.drop_unfinished_accounts()
+    finished = dtb.finish_account(reserved[1], "-")
+    result = dtb.create_account("Account2", "12345678")
+    dropped_again = dtb.drop_unfinished_accounts()
+    dtb.close()
+
+    assert dropped == 1
+    assert finished is False
+    assert result[0] == 0
+    assert dropped_again == 0
+
+
+def test_register_account_dropped(monkeypatch):
+    """Клиент получает ошибку, если аккаунт удалён до вычисления хеша."""
+    class DroppingHasher:
+        """Удаляет незавершённые аккаунты, пока вычисляется хеш."""
+
+        def submit(self, user_id, password, callback):
+            """Вызывает callback после удаления аккаунта."""
+            dtb.drop_unfinished_accounts()
+            callback(server.encrypt_password(user_id, password))
+
+    dtb = server.Database(":memory:")
+    dtb.reset_database()
+    monkeypatch.setattr(server, "dtb", dtb)
+    monkeypatch.setattr(server, "hasher", DroppingHasher())
+
+    sock = FakeSocket()
+    client = server.NetworkedClient(sock, ("127.0.0.1", 0), "0" * 64)
+    client.handle(["register", "Account", "12345678"])
+    user_id = dtb.user_id("Account")
+    dtb.close()
+
+    assert decode_sent(sock, "0" * 64) == [["register_status", 5]]
+    assert client.login is None
+    assert user_id is None
+
+
+def test_get_account_changes():
+    """Тесты для server.Database.get_account_changes()."""
+    dtb = server.Database(":memory:")
+    dtb.reset_database()
+    dtb.create_account("Account", "12345678")
+    dtb.create_account("Account2", "12345678")
+    dtb.send_message("Account", 2, "Первое")
+
+    full = dtb.get_account_changes("Account", 0)
+    version = full[2]
+    unchanged = dtb.get_account_changes("Account", version)
+
+    dtb.send_message("Account", 2, "Второе")
+    new_message = dtb.get_account_changes("Account", version)
+
+    dtb.get_account_changes("Account2", 0)
+    status_changed = dtb.get_account_changes("Account", new_message[2])
+
+    dtb.close()
+
+    assert full[0] == ([(1, 1, "Первое", 2, 0)], [], {2: "Account2"}, [])
+    assert unchanged == (([], [], {}, []), [], version)
+    assert new_message[0] == (
+        [(2, 1, "Второе", 2, 0)],
+        [],
+        {2: "Account2"},
+        []
+    )
+    assert new_message[2] > version
+    assert status_changed[0] == ([], [], {}, [(2, 2, 0)])
+
+
+def test_migrate():
+    """Тест для server.Database.migrate() со старой базой данных."""
+    dtb = server.Database(":memory:")
+    dtb.sql("""
+        CREATE TABLE users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+            name VARCHAR(16) NOT NULL,
+            password CHAR(32) NOT NULL
+        );
+        CREATE TABLE direct_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+            sender INTEGER NOT NULL,
+            content TEXT NOT NULL,
+            receiver INTEGER NOT NULL,
+            read TINYINT NOT NULL DEFAULT 0
+        );
+        INSERT INTO users (name, password) VALUES ("Account", "");
+        INSERT INTO direct_messages (sender, receiver, content)
+        VALUES (1, 2, "Старое");
+        INSERT INTO direct_messages (sender, receiver, content, read)
+        VALUES (2, 1, "Ответ", 2);
+    """)
+
+    assert dtb.schema_version() == 0
+    assert dtb.migrate() == len(server.MIGRATIONS)
+    assert dtb.migrate() == len(server.MIGRATIONS)
+
+    messages = dtb.sql("SELECT * FROM direct_messages;")
+    users = dtb.sql("SELECT id, name FROM users;")
+    conversations = dtb.sql("""
+        SELECT user, peer, inbound_id, delivered_id, read_id, unread \
+        FROM conversations;
+    """)
+
+    try:
+        dtb.sql("INSERT INTO users (name, password) VALUES ('Account', '');")
+        unique = False
+    except IntegrityError:
+        unique = True
+
+    dtb.close()
+
+    assert messages == [
+        (1, 1, "Старое", 2, 0, 0),
+        (2, 2, "Ответ", 1, 2, 0)
+    ]
+    assert users == [(1, "Account")]
+    assert conversations == [(1, 2, 2, 2, 2, 0), (2, 1, 1, 0, 0, 1)]
+    assert unique
+
+
+def test_migrate_rollback():
+    """Неудачная миграция не меняет версию схемы."""
+    dtb = server.Database(":memory:")
+    dtb.sql("""
+        CREATE TABLE users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+            name VARCHAR(16) NOT NULL,
+            password CHAR(32) NOT NULL
+        );
+        CREATE TABLE direct_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+            sender INTEGER NOT NULL,
+            content TEXT NOT NULL,
+            receiver INTEGER NOT NULL,
+            read TINYINT NOT NULL DEFAULT 0
+        );
+        INSERT INTO users (name, password) VALUES ("Account", "");
+        INSERT INTO users (name, password) VALUES ("Account", "");
+    """)
+
+    try:
+        dtb.migrate()
+        failed = False
+    except IntegrityError:
+        failed = True
+
+    version = dtb.schema_version()
+    indexes = dtb.sql("""
+        SELECT name FROM sqlite_master \
+        WHERE type = 'index' AND name = 'direct_messages_receiver';
+    """)
+    dtb.close()
+
+    assert failed
+    assert version == 2
+    assert indexes == []
+
+
+def test_get_conversation():
+    """Тесты для server.Database.get_conversation()."""
+    dtb = server.Database(":memory:")
+    dtb.reset_database()
+
+    assert dtb.schema_version() == len(server.MIGRATIONS)
+
+    dtb.create_account("Account", "12345678")
+    dtb.create_account("Account2", "12345678")
+    dtb.create_account("Account3", "12345678")
+
+    for i in range(5):
+        dtb.send_message("Account", 2, f"A{i}")
+        dtb.send_message("Account2", 1, f"B{i}")
+        dtb.send_message("Account3", 1, f"C{i}")
+
+    newest = dtb.get_conversation("Account", 2, None, 4)
+    older = dtb.get_conversation("Account", 2, newest[0][0][0], 4)
+    oldest = dtb.get_conversation("Account", 2, older[0][0][0], 4)
+    missing = dtb.get_conversation("Unknown", 2)
+    invalid = [
+        dtb.get_conversation("Account", 2, "10"),
+        dtb.get_conversation("Account", 2, -1),
+        dtb.get_conversation("Account", 2, None, -5),
+        dtb.get_conversation("Account", 2, None, 1.5),
+        dtb.get_conversation("Account", 2, None, True),
+        dtb.get_conversation("Account", "2"),
+        dtb.get_conversation("Account", None)
+    ]
+    clamped = dtb.get_conversation("Account", 2, None, 10 ** 6)
+
+    dtb.close()
+
+    assert [msg[2] for msg in newest[0]] == ["A3", "B3", "A4", "B4"]
+    assert newest[1]
+    assert [msg[2] for msg in older[0]] == ["A1", "B1", "A2", "B2"]
+    assert older[1]
+    assert [msg[2] for msg in oldest[0]] == ["A0", "B0"]
+    assert not oldest[1]
+    assert missing is False
+    assert invalid == [False] * len(invalid)
+    assert len(clamped[0]) == 10
+
+
+def test_get_conversation_invalid(monkeypatch):
+    """Неверные аргументы get_conversation не закрывают сессию."""
+    dtb = server.Database(":memory:")
+    dtb.reset_database()
+    dtb.create_account("Account", "12345678")
+    monkeypatch.setattr(server, "dtb", dtb)
+    sock = FakeSocket()
+    client = server.NetworkedClient(sock, ("127.0.0.1", 0), "0" * 64)
+    client.login = "Account"
+
+    client.handle(["get_conversation", 2, "x", -1])
+    client.handle(["get_conversation"])
+    client.handle(["get_conversation", 2, None])
+    dtb.close()
+
+    assert decode_sent(sock, "0" * 64) == [
+        ["conversation", 2, "x", False],
+        ["conversation", None, None, False],
+        ["conversation", 2, None, [[], False]]
+    ]
+
+
+def test_get_account_changes_peers_only():
+    """server.Database.get_account_changes() без истории сообщений."""
+    dtb = server.Database(":memory:")
+    dtb.reset_database()
+    dtb.create_account("Account", "12345678")
+    dtb.create_account("Account2", "12345678")
+    dtb.create_account("Account3", "12345678")
+    dtb.send_message("Account", 2, "Привет")
+    dtb.send_message("Account3", 1, "Привет")
+
+    result = dtb.get_account_changes("Account", 0, False)
+
+    dtb.close()
+
+    assert result[0][:3] == ([], [], {2: "Account2", 3: "Account3"})
+    assert result[1] == [3]
+
+
+def test_hot_queries_use_indexes():
+    """Все запросы основных команд используют индексы."""
+    dtb = server.Database(":memory:")
+    dtb.reset_database()
+    dtb.create_account("Account", "12345678")
+    dtb.create_account("Account2", "12345678")
+    dtb.send_message("Account2", 1, "Привет")
+
+    queries = []
+    dtb.set_trace(queries.append)
+
+    dtb.login_account("Account", "12345678")
+    dtb.find_user("Account2")
+    dtb.send_message("Account", 2, "Привет")
+    dtb.get_account_data("Account")
+    dtb.get_account_changes("Account2", 1)
+    dtb.get_account_changes("Account2", 0, False)
+    dtb.get_conversation("Account", 2, 10, 20)
+    dtb.get_conversations("Account")
+    dtb.mark_read("Account", 2, 10)
+
+    dtb.set_trace(None)
+    scans = []
+
+    for query in queries:
+        if not query.lstrip().upper().startswith(("SELECT", "UPDATE")):
+            continue
+
+        for row in dtb.sql(f"EXPLAIN QUERY PLAN {query}"):
+            if row[3].startswith((
+                "SCAN users",
+                "SCAN direct_messages",
+                "SCAN conversations"
+            )):
+                scans.append((query, row[3]))
+
+    dtb.close()
+
+    assert len(queries) > 10
+    assert scans == []
+
+
+def test_get_conversations():
+    """Тесты для server.Database.get_conversations()."""
+    dtb = server.Database(":memory:")
+    dtb.reset_database()
+
+    for name in ("Account", "Account2", "Account3"):
+        dtb.create_account(name, "12345678")
+
+    dtb.send_message("Account2", 1, "Привет")
+    dtb.send_message("Account2", 1, "Как дела?")
+    dtb.send_message("Account3", 1, "Привет")
+    unread = dtb.get_conversations("Account")
+    dtb.send_message("Account", 2, "Хорошо")
+    replied = dtb.get_conversations("Account")
+    peer = dtb.get_conversations("Account2")
+
+    # Миграция заполняет таблицу по существующим сообщениям
+    dtb.sql("DROP TABLE conversations;")
+    dtb.sql("DROP TABLE settings;")
+    dtb.sql("PRAGMA user_version = 3;")
+    dtb.migrate()
+    migrated = dtb.get_conversations("Account")
+    missing = dtb.get_conversations("Account4")
+    dtb.close()
+
+    assert [row[:2] + row[3:] for row in unread[0]] == [(3, 3, 1), (2, 2, 2)]
+    assert unread[1] == {3: "Account3", 2: "Account2"}
+    assert [row[:2] + row[3:] for row in replied[0]] == [(2, 4, 0), (3, 3, 1)]
+    assert all(row[2] > 0 for row in replied[0])
+    assert [row[:2] + row[3:] for row in peer[0]] == [(1, 4, 1)]
+    assert [row[:2] for row in migrated[0]] == \
+        [row[:2] for row in replied[0]]
+    assert missing is False
+
+
+def test_mark_read():
+    """Тесты для server.Database.mark_read()."""
+    dtb = server.Database(":memory:")
+    dtb.reset_database()
+    dtb.create_account("Account", "12345678")
+    dtb.create_account("Account2", "12345678")
+
+    for text in ("Первое", "Второе", "Третье"):
+        dtb.send_message("Account", 2, text)
+
+    version = dtb.sync_version()
+    dtb.mark_received("Account2")
+    queries = []
+    dtb.set_trace(queries.append)
+    read_id = dtb.mark_read("Account2", 1, 2)
+    dtb.set_trace(None)
+    page = dtb.get_conversation("Account", 2)
+    unread = dtb.get_conversations("Account2")[0]
+    repeated = dtb.mark_read("Account2", 1, 1)
+    beyond = dtb.mark_read("Account2", 1, 100)
+    changes = dtb.get_account_changes("Account", version)
+    missing = dtb.mark_read("Account2", 3, 1)
+    dtb.close()
+
+    assert read_id == 2 and repeated is False and beyond == 3
+    assert missing is False
+    assert not [
+        query for query in queries
+        if "UPDATE direct_messages" in query
+    ]
+    assert [message[4] for message in page[0]] == [2, 2, 1]
+    assert unread[0][3] == 1
+    assert changes[0] == ([], [], {}, [(2, 3, 3)])
+
+
+def test_user_directory():
+    """Тесты для server.UserDirectory."""
+    users = server.UserDirectory(2)
+    users.put(1, "Account")
+    users.put(2, "Account2")
+
+    assert users.get_name(1) == "Account"
+
+    users.put(3, "Account3")
+
+    assert len(users) == 2
+    assert users.get_id("Account") == 1
+    assert users.get_id("Account2") is None
+    assert users.get_name(3) == "Account3"
+
+    users.forget(3)
+
+    assert users.get_id("Account3") is None
+    assert len(users) == 1
+
+
+def test_account_data_user_queries():
+    """server.Database.get_account_data() получает логины одним запросом."""
+    dtb = server.Database(":memory:")
+    dtb.reset_database()
+    dtb.sql("INSERT INTO users (name, password) VALUES ('Account', '');")
+
+    for i in range(2, 30):
+        dtb.sql(
+            "INSERT INTO users (name, password) VALUES (?, '');",
+            [f"Account{i}"]
+        )
+        dtb.send_message("Account", i, "Привет")
+
+    dtb.users.clear()
+    first = []
+    dtb.set_trace(first.append)
+    result = dtb.get_account_data("Account")
+    dtb.set_trace(None)
+
+    second = []
+    dtb.set_trace(second.append)
+    dtb.get_account_data("Account")
+    dtb.find_user("Account5")
+    dtb.send_message("Account", 7, "Снова")
+    dtb.set_trace(None)
+    dtb.close()
+
+    assert len(result[0][2]) == 28
+    assert len([query for query in first if "FROM users" in query]) == 2
+    assert [query for query in second if "FROM users" in query] == []
+
+
+def test_sql_many():
+    """Тесты для server.Database.sql_many()."""
+    dtb = server.Database(":memory:")
+    dtb.sql("CREATE TABLE test (value INTEGER);")
+
+    assert dtb.sql_many(
+        "INSERT INTO test (value) VALUES (?);",
+        [[i] for i in range(1000)]
+    ) == 1000
+
+    result = dtb.sql("""
+        INSERT INTO test (value) VALUES (?);
+        SELECT COUNT(*) FROM test WHERE value = ?;
+    """, [5000, 5000])
+
+    dtb.close()
+
+    assert result == [[], [(1,)]]
+
+
+def test_transaction():
+    """Тесты для server.Database.transaction()."""
+    dtb = server.Database(":memory:")
+    dtb.sql("CREATE TABLE test (value INTEGER);")
+    queries = []
+    dtb.set_trace(queries.append)
+
+    with dtb.transaction():
+        dtb.sql("INSERT INTO test (value) VALUES (1);")
+
+        with dtb.transaction():
+            dtb.sql("INSERT INTO test (value) VALUES (2);")
+
+        dtb.sql("INSERT INTO test (value) VALUES (3);")
+
+    try:
+        with dtb.transaction():
+            dtb.sql("INSERT INTO test (value) VALUES (4);")
+            raise ValueError
+    except ValueError:
+        pass
+
+    dtb.sql("SELECT * FROM test;")
+    dtb.set_trace(None)
+    result = dtb.sql("SELECT value FROM test;")
+    dtb.close()
+
+    assert result == [(1,), (2,), (3,)]
+    assert queries.count("COMMIT") == 1
+
+
+@mark.parametrize("interval", [0, 0.05])
+def test_group_commit_writer(interval):
+    """Тесты для server.GroupCommitWriter."""
+    dtb = server.Database(":memory:")
+    dtb.sql("CREATE TABLE test (value INTEGER UNIQUE);")
+    queries = []
+    dtb.set_trace(queries.append)
+    writer = server.GroupCommitWriter(dtb, interval)
+
+    def insert(value):
+        dtb.sql("INSERT INTO test (value) VALUES (?);", [value])
+        return value
+
+    futures = [writer.submit(insert, value) for value in (1, 2, 2, 3)]
+    writer.close()
+    dtb.set_trace(None)
+    result = dtb.sql("SELECT value FROM test ORDER BY value;")
+    dtb.close()
+
+    assert [future.result() for future in futures[:2]] == [1, 2]
+    assert isinstance(futures[2].exception(), IntegrityError)
+    assert futures[3].result() == 3
+    assert result == [(1,), (2,), (3,)]
+
+    if interval > 0:
+        assert queries.count("COMMIT") == 1
+
+
+def test_read_pool(tmp_path):
+    """Тесты для чтения через server.Database.read() и snapshot()."""
+    dtb = server.Database(
+        str(tmp_path / "pool.db"),
+        readers=2,
+        profile=server.STORAGE_PROFILES["wal"]
+    )
+    dtb.sql("CREATE TABLE test (value INTEGER);")
+    dtb.sql("INSERT INTO test (value) VALUES (1);")
+
+    with dtb.transaction():
+        dtb.sql("INSERT INTO test (value) VALUES (2);")
+        own = dtb.read("SELECT COUNT(*) FROM test;")
+        other = []
+        thread = Thread(target=lambda: other.append(
+            dtb.read("SELECT COUNT(*) FROM test;")
+        ))
+        thread.start()
+        thread.join(5)
+
+    with dtb.snapshot() as read:
+        before = read("SELECT COUNT(*) FROM test;")
+        dtb.sql("INSERT INTO test (value) VALUES (3);")
+        during = read("SELECT COUNT(*) FROM test;")
+
+    after = dtb.read("SELECT COUNT(*) FROM test;")
+    mode = dtb.sql("PRAGMA journal_mode;")
+
+    try:
+        dtb.read("INSERT INTO test (value) VALUES (4);")
+        read_only = False
+    except OperationalError:
+        read_only = True
+
+    dtb.close()
+
+    assert mode == [("wal",)]
+    # Чтение в другом потоке не ждёт окончания записи
+    assert own == [(2,)]
+    assert other == [[(1,)]]
+    assert before == during == [(2,)]
+    assert after == [(3,)]
+    assert read_only
+
+
+def test_session_registry_soak(monkeypatch):
+    """100 000 подключений и отключений не увеличивают server.clients."""
+    registry = server.SessionRegistry()
+    monkeypatch.setattr(server, "clients", registry)
+    sock = FakeSocket()
+    peer = server.NetworkedClient(sock, ("127.0.0.1", 0), "0" * 64)
+    registry.add(peer, server.time())
+    registry.authenticate(peer, 1, "Peer")
+
+    def lookup_time():
+        started = perf_counter()
+
+        for _ in range(1000):
+            registry.by_id(1)
+            registry.by_login("Peer")
+
+        return perf_counter() - started
+
+    def cycle(start, count):
+        for port in range(start, start + count):
+            client = server.NetworkedClient(
+                sock,
+                ("127.0.0.1", port),
+                "0" * 64
+            )
+            registry.add(client, server.time())
+            registry.authenticate(client, port + 1, f"User{port}")
+            client.handle(["disconnect"])
+
+    cycle(1, 10000)
+    before = lookup_time()
+    tracemalloc.start()
+    cycle(10001, 10000)
+    baseline = tracemalloc.get_traced_memory()[0]
+    cycle(20001, 80000)
+    grown = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+    after = lookup_time()
+
+    assert len(registry) == 1
+    assert registry.by_id(1) == [peer]
+    assert registry.by_login("Peer") == [peer]
+    assert registry.by_id(50000) == []
+    assert grown < 64 * 1024
+    assert after < before * 5 + 0.01
+
+
+def test_send_message_notifies_receiver(monkeypatch):
+    """Получатель сообщения сразу получает изменения."""
+    dtb = server.Database(":memory:")
+    dtb.reset_database()
+    dtb.create_account("Account", "12345678")
+    dtb.create_account("Account2", "12345678")
+    registry = server.SessionRegistry()
+    monkeypatch.setattr(server, "dtb", dtb)
+    monkeypatch.setattr(server, "writer", server.GroupCommitWriter(dtb))
+    monkeypatch.setattr(server, "clients", registry)
+
+    sockets = [FakeSocket(), FakeSocket()]
+    sessions = []
+
+    for port, (sock, login) in enumerate(zip(
+        sockets,
+        ["Account", "Account2"]
+    )):
+        client = server.NetworkedClient(sock, ("127.0.0.1", port), "0" * 64)
+        registry.add(client, server.time())
+        registry.authenticate(client, port + 1, login)
+        sessions.append(client)
+
+    sessions[0].handle(["send_message", "Привет", 2])
+    dtb.close()
+
+    received = decode_sent(sockets[1], "0" * 64)
+
+    assert len(decode_sent(sockets[0], "0" * 64)) == 2
+    assert received[0][0] == "account_data"
+    assert received[0][1][1] == [[1, 1, "Привет", 2, 0]]
+
+
+def test_session_registry_expire(monkeypatch):
+    """Тесты для server.SessionRegistry.expire()."""
+    registry = server.SessionRegistry(10, 1)
+    monkeypatch.setattr(server, "clients", registry)
+    now = server.time()
+    idle, active, replaced = [
+        server.NetworkedClient(FakeSocket(), ("127.0.0.1", port), "0" * 64)
+        for port in range(3)
+    ]
+    registry.add(idle, now - 5)
+    registry.add(active, now - 5)
+    registry.add(replaced, now - 5)
+    registry.touch(active)
+    replacement = server.NetworkedClient(
+        FakeSocket(),
+        ("127.0.0.1", 2),
+        "0" * 64
+    )
+    registry.add(replacement, now)
+
+    early = registry.expire(now + 4)
+    expired = registry.expire(now + 6)
+
+    for client in expired:
+        client.close()
+
+    late = registry.expire(now + 12)
+
+    assert early == []
+    assert expired == [idle]
+    assert {client.addr for client in late} == {
+        active.addr,
+        replacement.addr
+    }
+    assert len(registry) == 2
+
+
+def test_send_message_push(monkeypatch):
+    """Отправитель получает message_ack, получатель - new_message."""
+    dtb = server.Database(":memory:")
+    dtb.reset_database()
+    dtb.create_account("Account", "12345678")
+    dtb.create_account("Account2", "12345678")
+
+    for i in range(100):
+        dtb.send_message("Account", 2, f"История {i}")
+
+    registry = server.SessionRegistry()
+    monkeypatch.setattr(server, "dtb", dtb)
+    monkeypatch.setattr(server, "writer", server.GroupCommitWriter(dtb))
+    monkeypatch.setattr(server, "clients", registry)
+
+    sockets = [FakeSocket(), FakeSocket()]
+    sessions = []
+
+    for port, (sock, login) in enumerate(zip(
+        sockets,
+        ["Account", "Account2"]
+    )):
+        client = server.NetworkedClient(sock, ("127.0.0.1", port), "0" * 64)
+        client.sync_version = dtb.sync_version()
+        registry.add(client, server.time())
+        registry.authenticate(client, port + 1, login)
+        sessions.append(client)
+
+    sessions[0].handle(["send_message", "Привет", 2])
+    sessions[0].handle(["send_message", "Никому", 7])
+    sessions[1].handle(["mark_read", 1, 101])
+    server.writer.close()
+    dtb.close()
+
+    sent = decode_sent(sockets[0], "0" * 64)
+    receipt = ["message_status", 2, 2, 101]
+
+    assert receipt in sent
+    assert [message for message in sent if message != receipt] == [
+        ["message_ack", [101, 1, "Привет", 2, 0]],
+        ["message_status", 2, 1],
+        ["message_ack", False]
+    ]
+    assert decode_sent(sockets[1], "0" * 64) == [
+        ["new_message", [101, 1, "Привет", 2, 0], {"1": "Account"}]
+    ]
+
+
+def test_fragmented_message(monkeypatch):
+    """Сообщение больше одной датаграммы передаётся фрагментами."""
+    dtb = server.Database(":memory:")
+    dtb.reset_database()
+    dtb.create_account("Account", "12345678")
+    dtb.create_account("Account2", "12345678")
+    monkeypatch.setattr(server, "dtb", dtb)
+    monkeypatch.setattr(server, "writer", server.GroupCommitWriter(dtb))
+    monkeypatch.setattr(server, "clients", server.SessionRegistry())
+
+    sock = FakeSocket()
+    client = server.NetworkedClient(sock, ("127.0.0.1", 0), "0" * 64)
+    server.clients.add(client, server.time())
+    server.clients.authenticate(client, 1, "Account")
+    client.sync_version = 0
+    text = "Я" * 65535
+    encoded = server.acrypt(server.KEY_EXTRA + "0" * 64).encrypt(
+        server.dumps(["send_message", text, 2], ensure_ascii=False)
+    )
+    fragments = Fragmenter().split(encoded)
+    results = [client.receive(fragment) for fragment in fragments]
+    dtb.close()
+
+    assert len(fragments) > 1
+    assert all(results)
+    assert len(sock.sent) > 1
+    assert decode_sent(sock, "0" * 64) == [
+        ["message_ack", [1, 1, text, 2, 0]]
+    ]
+
+
+@mark.parametrize("handshake, capabilities", [
+    (wire.HANDSHAKE, []),
+    (wire.handshake(["binary", "unknown"]), ["binary"]),
+    (wire.handshake(["binary", "gcm"]), ["binary", "gcm"])
+])
+def test_binary_handshake(monkeypatch, handshake, capabilities):
+    """Двоичный формат используется только после согласования."""
+    dtb = server.Database(":memory:")
+    dtb.reset_database()
+    dtb.create_account("Account", "12345678")
+    dtb.create_account("Account2", "12345678")
+    monkeypatch.setattr(server, "dtb", dtb)
+    monkeypatch.setattr(server, "writer", server.GroupCommitWriter(dtb))
+    monkeypatch.setattr(server, "clients", server.SessionRegistry())
+
+    sock = FakeSocket()
+    addr = ("127.0.0.1", 0)
+    server.accept_client(sock, addr, handshake)
+    key, accepted = wire.parse_handshake_reply(sock.sent.pop()[0])
+    client = server.clients.get(addr)
+    server.clients.authenticate(client, 1, "Account")
+    client.sync_version = 0
+    aes = server.acrypt(server.KEY_EXTRA + key)
+
+    if "gcm" in accepted:
+        aes = server.agcm(server.KEY_EXTRA + key, server.agcm.CLIENT)
+
+    result = client.receive(wire.BINARY_MAGIC + aes.encrypt_bytes(
+        wire.encode(["send_message", "Привет", 2])
+    ))
+    dtb.close()
+
+    assert result
+    assert accepted == capabilities
+    assert wire.is_binary(sock.sent[0][0]) == bool(capabilities)
+    assert decode_sent(sock, key, aes) == [
+        ["message_ack", [1, 1, "Привет", 2, 0]]
+    ]
+
+
+def test_send_queue_overflow(monkeypatch):
+    """Клиент, не подтверждающий пакеты, отключается при переполнении."""
+    monkeypatch.setattr(server, "clients", server.SessionRegistry())
+    monkeypatch.setattr(
+        server,
+        "ReliableChannel",
+        lambda: ReliableChannel(window=2, max_bytes=64 * 1024)
+    )
+    sock = FakeSocket()
+    addr = ("127.0.0.1", 0)
+    client = server.NetworkedClient(sock, addr, "0" * 64, ["binary"])
+    server.clients.add(client, server.time())
+    peer = ReliableChannel()
+    aes = server.acrypt(server.KEY_EXTRA + "0" * 64)
+    before = server.metrics.snapshot()["counters"].get(
+        "net.send_overflow",
+        0
+    )
+
+    for packet in peer.send(wire.BINARY_MAGIC + aes.encrypt_bytes(
+        wire.encode(["client_alive"])
+    ), 0):
+        client.receive(packet)
+
+    for i in range(1000):
+        client.send(["new_message", [i, 2, "Привет" * 20, 1, 0], {}])
+
+        if server.clients.get(addr) is None:
+            break
+
+    after = server.metrics.snapshot()["counters"]["net.send_overflow"]
+    server.unacked_clients.discard(client)
+
+    assert server.clients.get(addr) is None
+    assert after == before + 1
+    assert len(sock.sent) < 10
+
+
+@mark.parametrize("capabilities", [["binary"], ["binary", "zlib", "zdict"]])
+def test_compressed_account_data(monkeypatch, capabilities):
+    """Большие пакеты сжимаются, если клиент поддерживает сжатие."""
+    dtb = server.Database(":memory:")
+    dtb.reset_database()
+    dtb.create_account("Account", "12345678")
+    dtb.create_account("Account2", "12345678")
+
+    for i in range(200):
+        dtb.send_message("Account2", 1, f"Сообщение номер {i}")
+
+    monkeypatch.setattr(server, "dtb", dtb)
+    monkeypatch.setattr(server, "writer", server.GroupCommitWriter(dtb))
+    monkeypatch.setattr(server, "clients", server.SessionRegistry())
+    bytes_in = server.metrics.counter("compression.bytes_in")
+
+    sock = FakeSocket()
+    addr = ("127.0.0.1", 0)
+    server.accept_client(sock, addr, wire.handshake(capabilities))
+    key = wire.parse_handshake_reply(sock.sent.pop()[0])[0]
+    client = server.clients.get(addr)
+    server.clients.authenticate(client, 1, "Account")
+    client.send_account_data()
+    sent = sum(len(data) for data, _ in sock.sent)
+    received = decode_sent(sock, key, dictionary=wire.PRESET_DICTIONARY)
+    dtb.close()
+
+    assert received[0][0] == "account_data"
+    assert len(received[0][1][1]) == 200
+
+    if "zlib" in capabilities:
+        assert len(sock.sent) == 1
+        assert wire.is_compressed(sock.sent[0][0])
+        assert server.metrics.counter("compression.bytes_in") > bytes_in
+        assert sent < len(wire.encode(received[0])) / 3
+        assert server.metrics.snapshot()["gauges"]["compression.ratio"] < 1
+    else:
+        assert len(sock.sent) > 1
+
+
+@mark.skipif(server.AF_UNIX is None, reason="Нет UNIX сокетов")
+def test_worker_bus(monkeypatch, tmp_path):
+    """Сообщение доставляется получателю, подключённому к другому процессу."""
+    dtb = server.Database(":memory:")
+    dtb.reset_database()
+    dtb.create_account("Account", "12345678")
+    dtb.create_account("Account2", "12345678")
+    monkeypatch.setattr(server, "dtb", dtb)
+    monkeypatch.setattr(server, "writer", server.GroupCommitWriter(dtb))
+    monkeypatch.setattr(server, "clients", server.SessionRegistry())
+
+    sender_bus = server.WorkerBus(str(tmp_path), 0, 2)
+    receiver_bus = server.WorkerBus(str(tmp_path), 1, 2)
+    events = []
+    receiver_bus.start(events.append)
+    monkeypatch.setattr(server, "bus", sender_bus)
+
+    sock = FakeSocket()
+    client = server.NetworkedClient(sock, ("127.0.0.1", 0), "0" * 64)
+    server.clients.add(client, server.time())
+    server.clients.authenticate(client, 1, "Account")
+    client.sync_version = 0
+    client.handle(["send_message", "Привет", 2])
+
+    for _ in range(100):
+        if events:
+            break
+
+        sleep(0.01)
+
+    sender_bus.close()
+    receiver_bus.close()
+
+    peer_sock = FakeSocket()
+    peer = server.NetworkedClient(peer_sock, ("127.0.0.1", 1), "0" * 64)
+    server.clients.add(peer, server.time())
+    server.clients.authenticate(peer, 2, "Account2")
+    peer.sync_version = 0
+    server.dispatch_event(events[0])
+    dtb.close()
+
+    assert events == [["new_message", 2, [1, 1, "Привет", 2, 0], "Account"]]
+    assert decode_sent(peer_sock, "0" * 64) == [
+        ["new_message", [1, 1, "Привет", 2, 0], {"1": "Account"}]
+    ]
+
+
+def test_shard_count_checked(tmp_path):
+    """База данных не открывается с другим количеством файлов сообщений."""
+    single = str(tmp_path / "single.db")
+    dtb = server.Database(single)
+    dtb.reset_database()
+    dtb.create_account("Account", "12345678")
+    dtb.send_message("Account", 1, "Привет")
+    dtb.close()
+
+    sharded = str(tmp_path / "sharded.db")
+    dtb = server.Database(sharded, shards=3)
+    dtb.reset_database()
+    dtb.close()
+
+    with raises(ValueError):
+        server.Database(single, shards=2)
+
+    with raises(ValueError):
+        server.Database(sharded, shards=2)
+
+    with raises(ValueError):
+        server.Database(sharded)
+
+    # База данных до миграции 6: количество определяется по файлам
+    dtb = server.Database(sharded, shards=3)
+    stored = dtb.sql("SELECT value FROM settings WHERE name = 'shards';")
+    dtb.sql("DELETE FROM settings;")
+    dtb.close()
+
+    with raises(ValueError):
+        server.Database(sharded, shards=4)
+
+    server.Database(sharded, shards=3).close()
+    server.Database(single).close()
+
+    assert stored == [(3,)]
+
+
+def test_import_with_sharded_database(tmp_path):
+    """Сервер импортируется, если база данных по умолчанию разбита."""
+    for module in glob(path.join(path.dirname(server.__file__), "*.py")):
+        copy(module, tmp_path)
+
+    dtb = server.Database(str(tmp_path / "messenger.db"), shards=3)
+    dtb.reset_database()
+    dtb.close()
+
+    result = run(
+        [sys.executable, "server.py", "--shards", "3", "--help"],
+        cwd=str(tmp_path),
+        capture_output=True
+    )
+
+    assert result.returncode == 0, result.stderr.decode()
+
+
+def test_max_shards(tmp_path):
+    """Версия синхронизации при MAX_SHARDS файлах передаётся в wire."""
+    dtb = server.Database(
+        str(tmp_path / "messenger.db"),
+        shards=server.MAX_SHARDS
+    )
+    dtb.reset_database()
+
+    for i in range(8):
+        dtb.create_account(f"Account{i}", "12345678")
+
+    for i in range(8):
+        for j in range(8):
+            if i != j:
+                dtb.send_message(f"Account{i}", j + 1, "Привет")
+
+    changes = dtb.get_account_changes("Account0", 0)
+    dtb.close()
+
+    largest = (1 << server.VERSION_BITS * server.MAX_SHARDS) - 1
+    decoded = wire.decode(wire.encode(["sync_data", changes, largest]))
+
+    assert decoded[1][2] == changes[2]
+    assert decoded[2] == largest
+
+    with raises(ValueError):
+        wire.decode(wire.encode(
+            (1 << server.VERSION_BITS * (server.MAX_SHARDS + 1)) - 1
+        ))
+
+    with raises(ValueError):
+        server.Database(
+            str(tmp_path / "other.db"),
+            shards=server.MAX_SHARDS + 1
+        )
+
+    with raises(SystemExit):
+        server.main(["--shards", str(server.MAX_SHARDS + 1)])
+
+
+def test_sharded_database(tmp_path):
+    """Переписки распределяются по файлам, а API не меняется."""
+    dtb = server.Database(str(tmp_path / "messenger.db"), shards=3)
+    dtb.reset_database()
+
+    for i in range(6):
+        dtb.create_account(f"Account{i}", "12345678")
+
+    writer = server.GroupCommitWriter(dtb, 0.01)
+    futures = [
+        writer.submit(
+            dtb.send_message,
+            f"Account{i % 6}",
+            (i * 5) % 6 + 1,
+            f"Сообщение {i}"
+        )
+        for i in range(30)
+    ]
+    failed = writer.submit(dtb.send_message, "Account0", 999, "Нет")
+    messages = [future.result() for future in futures]
+    writer.close()
+
+    with dtb.transaction():
+        with raises(ValueError), dtb.savepoint():
+            dtb.send_message("Account0", 2, "Отменено")
+            raise ValueError
+
+    version = dtb.sync_version()
+    changes = dtb.get_account_changes("Account1", 0)
+    marked_version = dtb.sync_version()
+    dtb.send_message("Account0", 2, "Новое")
+    delta = dtb.get_account_changes("Account1", changes[2])
+    page = dtb.get_conversation("Account0", 2)
+    paths = dtb.backup(str(tmp_path / "backup.db"))
+    dtb.vacuum()
+    dtb.close()
+
+    backup = server.Database(paths[0], shards=3)
+    backup_page = backup.get_conversation("Account0", 2)
+    backup.close()
+
+    counts = []
+
+    for path_ in paths[1:]:
+        shard = server.Database(path_)
+        counts.append(shard.sql("SELECT COUNT(*) FROM direct_messages;"))
+        shard.close()
+
+    residues = {}
+
+    for message in messages:
+        residues.setdefault(
+            frozenset((message[1], message[3])),
+            set()
+        ).add(message[0] % 3)
+
+    assert failed.result() is False
+    assert len({message[0] for message in messages}) == 30
+    assert all(len(residue) == 1 for residue in residues.values())
+    assert sum(count[0][0] for count in counts) == 31 and all(
+        count[0][0] for count in counts
+    )
+    assert version < marked_version == changes[2]
+    assert [m[0] for m in changes[0][1]] == sorted(m[0] for m in changes[0][1])
+    assert len(changes[0][0]) + len(changes[0][1]) == 10
+    assert delta[0][0] == [] and delta[0][1][-1][2] == "Новое"
+    assert page[0][-1][2] == "Новое" and backup_page == page
+    assert "Отменено" not in [message[2] for message in page[0]]
+
+
+def test_command_metrics(monkeypatch):
+    """Время обработки команд записывается в command.<команда>."""
+    dtb = server.Database(":memory:")
+    dtb.reset_database()
+    dtb.create_account("Account", "12345678")
+    monkeypatch.setattr(server, "dtb", dtb)
+    monkeypatch.setattr(server, "clients", server.SessionRegistry())
+    sock = FakeSocket()
+    client = server.NetworkedClient(sock, ("127.0.0.1", 1), "0" * 64)
+    server.clients.add(client, server.time())
+    server.clients.authenticate(client, 1, "Account")
+    before = server.metrics.snapshot()
+
+    client.handle(["find_user", "Nobody"])
+    client.handle(["client_alive"])
+    client.handle(["unknown_command"])
+    after = server.metrics.snapshot()
+    dtb.close()
+
+    def count(snapshot, name):
+        return snapshot["histograms"].get(name, {"count": 0})["count"]
+
+    for name in ("command.find_user", "command.client_alive"):
+        assert count(after, name) == count(before, name) + 1
+
+    assert count(after, "command.other") == count(before, "command.other") + 1
+    assert count(after, "db.query") > count(before, "db.query")
+    assert count(after, "crypto.encrypt") > count(before, "crypto.encrypt")
+    assert after["counters"]["net.packets_out"] > \
+        before["counters"].get("net.packets_out", 0)
+    assert after["gauges"]["clients.active"] == 1
+
+
+def test_slow_request_trace(monkeypatch):
+    """Медленная команда записывается в журнал с этапами обработки."""
+    dtb = server.Database(":memory:")
+    dtb.reset_database()
+    dtb.create_account("Account", "12345678")
+    dtb.create_account("Account2", "12345678")
+    writer = server.GroupCommitWriter(dtb, 0.01)
+    monkeypatch.setattr(server, "dtb", dtb)
+    monkeypatch.setattr(server, "writer", writer)
+    monkeypatch.setattr(server, "clients", server.SessionRegistry())
+    monkeypatch.setattr(server.tracer, "threshold", 0.000001)
+    records = []
+    monkeypatch.setattr(
+        server.tracer,
+        "finish",
+        lambda trace: records.append((trace.name, dict(trace.spans)))
+    )
+    sock = FakeSocket()
+    client = server.NetworkedClient(sock, ("127.0.0.1", 0), "0" * 64)
+    server.clients.add(client, server.time())
+    server.clients.authenticate(client, 1, "Account")
+    client.sync_version = 0
+    aes = server.acrypt(server.KEY_EXTRA + "0" * 64)
+
+    client.receive(aes.encrypt(server.dumps(["find_user", "Account2"])))
+    client.receive(aes.encrypt(server.dumps(["send_message", "Привет", 2])))
+    writer.close()
+    dtb.close()
+
+    assert [name for name, _ in records] == [
+        "command.find_user",
+        "command.send_message"
+    ]
+    assert {"decode", "wait", "handle", "encode", "sendto"} <= \
+        set(records[0][1])
+    assert {"group_commit.queue", "group_commit", "db", "sendto"} <= \
+        set(records[1][1])
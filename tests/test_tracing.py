@@ -0,0 +1,124 @@
+"""Тестирование трассировки запросов."""
+from logging import getLogger
+from logging.handlers import QueueHandler
+from queue import SimpleQueue
+from threading import Thread
+
+from metrics import metrics
+from tracing import Tracer
+
+
+def capture():
+    """Перехватывает записи журнала messenger.
+
+    Возвращаемое значение: Очередь записей и функция отключения.
+    """
+    logger = getLogger("messenger")
+    records = SimpleQueue()
+    handler = QueueHandler(records)
+    level = logger.level
+    logger.addHandler(handler)
+    logger.setLevel("INFO")
+
+    def stop():
+        logger.removeHandler(handler)
+        logger.setLevel(level)
+
+    return records, stop
+
+
+def test_slow_request_logged():
+    """Медленный запрос записывается в журнал с разбивкой по этапам."""
+    tracer = Tracer(0.000001)
+    records, stop = capture()
+    slow = metrics.counter("trace.slow")
+
+    with tracer.resume(tracer.start("command.find_user")):
+        with tracer.span("db"):
+            pass
+
+        with tracer.span("db"):
+            pass
+
+        with tracer.span("sendto"):
+            pass
+
+    stop()
+    message = records.get_nowait().getMessage()
+
+    assert message.startswith("Медленный запрос command.find_user: ")
+    assert message.count("db ") == 1
+    assert "sendto " in message
+    assert metrics.counter("trace.slow") == slow + 1
+    assert records.empty()
+
+
+def test_fast_and_disabled():
+    """Быстрые запросы не записываются, при пороге 0 трассировки нет."""
+    records, stop = capture()
+    tracer = Tracer(60)
+
+    with tracer.resume(tracer.start("command.login")):
+        with tracer.span("db"):
+            assert tracer.current() is not None
+
+    disabled = Tracer(0)
+
+    with tracer.resume(disabled.start("command.login")):
+        with disabled.span("db"):
+            assert disabled.current() is None
+
+    stop()
+
+    assert records.empty()
+
+
+def test_deferred_trace():
+    """Трассировка завершается после продолжения в другом потоке."""
+    tracer = Tracer(0.000001)
+    records, stop = capture()
+
+    with tracer.resume(tracer.start("command.send_message")):
+        trace = tracer.defer()
+
+    assert records.empty()
+
+    def finish():
+        with tracer.resume(trace):
+            with tracer.span("group_commit"):
+                pass
+
+    thread = Thread(target=finish)
+    thread.start()
+    thread.join()
+    stop()
+
+    assert "group_commit " in records.get_nowait().getMessage()
+    assert tracer.current() is None
+
+
+def test_profile(tmp_path):
+    """Профилируются только следующие N запросов выбранной команды."""
+    tracer = Tracer()
+    records, stop = capture()
+    filepath = tmp_path / "profile.stats"
+
+    assert tracer.profile("command.login", "2", str(filepath)) == {
+        "profile": "command.login",
+        "requests": 2
+    }
+
+    for name in ("command.login", "command.sync", "command.login"):
+        with tracer.profiled(name):
+            sorted(range(1000))
+
+    with tracer.profiled("command.login"):
+        pass
+
+    stop()
+    message = records.get_nowait().getMessage()
+
+    assert message.startswith("Профиль command.login:")
+    assert "sorted" in message
+    assert records.empty()
+    assert filepath.exists()
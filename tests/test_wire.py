@@ -0,0 +1,74 @@
+"""Тестирование двоичного формата сообщений."""
+from json import dumps
+from json import loads
+
+from pytest import mark
+from pytest import raises
+
+import wire
+
+
+@mark.parametrize("value", [
+    None,
+    [True, False, 0, -1, 2 ** 63 - 1, -2 ** 70, 1.5, "", "Привет"],
+    ["message_ack", [1, 2, "Текст", 3, 0]],
+    ["conversation", 2, [[i, 1, "x" * i, 2, i % 2] for i in range(300)]],
+    ("row", [-1, 2, "a", 3, 1], [1, 2, "a", 3, True], [1, 2, 3, 4, 5]),
+    {"1": "Account", 2: {"nested": []}, None: 1.0, True: [{}]}
+])
+def test_encode_decode(value):
+    """После декодирования данные совпадают с результатом JSON."""
+    encoded = wire.encode(value)
+
+    assert wire.decode(encoded) == loads(dumps(value))
+    assert len(encoded) <= len(dumps(value, ensure_ascii=False).encode())
+
+
+@mark.parametrize("data", [
+    b"",
+    b"\x05\x02",
+    b"\x06\x02\x00",
+    b"\x00\x00",
+    b"\x63",
+    b"\x06\x01" * 64 + b"\x00"
+])
+def test_decode_invalid(data):
+    """Повреждённые данные вызывают ValueError."""
+    with raises(ValueError):
+        wire.decode(data)
+
+
+def test_handshake():
+    """Согласование возможностей при рукопожатии."""
+    packet = wire.handshake(["binary", "zlib"])
+
+    assert wire.parse_handshake(wire.HANDSHAKE) == []
+    assert wire.parse_handshake(packet) == ["binary", "zlib"]
+    assert wire.parse_handshake(b"\x01") is None
+    assert wire.handshake_reply(b"key") == b"key"
+    assert wire.parse_handshake_reply(b"key") == ("key", [])
+    assert wire.parse_handshake_reply(
+        wire.handshake_reply(b"key", ["binary"])
+    ) == ("key", ["binary"])
+
+
+@mark.parametrize("dictionary", [None, wire.PRESET_DICTIONARY])
+def test_compress_decompress(dictionary):
+    """Сжатые данные распаковываются только с тем же словарём."""
+    data = wire.encode(["account_data", [
+        [i, 1, "Сообщение", 2, 0] for i in range(100)
+    ]])
+    compressed = wire.compress(data, dictionary)
+
+    assert len(compressed) < len(data) / 4
+    assert wire.decompress(compressed, dictionary) == data
+
+    with raises(ValueError):
+        wire.decompress(compressed, dictionary, len(data) - 1)
+
+    with raises(ValueError):
+        wire.decompress(compressed[:-2], dictionary)
+
+    if dictionary is not None:
+        with raises(ValueError):
+            wire.decompress(compressed)
@@ -0,0 +1,237 @@
+"""Модуль трассировки запросов.
+
+Для каждой команды клиента создаётся трассировка, в которую этапы
+обработки (расшифровка, обработка, запросы к базе данных, шифрование,
+отправка) добавляют затраченное время. Если запрос обрабатывался дольше
+порога, он записывается в журнал вместе с разбивкой по этапам.
+
+Трассировка может продолжаться в других потоках (хеширование пароля,
+групповая запись): defer() откладывает её завершение, а resume()
+продолжает в другом потоке и завершает, когда все продолжения выполнены.
+"""
+from cProfile import Profile
+from contextlib import contextmanager
+from io import StringIO
+from pstats import Stats
+from threading import Lock
+from threading import local
+from time import perf_counter
+
+from log import logger
+from metrics import metrics
+
+SLOW_REQUEST_TIME = 0.1
+PROFILE_LINES = 25
+
+
+class Trace:
+    """Трассировка одного запроса."""
+
+    def __init__(self, tracer: "Tracer", name: str) -> None:
+        """Инициализация.
+
+        Аргументы:
+            tracer: Трассировщик, который получит завершённую трассировку.
+            name:   Название запроса (имя метрики команды).
+        """
+        self.name = name
+        self.started = perf_counter()
+        self.spans = {}
+        self.__tracer = tracer
+        self.__pending = 1
+        self.__lock = Lock()
+
+    def add(self, span: str, seconds: float) -> None:
+        """Добавляет время этапа span."""
+        with self.__lock:
+            self.spans[span] = self.spans.get(span, 0.0) + seconds
+
+    def hold(self) -> None:
+        """Откладывает завершение до вызова release()."""
+        with self.__lock:
+            self.__pending += 1
+
+    def release(self) -> None:
+        """Завершает трассировку, если не осталось продолжений."""
+        with self.__lock:
+            self.__pending -= 1
+            finished = self.__pending == 0
+
+        if finished:
+            self.__tracer.finish(self)
+
+
+class Tracer:
+    """Создаёт трассировки и записывает медленные запросы в журнал.
+
+    Метрики:
+        trace.slow: Количество запросов дольше порога.
+    """
+
+    def __init__(self, threshold: float = SLOW_REQUEST_TIME) -> None:
+        """Инициализация.
+
+        Аргументы:
+            threshold:  Порог медленного запроса в секундах. Если 0,
+                            трассировки не создаются.
+        """
+        self.threshold = threshold
+        self.__local = local()
+        self.__profile_lock = Lock()
+        self.__profiler = None
+        self.__profile_name = None
+        self.__profile_left = 0
+        self.__profile_path = None
+
+    def start(self, name: str):
+        """Создаёт трассировку запроса.
+
+        Возвращаемое значение: Trace или None, если трассировка выключена.
+        """
+        if self.threshold <= 0:
+            return None
+
+        return Trace(self, name)
+
+    def current(self):
+        """Возвращает трассировку, активную в этом потоке, или None."""
+        return getattr(self.__local, "trace", None)
+
+    @contextmanager
+    def activate(self, trace):
+        """Делает trace активной в этом потоке внутри блока with."""
+        previous = self.current()
+        self.__local.trace = trace
+
+        try:
+            yield trace
+        finally:
+            self.__local.trace = previous
+
+    @contextmanager
+    def span(self, name: str):
+        """Добавляет время блока with к этапу name активной трассировки."""
+        trace = self.current()
+
+        if trace is None:
+            yield
+            return
+
+        started = perf_counter()
+
+        try:
+            yield
+        finally:
+            trace.add(name, perf_counter() - started)
+
+    def defer(self):
+        """Продлевает активную трассировку для продолжения в другом потоке.
+
+        Возвращаемое значение: Trace, которую нужно передать в resume(),
+            или None.
+        """
+        trace = self.current()
+
+        if trace is not None:
+            trace.hold()
+
+        return trace
+
+    @contextmanager
+    def resume(self, trace):
+        """Продолжает трассировку из defer() и завершает продолжение."""
+        if trace is None:
+            yield
+            return
+
+        try:
+            with self.activate(trace):
+                yield
+        finally:
+            trace.release()
+
+    def finish(self, trace: Trace) -> None:
+        """Записывает трассировку в журнал, если запрос был медленным."""
+        elapsed = perf_counter() - trace.started
+
+        if elapsed < self.threshold:
+            return
+
+        metrics.inc("trace.slow")
+        logger.warning(
+            "Медленный запрос %s: %.1f мс (%s)",
+            trace.name,
+            elapsed * 1000,
+            ", ".join(
+                f"{span} {seconds * 1000:.1f}"
+                for span, seconds in trace.spans.items()
+            )
+        )
+
+    def profile(self, name: str, requests=10, filepath: str = None) -> dict:
+        """Включает cProfile для следующих requests запросов name.
+
+        Когда запросы выполнены, статистика записывается в журнал и, если
+        указан filepath, в файл для pstats.
+
+        Аргументы:
+            name:       Название запроса (например, command.send_message).
+            requests:   Количество запросов.
+            filepath:   Файл статистики или None.
+
+        Возвращаемое значение: Настройки профилирования.
+        """
+        with self.__profile_lock:
+            self.__profiler = Profile()
+            self.__profile_name = name
+            self.__profile_left = int(requests)
+            self.__profile_path = filepath
+
+        return {"profile": name, "requests": int(requests)}
+
+    @contextmanager
+    def profiled(self, name: str):
+        """Профилирует блок with, если включено профилирование name.
+
+        Запросы других потоков в это время не профилируются, так как
+        cProfile не поддерживает несколько одновременных профилей.
+        """
+        if self.__profile_name != name or \
+                not self.__profile_lock.acquire(blocking=False):
+            yield
+            return
+
+        try:
+            if self.__profile_name != name:
+                yield
+                return
+
+            self.__profiler.enable()
+
+            try:
+                yield
+            finally:
+                self.__profiler.disable()
+                self.__profile_left -= 1
+
+                if self.__profile_left <= 0:
+                    self.__report_profile()
+        finally:
+            self.__profile_lock.release()
+
+    def __report_profile(self) -> None:
+        """Записывает собранный профиль и выключает профилирование."""
+        output = StringIO()
+        stats = Stats(self.__profiler, stream=output)
+        stats.sort_stats("cumulative").print_stats(PROFILE_LINES)
+        logger.info("Профиль %s:\n%s", self.__profile_name, output.getvalue())
+
+        if self.__profile_path is not None:
+            stats.dump_stats(self.__profile_path)
+
+        self.__profiler = None
+        self.__profile_name = None
+        self.__profile_path = None
+
+
+tracer = Tracer()
@@ -0,0 +1,381 @@
+"""Модуль двоичного формата сообщений.
+
+Формат повторяет модель данных JSON (после decode() ключи словарей - строки,
+кортежи - списки), поэтому его можно использовать вместо json.dumps() и
+json.loads() без изменения обработчиков команд. Каждое значение начинается
+с байта типа, числа записываются в формате varint, строки и контейнеры -
+с длиной в начале. Строки сообщений [id, sender, content, receiver, read]
+записываются отдельным типом без байтов типов полей.
+
+Двоичный формат согласуется при рукопожатии: клиент добавляет к HANDSHAKE
+список возможностей через запятую, сервер добавляет к ключу "\\0" и
+принятые возможности. Старые клиенты отправляют только HANDSHAKE и получают
+только ключ. Двоичные пакеты начинаются с BINARY_MAGIC, за которым идёт
+шифротекст без base64 (AES-GCM, если согласована возможность GCM, иначе
+AES-CBC).
+
+Если согласована возможность ZLIB, пакеты больше COMPRESSION_THRESHOLD
+сжимаются перед шифрованием и начинаются с COMPRESSED_MAGIC. Возможность
+ZDICT включает для сессии словарь PRESET_DICTIONARY с типичными командами
+и строками сообщений, который улучшает сжатие небольших пакетов.
+"""
+from struct import Struct
+from zlib import MAX_WBITS
+from zlib import compressobj
+from zlib import decompressobj
+from zlib import error as ZlibError
+
+HANDSHAKE = b"\x05\x03\xff\x01"
+BINARY_MAGIC = b"\xfc"
+BINARY = "binary"
+GCM = "gcm"
+ZLIB = "zlib"
+ZDICT = "zdict"
+COMPRESSED_MAGIC = b"\xfb"
+COMPRESSION_THRESHOLD = 256
+COMPRESSION_LEVEL = 6
+MAX_DECOMPRESSED_SIZE = 64 * 1024 * 1024
+NONE = 0
+FALSE = 1
+TRUE = 2
+INT = 3
+FLOAT = 4
+STR = 5
+LIST = 6
+DICT = 7
+ROW = 8
+DOUBLE = Struct("!d")
+MAX_DEPTH = 32
+# Максимальное количество бит числа varint (92 байта по 7 бит)
+MAX_VARINT_BITS = 644
+
+
+def _write_varint(out: bytearray, value: int) -> None:
+    """Записывает неотрицательное число в формате varint."""
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+
+    out.append(value)
+
+
+def _write_int(out: bytearray, value: int) -> None:
+    """Записывает целое число в формате zigzag varint."""
+    _write_varint(out, value * 2 if value >= 0 else -value * 2 - 1)
+
+
+def _write_str(out: bytearray, value: str) -> None:
+    """Записывает строку с длиной в начале."""
+    data = value.encode("utf8")
+    _write_varint(out, len(data))
+    out += data
+
+
+def _is_row(value) -> bool:
+    """Проверяет, является ли значение строкой сообщения."""
+    return len(value) == 5 and \
+        all(type(value[i]) is int for i in (0, 1, 3, 4)) and \
+        type(value[2]) is str and 0 <= value[4] <= 0xff
+
+
+def _write(out: bytearray, value, depth: int) -> None:
+    """Записывает значение value."""
+    if depth > MAX_DEPTH:
+        raise ValueError("Слишком большая вложенность")
+
+    if value is None:
+        out.append(NONE)
+    elif value is False:
+        out.append(FALSE)
+    elif value is True:
+        out.append(TRUE)
+    elif isinstance(value, int):
+        out.append(INT)
+        _write_int(out, value)
+    elif isinstance(value, float):
+        out.append(FLOAT)
+        out += DOUBLE.pack(value)
+    elif isinstance(value, str):
+        out.append(STR)
+        _write_str(out, value)
+    elif isinstance(value, (list, tuple)):
+        if _is_row(value):
+            out.append(ROW)
+            _write_int(out, value[0])
+            _write_int(out, value[1])
+            _write_str(out, value[2])
+            _write_int(out, value[3])
+            out.append(value[4])
+            return
+
+        out.append(LIST)
+        _write_varint(out, len(value))
+
+        for item in value:
+            _write(out, item, depth + 1)
+    elif isinstance(value, dict):
+        out.append(DICT)
+        _write_varint(out, len(value))
+
+        for key, item in value.items():
+            _write_str(out, _json_key(key))
+            _write(out, item, depth + 1)
+    else:
+        raise TypeError(f"Тип {type(value).__name__} не поддерживается")
+
+
+def _json_key(key) -> str:
+    """Преобразует ключ словаря в строку так же, как json.dumps()."""
+    if isinstance(key, str):
+        return key
+
+    if key is None:
+        return "null"
+
+    if isinstance(key, bool):
+        return "true" if key else "false"
+
+    if isinstance(key, (int, float)):
+        return str(key)
+
+    raise TypeError(f"Ключ {type(key).__name__} не поддерживается")
+
+
+def encode(value) -> bytes:
+    """Превращает объект, преобразуемый в JSON, в байты."""
+    out = bytearray()
+    _write(out, value, 0)
+    return bytes(out)
+
+
+class _Reader:
+    """Последовательное чтение значений из байтов."""
+
+    def __init__(self, data: bytes) -> None:
+        """Инициализация."""
+        self.data = data
+        self.pos = 0
+
+    def byte(self) -> int:
+        """Читает один байт."""
+        if self.pos >= len(self.data):
+            raise ValueError("Неожиданный конец данных")
+
+        self.pos += 1
+        return self.data[self.pos - 1]
+
+    def varint(self) -> int:
+        """Читает неотрицательное число в формате varint."""
+        if self.pos < len(self.data) and self.data[self.pos] < 0x80:
+            self.pos += 1
+            return self.data[self.pos - 1]
+
+        value = 0
+        shift = 0
+
+        while True:
+            byte = self.byte()
+            value |= (byte & 0x7f) << shift
+
+            if byte < 0x80:
+                return value
+
+            shift += 7
+
+            if shift >= MAX_VARINT_BITS:
+                raise ValueError("Слишком длинное число")
+
+    def int(self) -> int:
+        """Читает целое число в формате zigzag varint."""
+        value = self.varint()
+        return value >> 1 if value & 1 == 0 else -(value >> 1) - 1
+
+    def bytes(self, length: int) -> bytes:
+        """Читает length байтов."""
+        if self.pos + length > len(self.data):
+            raise ValueError("Неожиданный конец данных")
+
+        self.pos += length
+        return self.data[self.pos - length:self.pos]
+
+    def str(self) -> str:
+        """Читает строку с длиной в начале."""
+        return self.bytes(self.varint()).decode("utf8")
+
+    def value(self, depth: int = 0):
+        """Читает значение."""
+        if depth > MAX_DEPTH:
+            raise ValueError("Слишком большая вложенность")
+
+        kind = self.byte()
+
+        if kind == NONE:
+            return None
+        if kind == FALSE:
+            return False
+        if kind == TRUE:
+            return True
+        if kind == INT:
+            return self.int()
+        if kind == FLOAT:
+            return DOUBLE.unpack(self.bytes(DOUBLE.size))[0]
+        if kind == STR:
+            return self.str()
+        if kind == ROW:
+            return [
+                self.int(),
+                self.int(),
+                self.str(),
+                self.int(),
+                self.byte()
+            ]
+        if kind == LIST:
+            return [self.value(depth + 1) for _ in range(self.varint())]
+        if kind == DICT:
+            return {
+                self.str(): self.value(depth + 1)
+                for _ in range(self.varint())
+            }
+
+        raise ValueError(f"Неизвестный тип {kind}")
+
+
+def decode(data: bytes):
+    """Превращает байты в объект, преобразуемый в JSON.
+
+    Исключения:
+        ValueError: Данные повреждены.
+    """
+    reader = _Reader(data)
+    value = reader.value()
+
+    if reader.pos != len(data):
+        raise ValueError("Лишние данные в конце")
+
+    return value
+
+
+def is_binary(packet: bytes) -> bool:
+    """Проверяет, записан ли пакет в двоичном формате."""
+    return packet.startswith(BINARY_MAGIC)
+
+
+def handshake(capabilities=()) -> bytes:
+    """Создаёт пакет рукопожатия со списком возможностей клиента."""
+    return HANDSHAKE + ",".join(capabilities).encode("ascii")
+
+
+def parse_handshake(packet: bytes):
+    """Возвращает возможности клиента или None, если это не рукопожатие."""
+    if not packet.startswith(HANDSHAKE):
+        return None
+
+    return [
+        capability
+        for capability in packet[len(HANDSHAKE):].decode(
+            "ascii",
+            "replace"
+        ).split(",")
+        if capability
+    ]
+
+
+def handshake_reply(key: bytes, capabilities=()) -> bytes:
+    """Создаёт ответ на рукопожатие с ключом и принятыми возможностями."""
+    if not capabilities:
+        return key
+
+    return key + b"\0" + ",".join(capabilities).encode("ascii")
+
+
+def parse_handshake_reply(packet: bytes) -> (str, list):
+    """Возвращает ключ и принятые сервером возможности."""
+    key, _, capabilities = packet.partition(b"\0")
+    return key.decode("ascii"), [
+        capability
+        for capability in capabilities.decode("ascii").split(",")
+        if capability
+    ]
+
+
+def is_compressed(packet: bytes) -> bool:
+    """Проверяет, сжат ли пакет."""
+    return packet.startswith(COMPRESSED_MAGIC)
+
+
+def compress(data: bytes, dictionary: bytes = None) -> bytes:
+    """Сжимает data без заголовка zlib.
+
+    Аргументы:
+        data:       Данные.
+        dictionary: Словарь, который должен быть и у получателя.
+    """
+    if dictionary is None:
+        compressor = compressobj(COMPRESSION_LEVEL, wbits=-MAX_WBITS)
+    else:
+        compressor = compressobj(
+            COMPRESSION_LEVEL,
+            wbits=-MAX_WBITS,
+            zdict=dictionary
+        )
+
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress(
+    data: bytes,
+    dictionary: bytes = None,
+    max_size: int = MAX_DECOMPRESSED_SIZE
+) -> bytes:
+    """Распаковывает результат compress().
+
+    Исключения:
+        ValueError: Данные повреждены или больше max_size.
+    """
+    if dictionary is None:
+        decompressor = decompressobj(wbits=-MAX_WBITS)
+    else:
+        decompressor = decompressobj(wbits=-MAX_WBITS, zdict=dictionary)
+
+    try:
+        result = decompressor.decompress(data, max_size)
+    except ZlibError as exc:
+        raise ValueError("Данные повреждены") from exc
+
+    if decompressor.unconsumed_tail:
+        raise ValueError("Слишком большой пакет")
+
+    if not decompressor.eof:
+        raise ValueError("Неожиданный конец данных")
+
+    return result
+
+
+# Словарь собран из пакетов протокола: zlib находит в нём названия команд и
+# повторяющуюся структуру строк сообщений даже в первом пакете сессии
+PRESET_DICTIONARY = b"".join(encode(sample) for sample in (
+    ["login", "", ""],
+    ["register", "", ""],
+    ["get_account_data"],
+    ["get_conversation", 1, 1, 50],
+    ["send_message", "", 1],
+    ["find_user", ""],
+    ["find_user_result", 1, ""],
+    ["login_status", 0],
+    ["register_status", 0],
+    ["message_ack", [1, 1, "", 2, 0]],
+    ["message_status", 1, 1],
+    ["new_message", [1, 1, "", 2, 0], {"1": ""}],
+    ["conversation", 1, [[1, 1, "", 2, 1], [2, 2, "", 1, 0]], False],
+    ["sync", 1],
+    [
+        "sync_data",
+        False,
+        1,
+        [[[1, 1, "", 2, 1]], [[2, 2, "", 1, 0]], {"1": "", "2": ""}]
+    ],
+    [
+        "account_data",
+        [[[1, 1, "", 2, 1]], [[2, 2, "", 1, 0]], {"1": "", "2": ""}]
+    ]
+))